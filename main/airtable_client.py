@@ -0,0 +1,250 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# airtable_client.py
+#
+# Polls the Airtable control and image tables without hammering the
+# API. One pooled requests session is shared by every call, requests
+# are spaced to stay under Airtable's rate limit, failures and 429s
+# back off exponentially with jitter, and waiters are woken by an
+# asyncio condition when a watched status changes.
+#
+# Point api_url at fake_airtable.FakeAirtable to run offline.
+#
+# NECESSARY FOR USE:
+# requests
+
+import asyncio
+import random
+import time
+import requests
+
+BASE_ID = 'appuhn9X6CJyPGaho'
+API_URL = 'https://api.airtable.com/v0'
+
+CONTROL_TABLE = 'control'
+CONTROL_QUERY = 'sort%5B0%5D%5Bfield%5D=Name'
+UNLOAD_RECORD = 4  # when sorting by name, 'frosting position set' is 5th record
+
+IMAGE_TABLE = 'image'
+IMAGE_QUERY = 'sort%5B0%5D%5Bfield%5D=Created'
+
+
+class AirtableError(Exception):
+    pass
+
+
+class AirtablePoller:
+    def __init__(self, api_key: str = None, base_id: str = BASE_ID, api_url: str = API_URL,
+                 poll_interval: float = 1.0, min_interval: float = 0.2, max_backoff: float = 60,
+                 max_retries: int = 8, timeout: float = 10):
+        """
+        Constructs an Airtable poller
+        :param api_key: Airtable API key. Read once from api_key.txt if None
+        :param base_id: Airtable base to poll
+        :param api_url: Airtable API root, change for a local stand-in server
+        :param poll_interval: seconds between polls of a watched status
+        :param min_interval: minimum seconds between any two requests.
+                             Airtable allows 5 requests per second per base
+        :param max_backoff: longest wait in seconds between retries
+        :param max_retries: retries of a failed request before giving up
+        :param timeout: seconds before a request times out
+        """
+        if api_key is None:
+            with open('api_key.txt') as f:
+                api_key = f.read().strip()
+
+        self.base_url = api_url.rstrip('/') + '/' + base_id + '/'
+        self.poll_interval = poll_interval
+        self.min_interval = min_interval
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        # One session keeps the connection to Airtable open between polls
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer ' + api_key
+
+        self.status = {}
+        self.requests_made = 0
+        self._next_request = 0
+        self._changed = None
+
+    def _request(self, table: str, query: str = '') -> requests.Response:
+        """Makes one GET request without retrying."""
+        self.requests_made += 1
+        return self.session.get(self.base_url + table + '?' + query, timeout=self.timeout)
+
+    def _retry_delay(self, attempt: int, response: requests.Response = None) -> float:
+        """
+        Seconds to wait before retrying. Uses Retry-After from a rate limited
+        response if there is one, otherwise exponential backoff with full jitter.
+        """
+        if response is not None and 'Retry-After' in response.headers:
+            try:
+                return float(response.headers['Retry-After'])
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.min_interval * 2 ** (attempt + 1)))
+
+    @staticmethod
+    def _should_retry(response: requests.Response) -> bool:
+        return response.status_code == 429 or response.status_code >= 500
+
+    def _rate_limit_delay(self, after: float = 0) -> float:
+        """
+        Reserves the next request slot and returns how long to wait for it
+        :param after: seconds from now the request can be made at the earliest
+        """
+        now = time.monotonic()
+        start = max(now + after, self._next_request)
+        self._next_request = start + self.min_interval
+        return start - now
+
+    def _try_request(self, table: str, query: str = '') -> tuple:
+        """
+        Makes one request
+        :return: (True, decoded json) if it succeeded, otherwise (False, response to
+                 retry), with no response if it couldn't connect or timed out
+        """
+        try:
+            response = self._request(table, query)
+        except (requests.ConnectionError, requests.Timeout):
+            return False, None
+        if self._should_retry(response):
+            return False, response
+        response.raise_for_status()
+        return True, response.json()
+
+    def _retries(self, table: str):
+        """
+        The retry rules of fetch() and get(), as a generator of seconds to wait
+        before each try. Each try's result from _try_request() is sent back in,
+        and the generator returns the json once one succeeds.
+        """
+        delay = self._rate_limit_delay()
+        for attempt in range(self.max_retries + 1):
+            succeeded, result = yield delay
+            if succeeded:
+                return result
+            if attempt == self.max_retries:
+                break
+            backoff = self._retry_delay(attempt, result)
+            delay = self._rate_limit_delay(backoff)
+
+        raise AirtableError('Gave up getting %s after %d retries' % (table, self.max_retries))
+
+    def fetch(self, table: str, query: str = '') -> dict:
+        """
+        Gets a table, blocking until it succeeds or retries run out
+        :param table: table name
+        :param query: url encoded query string
+        :return: decoded json response
+        """
+        retries = self._retries(table)
+        delay = next(retries)
+        while True:
+            time.sleep(delay)
+            try:
+                delay = retries.send(self._try_request(table, query))
+            except StopIteration as done:
+                return done.value
+
+    async def get(self, table: str, query: str = '') -> dict:
+        """
+        Gets a table without blocking the event loop
+        :param table: table name
+        :param query: url encoded query string
+        :return: decoded json response
+        """
+        retries = self._retries(table)
+        delay = next(retries)
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                delay = retries.send(await asyncio.to_thread(self._try_request, table, query))
+            except StopIteration as done:
+                return done.value
+
+    async def watch(self, name: str, table: str, query: str, extract):
+        """
+        Polls a table forever, waking waiters whenever the watched value changes
+        :param name: name to store the value under in self.status
+        :param table: table name
+        :param query: url encoded query string
+        :param extract: function taking the json response and returning the value to watch
+        :return: None, runs until cancelled
+        """
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+
+        while True:
+            value = extract(await self.get(table, query))
+            if self.status.get(name) != value or name not in self.status:
+                async with self._changed:
+                    self.status[name] = value
+                    self._changed.notify_all()
+            await asyncio.sleep(self.poll_interval)
+
+    async def wait_for_status(self, name: str, value) -> None:
+        """
+        Waits until a watched value equals value
+        :param name: name the value is watched under
+        :param value: value to wait for
+        :return: None
+        """
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.status.get(name) == value)
+
+    async def wait_for_unload(self, next_unload: bool = False) -> None:
+        """
+        Waits until the control table marks unloading complete
+        :param next_unload: wait for an unload that hasn't finished yet. The status
+                            stays 'complete' from the last unload until the unloader
+                            starts the next one, so it must change before it counts
+        :return: None
+        """
+        def unload_status(response):
+            return response['records'][UNLOAD_RECORD]['fields']['Select']
+
+        # Start fresh for each wait, which may be in a new event loop
+        self._changed = asyncio.Condition()
+        self.status.pop('unload', None)
+
+        watcher = asyncio.create_task(self.watch('unload', CONTROL_TABLE, CONTROL_QUERY, unload_status))
+        async def unloaded():
+            if next_unload:
+                async with self._changed:
+                    await self._changed.wait_for(lambda: self.status.get('unload', 'complete') != 'complete')
+            await self.wait_for_status('unload', 'complete')
+
+        waiter = asyncio.create_task(unloaded())
+        try:
+            # Whichever finishes first: the status, or the watcher giving up
+            done, _ = await asyncio.wait((watcher, waiter), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            watcher.cancel()
+            waiter.cancel()
+
+    def image_records(self) -> list:
+        """
+        Every order in the image table, oldest first
+        :return: Airtable records, each with 'id' and the image attachments in fields['Image']
+        """
+        return self.fetch(IMAGE_TABLE, IMAGE_QUERY)['records']
+
+    def latest_image(self) -> dict:
+        """
+        Attachment of the last image submitted to the image table
+        :return: Airtable attachment, with at least 'id' and 'url'
+        """
+        return self.image_records()[-1]['fields']['Image'][0]
+
+    def close(self):
+        self.session.close()
+        return
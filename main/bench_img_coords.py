@@ -0,0 +1,122 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# bench_img_coords.py
+#
+# Checks the vectorized G-code coordinate construction in
+# img_processing against the old point-by-point version, and times
+# both across contour counts. Also checks thousands of contours are
+# ordered in well under a second.
+#
+# NECESSARY FOR USE:
+# numpy
+# opencv-python
+
+from img_processing import __getImgCoords as get_img_coords
+from img_processing import __getBgd as get_bgd
+from img_processing import COAST_MM, orderContours
+import numpy as np
+import time
+
+
+def old_img_coords(contours, coast_mm=COAST_MM):
+    """
+    The old __getImgCoords, one np.append per point, with its coast changed
+    from the last 5 points to the last coast_mm along each line.
+    """
+    coordinates = []
+    for line in contours:
+        points = np.reshape(line, (-1, 2)).astype(float)
+        travelled = [0.0]
+        for point_num in range(1, len(points)):
+            travelled.append(travelled[-1] + np.hypot(*(points[point_num] - points[point_num - 1])))
+
+        for point_num in range(len(points)):
+            to_end = travelled[-1] - travelled[point_num]
+            if point_num == 0:
+                coordinates.append(np.append(points[point_num], 0))
+            elif to_end >= coast_mm:
+                coordinates.append(np.append(points[point_num], 1))
+            else:
+                # The coast starts partway along this move: frost up to there
+                before = travelled[-1] - travelled[point_num - 1]
+                if before > coast_mm:
+                    fraction = (before - coast_mm) / (before - to_end)
+                    split = np.rint(points[point_num - 1] + fraction * (points[point_num] - points[point_num - 1]))
+                    if np.any(split != points[point_num]) and np.any(split != points[point_num - 1]):
+                        coordinates.append(np.append(split, 1))
+                coordinates.append(np.append(points[point_num], 0))
+
+    coordinates.append([0, 0, 0])
+
+    return np.asarray(coordinates).astype(int)
+
+
+def old_bgd(img):
+    """The old 12x12 grid __getBgd, built with __reverseBgdLines and __gcodeBgdCoords loops."""
+    spacing_pt = .08
+    num_x_y = int(1 / spacing_pt)
+    Y, X = np.meshgrid(np.linspace(0, img.shape[0], num_x_y), np.linspace(0, img.shape[1], num_x_y))
+    positions = np.column_stack([X.ravel(), Y.ravel()]).astype(int).tolist()
+    spc_inv = int(1 / spacing_pt)
+
+    rev_coords = []
+    for i in range(spc_inv):
+        temp_crd_list = positions[(i * spc_inv):(((i + 1) * spc_inv))]
+        if (i + 1) % 2 == 0:
+            for j in reversed(range(spc_inv)):
+                rev_coords.append(temp_crd_list[j])
+        else:
+            for j in range(spc_inv):
+                rev_coords.append(temp_crd_list[j])
+
+    coordinates = []
+    for i in range(len(positions)):
+        if (i == 0):
+            coord = np.append(rev_coords[i], 0)
+        else:
+            coord = np.append(rev_coords[i], 1)
+
+        coordinates.append(coord)
+
+    coordinates.append([0, 0, 0])
+
+    return np.asarray(coordinates)
+
+
+def random_contours(num: int, rng: np.random.Generator) -> list:
+    """Closed contours of 3 to 60 points, shaped like cv2.findContours output."""
+    return [rng.integers(0, 190, (rng.integers(3, 60), 1, 2)).astype(np.int32) for _ in range(num)]
+
+
+def bench(func, *args) -> float:
+    """Wall time of func(*args) in seconds."""
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    rng = np.random.default_rng(0)
+
+    img = np.zeros((190, 152), dtype='uint8')
+    # The background is now a scanline fill, so only the times compare
+    print('Background: old grid %.5f s  scanline fill %.5f s' % (bench(old_bgd, img), bench(get_bgd, img)))
+
+    for num in (10, 100, 1000, 5000):
+        contours = random_contours(num, rng)
+        assert np.array_equal(get_img_coords(contours), old_img_coords(contours))
+        old_time = bench(old_img_coords, contours)
+        new_time = bench(get_img_coords, contours)
+        print('%5d contours: old %.4f s  new %.5f s  (%.0fx)' % (num, old_time, new_time, old_time / new_time))
+
+    for num in (1000, 5000, 10000):
+        contours = random_contours(num, rng)
+        order_time = bench(orderContours, contours)
+        print('%5d contours ordered in %.3f s' % (num, order_time))
+        if num <= 5000:
+            assert order_time < 0.5, 'ordering %d contours took %.2f s' % (num, order_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# bench_step_planner.py
+#
+# Times the step_planner line algorithm against the old lcm
+# interlacing loop from x_y_move, without any hardware attached.
+#
+# NECESSARY FOR USE:
+# numpy
+
+from step_planner import plan_move, plan_path
+import numpy as np
+import time
+
+
+def lcm_plan(dx: float, dy: float, x_steps_per_mm: float, y_steps_per_mm: float) -> np.ndarray:
+    """
+    The old x_y_move interlacing, returning the steps taken instead of stepping.
+    :param dx: distance to move in x (can be negative)
+    :param dy: distance to move in y (can be negative)
+    :param x_steps_per_mm: steps per mm on the x axis
+    :param y_steps_per_mm: steps per mm on the y axis
+    :return: (n, 2) step plan of the iterations that stepped
+    """
+    dir_x = int(np.sign(dx))
+    dir_y = int(np.sign(dy))
+    steps_x = int(abs(dx) * x_steps_per_mm)
+    steps_y = int(abs(dy) * y_steps_per_mm)
+
+    if steps_x > 0 and steps_y > 0:
+        iter_lcm = np.lcm(steps_x, steps_y)
+        x_mod = iter_lcm // steps_x
+        y_mod = iter_lcm // steps_y
+    elif steps_x == 0:
+        iter_lcm = steps_y
+        x_mod = 0.1  # will never trigger
+        y_mod = 1
+    elif steps_y == 0:
+        iter_lcm = steps_x
+        x_mod = 1
+        y_mod = 0.1  # will never trigger
+    else:
+        iter_lcm = 0
+        x_mod = 1
+        y_mod = 1
+
+    plan = []
+    for j in np.arange(1, iter_lcm + 1, 1):
+        step_x = j % x_mod == 0
+        step_y = j % y_mod == 0
+        if step_x or step_y:
+            plan.append((dir_x * step_x, dir_y * step_y))
+    return np.array(plan, dtype=np.int8).reshape(-1, 2)
+
+
+def bench(func, *args, repeats: int = 3) -> float:
+    """Best wall time of func(*args) over a few repeats, in seconds."""
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    steps_per_mm = 10
+
+    print('Single diagonal move 99.7 mm x 99.1 mm:')
+    lcm_time = bench(lcm_plan, 99.7, 99.1, steps_per_mm, steps_per_mm, repeats=1)
+    dda_time = bench(plan_move, 99.7, 99.1, steps_per_mm, steps_per_mm)
+    print('  lcm: %.4f s  line: %.6f s  (%.0fx)' % (lcm_time, dda_time, lcm_time / dda_time))
+
+    rng = np.random.default_rng(0)
+    for moves in (100, 1000, 10000):
+        drawing = np.column_stack((rng.uniform(0, 150, (moves, 2)), np.ones(moves)))
+
+        def lcm_drawing():
+            loc = np.zeros(2)
+            for command in drawing:
+                lcm_plan(*(command[0:2] - loc), steps_per_mm, steps_per_mm)
+                loc = command[0:2]
+
+        # The lcm loop is too slow to run on the big drawings
+        lcm_time = bench(lcm_drawing, repeats=1) if moves <= 100 else np.nan
+        dda_time = bench(plan_path, drawing, steps_per_mm, steps_per_mm)
+        steps = len(plan_path(drawing, steps_per_mm, steps_per_mm)[0])
+        print('%6d random moves, %8d steps:  lcm: %8.3f s  line: %.4f s'
+              % (moves, steps, lcm_time, dda_time))
+
+
+if __name__ == '__main__':
+    main()
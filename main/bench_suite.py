@@ -0,0 +1,260 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# bench_suite.py
+#
+# Offline benchmark of the whole pipeline, to tell whether a change
+# makes jobs faster or slower. Synthetic images (a logo, text, a photo
+# and dense line art) are generated at several resolutions and each is
+# timed through every img_processing stage (centerline tracing too),
+# step generation, motion planning, sim_frosting, and drawing on a
+# simulated board.
+#
+# Results are saved as JSON. Pass an earlier results file to compare
+# against it:
+#     python bench_suite.py [--quick] [--out results.json] [--compare old.json]
+#
+# orderContours stops improving the order after its 2-opt time budget
+# (0.25 s), so the order stage of dense images is capped near that.
+#
+# NECESSARY FOR USE:
+# numpy
+# opencv-python
+# matplotlib (for sims/sim.py)
+
+from contextlib import redirect_stdout
+from img_processing import __getImg as get_img
+from img_processing import __getBgd as get_bgd
+from img_processing import __getImgCoords as get_img_coords
+from img_processing import simplifyContours, orderContours, iterImgCoords as iter_img_coords
+from step_planner import plan_path
+from motion_planner import MotionPlanner
+from extrusion import ExtrusionController
+from frosting_hal import SimulatedBackend
+from frosting_board import FrostingMainBoard
+from sims.sim import sim_frosting
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import cv2
+import numpy as np
+
+RESOLUTIONS = {'small': (300, 400), 'medium': (900, 1200), 'large': (2400, 3200)}
+STEPS_PER_MM = 10
+
+
+def logo_image(rows: int, cols: int, rng: np.random.Generator) -> np.ndarray:
+    """Filled circles, rings and polygons, dark on white"""
+    img = np.full((rows, cols), 255, dtype=np.uint8)
+    scale = min(rows, cols)
+    center = (cols // 2, rows // 2)
+    cv2.circle(img, center, int(scale * 0.4), 0, -1)
+    cv2.circle(img, center, int(scale * 0.3), 255, -1)
+    star = np.array([[np.cos(a) * r, np.sin(a) * r]
+                     for a, r in zip(np.linspace(0, 2 * np.pi, 10, endpoint=False),
+                                     [scale * 0.25, scale * 0.1] * 5)]) + center
+    cv2.fillPoly(img, [star.astype(np.int32)], 0)
+    for _ in range(6):
+        x, y = rng.integers(0, cols), rng.integers(0, rows)
+        cv2.rectangle(img, (int(x), int(y)), (int(x + scale * 0.08), int(y + scale * 0.08)), 0, -1)
+    return img
+
+
+def text_image(rows: int, cols: int, rng: np.random.Generator) -> np.ndarray:
+    """Several lines of text, like a birthday message"""
+    img = np.full((rows, cols), 255, dtype=np.uint8)
+    lines = ('HAPPY BIRTHDAY', 'Tufts ME35', 'Frosting 2022', 'abcdefghijklm')
+    font_scale = cols / 400
+    thickness = max(1, int(font_scale * 2))
+    for i, line in enumerate(lines):
+        y = int(rows * (i + 1) / (len(lines) + 1))
+        cv2.putText(img, line, (int(cols * 0.05), y), cv2.FONT_HERSHEY_SIMPLEX, font_scale, 0, thickness)
+    return img
+
+
+def photo_image(rows: int, cols: int, rng: np.random.Generator) -> np.ndarray:
+    """Smooth blobs of light and shade with grain, standing in for a photo"""
+    noise = rng.random((max(rows // 20, 2), max(cols // 20, 2))).astype(np.float32)
+    img = cv2.resize(noise, (cols, rows), interpolation=cv2.INTER_CUBIC)
+    gradient = np.linspace(0, 0.3, cols, dtype=np.float32)
+    img = img + gradient + rng.normal(0, 0.05, (rows, cols)).astype(np.float32)
+    return cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+
+def line_art_image(rows: int, cols: int, rng: np.random.Generator) -> np.ndarray:
+    """Dense thin lines and ellipses"""
+    img = np.full((rows, cols), 255, dtype=np.uint8)
+    thickness = max(1, min(rows, cols) // 300)
+    for _ in range(150):
+        p1 = (int(rng.integers(0, cols)), int(rng.integers(0, rows)))
+        p2 = (int(rng.integers(0, cols)), int(rng.integers(0, rows)))
+        cv2.line(img, p1, p2, 0, thickness)
+    for _ in range(40):
+        center = (int(rng.integers(0, cols)), int(rng.integers(0, rows)))
+        axes = (int(rng.integers(5, cols // 8)), int(rng.integers(5, rows // 8)))
+        cv2.ellipse(img, center, axes, float(rng.uniform(0, 180)), 0, 360, 0, thickness)
+    return img
+
+
+IMAGES = {'logo': logo_image, 'text': text_image, 'photo': photo_image, 'line_art': line_art_image}
+
+
+def best_time(function, repeats: int) -> tuple:
+    """
+    Runs function repeats times with its printing silenced
+    :return: (fastest time in seconds, result of the last run)
+    """
+    best = np.inf
+    for _ in range(repeats):
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = function()
+            best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_image(img: np.ndarray, repeats: int) -> dict:
+    """
+    Times one image through the pipeline
+    :param img: grayscale image
+    :param repeats: runs of each stage, the fastest is kept
+    :return: {'seconds': {stage: s}, 'counts': {...}, 'rates': {...}}
+    """
+    seconds = {}
+    seconds['preprocess'], (ctrs, dim_img) = best_time(lambda: get_img(img), repeats)
+    seconds['background'], bgd = best_time(lambda: get_bgd(dim_img, ctrs), repeats)
+    seconds['simplify'], simplified = best_time(lambda: simplifyContours(ctrs), repeats)
+    seconds['order'], ordered = best_time(lambda: orderContours(simplified), repeats)
+    seconds['coords'], coords = best_time(lambda: get_img_coords(ordered), repeats)
+    seconds['centerline'], (lines, _) = best_time(lambda: get_img(img, mode='centerline'), repeats)
+    _, centerline_coords = best_time(
+        lambda: np.concatenate(list(iter_img_coords(lines, closed=False))), 1)
+
+    commands = coords.astype(float)
+    seconds['step_generation'], (steps, _) = best_time(
+        lambda: plan_path(commands, STEPS_PER_MM, STEPS_PER_MM), repeats)
+
+    planner = MotionPlanner(STEPS_PER_MM, STEPS_PER_MM)
+    extrusion = ExtrusionController(STEPS_PER_MM, STEPS_PER_MM)
+    seconds['motion_planning'], schedule = best_time(
+        lambda: extrusion.apply(planner.plan(commands)), repeats)
+
+    seconds['sim_frosting'], _ = best_time(
+        lambda: sim_frosting(commands[:, 0:2], STEPS_PER_MM, STEPS_PER_MM, plot=False), repeats)
+
+    # End to end on a simulated board: planning, executor thread and motor calls
+    def draw():
+        board = FrostingMainBoard(SimulatedBackend())
+        board.draw(commands, board.white_extruder)
+    seconds['simulated_draw'], _ = best_time(draw, 1)
+
+    return {'seconds': seconds,
+            'counts': {'contours': len(ctrs),
+                       'moves': len(coords),
+                       'centerline_moves': len(centerline_coords),
+                       'background_moves': len(bgd),
+                       'step_iterations': len(steps)},
+            'rates': {'step_iterations_per_s': len(steps) / seconds['simulated_draw'],
+                      'planned_job_s': float(schedule['t'][-1]) if len(schedule) else 0.0}}
+
+
+def environment() -> dict:
+    """Versions and commit the results were measured with"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def run(resolutions: dict = RESOLUTIONS, images: dict = IMAGES, repeats: int = 3, seed: int = 0) -> dict:
+    """
+    Runs the benchmark on every image at every resolution
+    :param resolutions: {name: (rows, cols)}
+    :param images: {name: function(rows, cols, rng) returning a grayscale image}
+    :param repeats: runs of each stage, the fastest is kept
+    :param seed: random seed for the synthetic images
+    :return: results, ready to save as JSON
+    """
+    results = {'environment': environment(), 'benchmarks': {}}
+
+    for image_name, make_image in images.items():
+        for resolution_name, (rows, cols) in resolutions.items():
+            name = '%s_%s' % (image_name, resolution_name)
+            img = make_image(rows, cols, np.random.default_rng(seed))
+            results['benchmarks'][name] = bench_image(img, repeats)
+            print_result(name, results['benchmarks'][name])
+
+    return results
+
+
+def print_result(name: str, result: dict):
+    stages = ', '.join('%s %.3f' % item for item in result['seconds'].items())
+    print('%-16s %6d moves %8d steps | %s' % (name, result['counts']['moves'],
+                                              result['counts']['step_iterations'], stages))
+    return
+
+
+def compare(results: dict, baseline: dict, threshold: float = 1.1) -> list:
+    """
+    Compares stage times against an earlier run
+    :param results: results from run()
+    :param baseline: results from an earlier run()
+    :param threshold: ratio of new to old time above which a stage counts as slower
+    :return: list of (benchmark, stage, old s, new s) that got slower
+    """
+    slower = []
+    for name, result in results['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if old is None:
+            continue
+        for stage, new_time in result['seconds'].items():
+            old_time = old['seconds'].get(stage)
+            if old_time is None or old_time <= 0:
+                continue
+            ratio = new_time / old_time
+            print('%-16s %-16s %8.4f -> %8.4f s  x%.2f' % (name, stage, old_time, new_time, ratio))
+            if ratio > threshold:
+                slower.append((name, stage, old_time, new_time))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of image processing, planning and simulation')
+    parser.add_argument('--quick', action='store_true', help='small and medium resolutions, one repeat')
+    parser.add_argument('--out', default='bench_results.json', help='file to save results to')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    if args.quick:
+        resolutions = {name: RESOLUTIONS[name] for name in ('small', 'medium')}
+        results = run(resolutions, repeats=1)
+    else:
+        results = run()
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Saved results to %s' % args.out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f))
+        if slower:
+            print('%d stages got more than 10%% slower.' % len(slower))
+            sys.exit(1)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# centerline.py
+#
+# Finds the centerlines of strokes in a binary image, so a line drawing
+# can be frosted with one pass down the middle of each stroke instead
+# of tracing both of its outlines.
+#
+# The image is thinned to a one pixel wide skeleton with the Zhang-Suen
+# algorithm (vectorized over the whole image each pass), then the
+# skeleton is traced as a graph: endpoints and junctions are nodes and
+# the pixel chains between them are edges. Short spurs left by
+# thinning are pruned, and at each junction the edges that continue
+# most nearly straight through it are joined, so strokes that cross
+# come out as two long polylines rather than four short ones.
+#
+# Polylines are returned in the same (n, 1, 2) int32 [x, y] format as
+# cv2.findContours, but are open.
+#
+# NECESSARY FOR USE:
+# numpy
+# opencv-python
+
+import cv2
+import numpy as np
+
+# Neighbour offsets (row, col) in Zhang-Suen order P2..P9, clockwise from north
+NEIGHBOURS = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+
+
+def _neighbours(img: np.ndarray) -> list:
+    """The 8 neighbour images P2..P9 of a 0/1 image, zero outside it"""
+    padded = np.pad(img, 1)
+    rows, cols = img.shape
+    return [padded[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols] for dr, dc in NEIGHBOURS]
+
+
+def skeletonize(binary: np.ndarray) -> np.ndarray:
+    """
+    Thins the white shapes of a binary image to one pixel wide lines (Zhang-Suen)
+    :param binary: image, nonzero for strokes
+    :return: uint8 image, 1 on the skeleton and 0 elsewhere
+    """
+    img = (np.asarray(binary) > 0).astype(np.uint8)
+
+    changed = True
+    while changed:
+        changed = False
+        for first_pass in (True, False):
+            p2, p3, p4, p5, p6, p7, p8, p9 = _neighbours(img)
+            count = p2 + p3 + p4 + p5 + p6 + p7 + p8 + p9
+            ring = (p2, p3, p4, p5, p6, p7, p8, p9, p2)
+            transitions = sum((ring[k] == 0) & (ring[k + 1] == 1) for k in range(8))
+            if first_pass:
+                side = (p2 * p4 * p6 == 0) & (p4 * p6 * p8 == 0)
+            else:
+                side = (p2 * p4 * p8 == 0) & (p2 * p6 * p8 == 0)
+            remove = (img == 1) & (count >= 2) & (count <= 6) & (transitions == 1) & side
+            if remove.any():
+                img[remove] = 0
+                changed = True
+    return img
+
+
+def _walk(skeleton: np.ndarray, node_id: np.ndarray, visited: np.ndarray, start: tuple, first: tuple) -> list:
+    """
+    Follows a chain of skeleton pixels from start through first until it reaches
+    a node or runs out
+    :return: list of (row, col) pixels from start to the end of the chain
+    """
+    rows, cols = skeleton.shape
+    path = [start, first]
+    prev, here = start, first
+    while node_id[here] < 0:
+        visited[here] = True
+        step = None
+        for dr, dc in NEIGHBOURS:
+            r, c = here[0] + dr, here[1] + dc
+            if 0 <= r < rows and 0 <= c < cols and skeleton[r, c] and (r, c) != prev \
+                    and (r, c) not in path[-3:] and (node_id[r, c] >= 0 or not visited[r, c]):
+                step = (r, c)
+                if node_id[r, c] >= 0:
+                    break
+        if step is None:
+            break
+        prev, here = here, step
+        path.append(here)
+    return path
+
+
+def _direction(path: list, reach: int = 5) -> np.ndarray:
+    """Unit [row, col] direction leaving the start of a pixel path"""
+    d = np.subtract(path[min(reach, len(path) - 1)], path[0]).astype(float)
+    norm = np.hypot(*d)
+    return d / norm if norm > 0 else d
+
+
+def trace_skeleton(skeleton: np.ndarray, min_spur: int = 3, max_turn: float = 60) -> list:
+    """
+    Traces a skeleton into polylines, joining edges that run straight through junctions
+    :param skeleton: one pixel wide skeleton from skeletonize()
+    :param min_spur: branches ending in nothing shorter than this many pixels are pruned
+    :param max_turn: degrees two edges may turn at a junction and still be joined
+    :return: list of (n, 1, 2) int32 [x, y] polylines
+    """
+    skeleton = (np.asarray(skeleton) > 0).astype(np.uint8)
+    count = sum(_neighbours(skeleton)) * skeleton
+
+    # Nodes: endpoints, and junctions with touching junction pixels merged
+    junction = ((count >= 3) & (skeleton == 1)).astype(np.uint8)
+    num_junctions, junction_labels = cv2.connectedComponents(junction, connectivity=8)
+    node_id = np.where(junction > 0, junction_labels - 1, -1)
+    endpoints = np.argwhere((count <= 1) & (skeleton == 1))
+    for k, (r, c) in enumerate(endpoints):
+        node_id[r, c] = num_junctions - 1 + k
+
+    # Edges: chains of pixels between nodes
+    visited = np.zeros(skeleton.shape, dtype=bool)
+    edges = []
+    seen_links = set()
+    for r, c in np.argwhere(node_id >= 0):
+        for dr, dc in NEIGHBOURS:
+            nr, nc = r + dr, c + dc
+            if not (0 <= nr < skeleton.shape[0] and 0 <= nc < skeleton.shape[1]) or not skeleton[nr, nc]:
+                continue
+            if node_id[nr, nc] >= 0:
+                # Two nodes touching: one short edge, unless it is inside one junction
+                link = tuple(sorted(((r, c), (nr, nc))))
+                if node_id[nr, nc] != node_id[r, c] and link not in seen_links:
+                    seen_links.add(link)
+                    edges.append([(r, c), (nr, nc)])
+            elif not visited[nr, nc]:
+                edges.append(_walk(skeleton, node_id, visited, (r, c), (nr, nc)))
+
+    # Loops with no nodes, like the letter O
+    for r, c in np.argwhere((skeleton == 1) & ~visited & (node_id < 0)):
+        if visited[r, c]:
+            continue
+        visited[r, c] = True
+        for dr, dc in NEIGHBOURS:
+            nr, nc = r + dr, c + dc
+            if 0 <= nr < skeleton.shape[0] and 0 <= nc < skeleton.shape[1] and skeleton[nr, nc]:
+                loop = _walk(skeleton, node_id, visited, (r, c), (nr, nc))
+                edges.append(loop + [(r, c)])
+                break
+
+    def end_node(point):
+        return node_id[point] if node_id[point] >= 0 else -1
+
+    # Prune short spurs hanging off junctions
+    is_endpoint = np.zeros(num_junctions - 1 + len(endpoints), dtype=bool)
+    is_endpoint[num_junctions - 1:] = True
+    kept = []
+    for path in edges:
+        ends = (end_node(path[0]), end_node(path[-1]))
+        spur = len(path) < min_spur and any(n >= 0 and is_endpoint[n] for n in ends) \
+            and any(n >= 0 and not is_endpoint[n] for n in ends)
+        if not spur:
+            kept.append(path)
+    edges = kept
+
+    # Join pairs of edges that continue straight through each junction
+    at_node = {}
+    for e, path in enumerate(edges):
+        for end, point in ((0, path[0]), (1, path[-1])):
+            node = end_node(point)
+            if node >= 0 and not is_endpoint[node]:
+                at_node.setdefault(node, []).append((e, end))
+
+    link = {}
+    min_straightness = -np.cos(np.radians(max_turn))
+    for ends in at_node.values():
+        directions = {}
+        for e, end in ends:
+            path = edges[e] if end == 0 else edges[e][::-1]
+            directions[(e, end)] = _direction(path)
+        pairs = sorted((np.dot(directions[a], directions[b]), a, b)
+                       for i, a in enumerate(ends) for b in ends[i + 1:] if a[0] != b[0])
+        for straightness, a, b in pairs:
+            # Opposite directions are straight through: dot product near -1
+            if straightness > min_straightness:
+                break
+            if a not in link and b not in link:
+                link[a] = b
+                link[b] = a
+
+    # Chain linked edges into polylines
+    used = [False] * len(edges)
+    polylines = []
+
+    def chain(e, end):
+        """Pixels from the given end of edge e onward through linked edges"""
+        points = []
+        while not used[e]:
+            used[e] = True
+            path = edges[e] if end == 0 else edges[e][::-1]
+            points.extend(path if not points else path[1:])
+            other = (e, 1 - end)
+            if other not in link:
+                break
+            e, end = link[other]
+        return points
+
+    # Start from unlinked ends first, so open chains are traced whole
+    for e in range(len(edges)):
+        for end in (0, 1):
+            if not used[e] and (e, end) not in link:
+                polylines.append(chain(e, end))
+    for e in range(len(edges)):
+        if not used[e]:
+            polylines.append(chain(e, 0))
+
+    return [np.array(line, dtype=np.int32)[:, ::-1].reshape(-1, 1, 2) for line in polylines if len(line) > 1]
+
+
+def centerlines(binary: np.ndarray, min_spur: int = 3) -> list:
+    """
+    Centerline polylines of the strokes in a binary image
+    :param binary: image, nonzero for strokes
+    :param min_spur: branches shorter than this many pixels are pruned
+    :return: list of (n, 1, 2) int32 [x, y] polylines
+    """
+    return trace_skeleton(skeletonize(binary), min_spur)
@@ -0,0 +1,124 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# extrusion.py
+#
+# Schedules the extruder throttle from the planned toolpath speed
+# instead of holding a constant throttle for each move. Frosting is
+# pushed out in proportion to how fast the nozzle is moving, so lines
+# keep the same width as the steppers speed up along straight runs and
+# slow down for corners.
+#
+# Like pressure advance on a 3D printer, the throttle follows the
+# demand lead_time seconds ahead, so the pump starts before a line
+# starts and eases off before a corner. At the end of each line the
+# motor runs backwards briefly to pull the frosting back, and primes
+# forwards again at the start of the next line.
+#
+# Throttles are worked out for a whole step schedule at once and
+# written into its e column, so the executor just drives them.
+#
+# NECESSARY FOR USE:
+# numpy
+
+import numpy as np
+
+
+class ExtrusionController:
+    def __init__(self, x_steps_per_mm: float, y_steps_per_mm: float, reference_speed: float = 20,
+                 min_ratio: float = 0.3, max_ratio: float = 2, lead_time: float = 0.1,
+                 retract_time: float = 0.15, retract_throttle: float = 0.5, resolution: float = 0.05,
+                 window: int = 8):
+        """
+        Constructs an extrusion controller
+        :param x_steps_per_mm: steps per mm on the x axis
+        :param y_steps_per_mm: steps per mm on the y axis
+        :param reference_speed: mm/s at which a command's e value is the right throttle.
+                                This is the speed the extrude modifiers were tuned at
+        :param min_ratio: lowest fraction of e to drive while drawing, so slow corners
+                          don't drop the pressure entirely
+        :param max_ratio: highest multiple of e to drive on fast runs
+        :param lead_time: seconds ahead of the nozzle that the throttle follows
+        :param retract_time: seconds to run backwards at the end of a line, and
+                             forwards at full throttle at the start of the next
+        :param retract_throttle: throttle to retract with
+        :param resolution: throttles are rounded to this, so the extruder board
+                           isn't sent a new throttle on every step
+        :param window: step iterations either side of each step to average speed over
+        """
+        self.x_steps_per_mm = x_steps_per_mm
+        self.y_steps_per_mm = y_steps_per_mm
+        self.reference_speed = reference_speed
+        self.min_ratio = min_ratio
+        self.max_ratio = max_ratio
+        self.lead_time = lead_time
+        self.retract_time = retract_time
+        self.retract_throttle = retract_throttle
+        self.resolution = resolution
+        self.window = window
+
+    def speeds(self, schedule: np.ndarray) -> np.ndarray:
+        """
+        Nozzle speed at each step of a schedule, averaged over nearby steps
+        :param schedule: step schedule from MotionPlanner.plan
+        :return: speed in mm/s for each step
+        """
+        t = schedule['t']
+        distance = np.hypot(schedule['x'] / self.x_steps_per_mm, schedule['y'] / self.y_steps_per_mm)
+        s = np.cumsum(distance)
+
+        i = np.arange(len(t))
+        lo = np.maximum(i - self.window, 0)
+        hi = np.minimum(i + self.window, len(t) - 1)
+        dt = t[hi] - t[lo]
+        speed = np.zeros(len(t))
+        np.divide(s[hi] - s[lo], dt, out=speed, where=dt > 0)
+        return speed
+
+    def throttles(self, schedule: np.ndarray) -> np.ndarray:
+        """
+        Extruder throttle to drive at each step of a schedule
+        :param schedule: step schedule from MotionPlanner.plan, with the
+                         commanded extruder values in e
+        :return: throttle for each step
+        """
+        t = schedule['t']
+        e = schedule['e'].astype(float)
+        if len(t) == 0:
+            return e
+
+        ratio = np.clip(self.speeds(schedule) / self.reference_speed, self.min_ratio, self.max_ratio)
+        demand = np.where(e > 0, e * ratio, 0)
+
+        # Follow the demand lead_time ahead of the nozzle
+        ahead = np.minimum(np.searchsorted(t, t + self.lead_time), len(t) - 1)
+        throttle = demand[ahead]
+
+        # Retract after each line ends and prime before the next one starts
+        drawing = throttle > 0
+        changes = np.flatnonzero(drawing[1:] != drawing[:-1]) + 1
+        stops = changes[~drawing[changes]]
+        starts = changes[drawing[changes]]
+        starts = starts[starts > stops[0]] if len(stops) else starts[:0]
+
+        throttle[self._within(t, stops) & ~drawing] = -self.retract_throttle
+        throttle[self._within(t, starts) & drawing] = 1
+
+        return np.round(throttle / self.resolution) * self.resolution
+
+    def _within(self, t: np.ndarray, events: np.ndarray) -> np.ndarray:
+        """True for each time less than retract_time after the latest of events at or before it"""
+        last = np.full(len(t), -np.inf)
+        last[events] = t[events]
+        last = np.maximum.accumulate(last)
+        return t - last < self.retract_time
+
+    def apply(self, schedule: np.ndarray) -> np.ndarray:
+        """
+        Replaces the commanded extruder values of a schedule with scheduled throttles
+        :param schedule: step schedule from MotionPlanner.plan
+        :return: copy of schedule with throttles in e
+        """
+        scheduled = schedule.copy()
+        scheduled['e'] = self.throttles(schedule)
+        return scheduled
@@ -0,0 +1,173 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# fake_airtable.py
+#
+# A local stand-in for the Airtable API, so the unload and image
+# flow can be run offline. Serves GET /v0/<base>/<table> with sorting,
+# PATCH /v0/<base>/<table>/<record id>, and image files under /files/.
+# It can also answer with 429s to exercise rate limit handling.
+#
+# Example:
+#     server = FakeAirtable()
+#     server.start()
+#     poller = AirtablePoller(api_key='test', api_url=server.api_url)
+#     ...
+#     server.set_field('control', 'frosting position set', 'Select', 'complete')
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, quote
+import itertools
+import json
+import os
+import threading
+
+
+def default_tables() -> dict:
+    """Control table laid out like the real base: unload status is the 5th record by name."""
+    names = ['cake loaded', 'cake unloaded', 'conveyor', 'frosting', 'frosting position set']
+    control = [{'id': 'rec%d' % i, 'fields': {'Name': name, 'Select': 'waiting'}}
+               for i, name in enumerate(names)]
+    return {'control': control, 'image': []}
+
+
+class FakeAirtable:
+    def __init__(self, tables: dict = None, port: int = 0):
+        """
+        Constructs a fake Airtable server
+        :param tables: {table name: [record, ...]} where each record is
+                       {'id': ..., 'fields': {...}}. Defaults to default_tables()
+        :param port: port to listen on, 0 picks a free one
+        """
+        self.tables = default_tables() if tables is None else tables
+        self.files = {}
+        self.requests = 0
+        self.rate_limit_every = 0   # answer every nth request with a 429, 0 never
+        self.lock = threading.Lock()
+        self._ids = itertools.count(100)
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake._handle(self, 'GET')
+
+            def do_PATCH(self):
+                fake._handle(self, 'PATCH')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    @property
+    def api_url(self) -> str:
+        return self.url + '/v0'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        return
+
+    def set_field(self, table: str, name: str, field: str, value):
+        """
+        Sets a field of the record with the given Name
+        :param table: table name
+        :param name: value of the record's Name field
+        :param field: field to set
+        :param value: new value
+        :return: None
+        """
+        with self.lock:
+            for record in self.tables[table]:
+                if record['fields'].get('Name') == name:
+                    record['fields'][field] = value
+        return
+
+    def add_image(self, path: str, created: str = None) -> str:
+        """
+        Adds an image record whose attachment is served by this server
+        :param path: image file to serve
+        :param created: value of the Created field, sorts after existing records if None
+        :return: url of the served image
+        """
+        name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            self.files[name] = f.read()
+        url = self.url + '/files/' + quote(name)
+
+        with self.lock:
+            records = self.tables.setdefault('image', [])
+            if created is None:
+                created = '%06d' % len(records)
+            records.append({'id': 'rec%d' % next(self._ids),
+                            'fields': {'Created': created,
+                                       'Image': [{'id': 'att%d' % next(self._ids), 'url': url, 'filename': name}]}})
+        return url
+
+    def _handle(self, handler: BaseHTTPRequestHandler, method: str):
+        url = urlparse(handler.path)
+        parts = [part for part in url.path.split('/') if part]
+
+        # Attachments come from a file server, which isn't rate limited
+        if method == 'GET' and len(parts) == 2 and parts[0] == 'files' and parts[1] in self.files:
+            handler.send_response(200)
+            handler.send_header('Content-Length', str(len(self.files[parts[1]])))
+            handler.end_headers()
+            handler.wfile.write(self.files[parts[1]])
+            return
+
+        with self.lock:
+            self.requests += 1
+            limited = self.rate_limit_every and self.requests % self.rate_limit_every == 0
+
+        if limited:
+            self._reply(handler, 429, {'error': {'type': 'RATE_LIMIT_REACHED'}}, {'Retry-After': '0.05'})
+            return
+
+        if len(parts) < 3 or parts[0] != 'v0' or parts[2] not in self.tables:
+            self._reply(handler, 404, {'error': 'NOT_FOUND'})
+            return
+        table = parts[2]
+
+        if method == 'GET':
+            query = parse_qs(url.query)
+            with self.lock:
+                records = [dict(record, fields=dict(record['fields'])) for record in self.tables[table]]
+            sort_field = query.get('sort[0][field]')
+            if sort_field:
+                records.sort(key=lambda record: str(record['fields'].get(sort_field[0], '')))
+            self._reply(handler, 200, {'records': records})
+        elif method == 'PATCH' and len(parts) == 4:
+            length = int(handler.headers.get('Content-Length', 0))
+            fields = json.loads(handler.rfile.read(length) or b'{}').get('fields', {})
+            with self.lock:
+                for record in self.tables[table]:
+                    if record['id'] == parts[3]:
+                        record['fields'].update(fields)
+                        self._reply(handler, 200, record)
+                        return
+            self._reply(handler, 404, {'error': 'NOT_FOUND'})
+        else:
+            self._reply(handler, 404, {'error': 'NOT_FOUND'})
+
+    @staticmethod
+    def _reply(handler: BaseHTTPRequestHandler, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(data)
@@ -6,6 +6,13 @@
 # This object controls the whole robot and contains the methods
 # and properties required for use.
 #
+# The board keeps the carriage position in whole steps from home, and
+# every move goes to the nearest step to its target, so rounding never
+# builds up over a drawing. Each extruder has its own coordinate frame,
+# offset from the carriage by where its nozzle is, so commands for
+# either extruder are given in drawing coordinates and switching
+# extruders doesn't need homing again.
+#
 # NECESSARY FOR USE:
 # numpy
 # GPIO
@@ -18,43 +25,65 @@
 # https://docs.circuitpython.org/projects/motor/en/latest/index.html
 
 from frosting_motors import FrostingStepper, FrostingDCMotor
-from adafruit_motorkit import MotorKit
-import RPi.GPIO as GPIO
+from step_planner import plan_steps, position_steps
+from motion_planner import MotionPlanner
+from homing import home_axes
+from step_executor import StepExecutor
+from extrusion import ExtrusionController
+from metrics import REGISTRY
+from toolpath_fit import expand
+from frosting_hal import HardwareBackend, AdafruitBackend
 import numpy as np
-import time
 
 
 class FrostingMainBoard:
-    def __init__(self):
+    def __init__(self, backend: HardwareBackend = None):
+        """
+        Constructs the frosting board
+        :param backend: hardware backend from frosting_hal. Defaults to the
+                        real Adafruit boards and GPIO. Pass a SimulatedBackend
+                        to run without hardware
+        """
         # Parameters
         x_steps_per_mm = 10
         y_steps_per_mm = 10
 
         white_extrude_modifier = 0.75
         black_extrude_modifier = 0.80
+        white_extruder_offset = (0, 0)     # mm from the carriage to each nozzle's drawing origin
+        black_extruder_offset = (20, 0)
 
         self.default_speed = 20
+        self.homing_fast_speed = 40     # mm/s seeking the endstops
+        self.homing_slow_speed = 4      # mm/s re-approaching them
+        max_speed = 30          # mm/s cruise speed while drawing
+        acceleration = 150      # mm/s^2
+        junction_deviation = 0.05
         self.x_endstop = 23  # GPIO23
         self.y_endstop = 24  # GPIO24
 
         # Spatial planning
-        self.x_position = 0
-        self.y_position = 0
-        self.location = np.array([self.x_position, self.y_position])
+        self.steps = np.zeros(2, dtype=np.int64)    # carriage position in steps from home
+        self.target = np.zeros(2)                   # commanded carriage position in mm
+        self.homing_times = {}
+        self.executor_stats = {}
+
+        # Motion planning
+        self.motion_planner = MotionPlanner(x_steps_per_mm, y_steps_per_mm, max_speed,
+                                            acceleration, junction_deviation)
+        self.extrusion = ExtrusionController(x_steps_per_mm, y_steps_per_mm, self.default_speed)
 
         # Motor driver boards
-        try:
-            self.stepper_kit = MotorKit()               # default board
-        except Exception as e:
-            print("Some problem initializing stepper board. Error:")
-            print(e)
-            return
-        try:
-            self.extruder_kit = MotorKit(address=0x61)  # Bridge jumper A0 on extruder board
-        except Exception as e:
-            print("Some problem initializing extruder board. Error:")
-            print(e)
-            return
+        if backend is None:
+            try:
+                backend = AdafruitBackend()
+            except Exception as e:
+                print("Some problem initializing motor boards. Error:")
+                print(e)
+                return
+        self.backend = backend
+        self.stepper_kit = backend.stepper_kit
+        self.extruder_kit = backend.extruder_kit
 
         # Steppers
         self.x_axis = FrostingStepper(self.stepper_kit, 1, x_steps_per_mm)
@@ -64,10 +93,58 @@ class FrostingMainBoard:
         self.white_extruder = FrostingDCMotor(self.extruder_kit, 1, white_extrude_modifier)
         self.black_extruder = FrostingDCMotor(self.extruder_kit, 2, black_extrude_modifier)
 
+        # Tool frames
+        self.tool_offsets = {self.white_extruder: np.array(white_extruder_offset, dtype=float),
+                             self.black_extruder: np.array(black_extruder_offset, dtype=float)}
+        self.tool = self.white_extruder
+
         # Endstops
-        GPIO.setmode(GPIO.BCM)  # Use GPIO pin numbering
-        GPIO.setup(self.x_endstop, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-        GPIO.setup(self.y_endstop, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+        self.backend.setup_endstop(self.x_endstop)
+        self.backend.setup_endstop(self.y_endstop)
+
+    def endstop_triggered(self, pin: int) -> bool:
+        """
+        Reads an endstop
+        :param pin: GPIO pin of the endstop
+        :return: True if the endstop is pressed
+        """
+        return self.backend.read_endstop(pin)
+
+    def home_axes(self, axis_names: list, timeout: int = 30, backoff_mm: int = 2) -> bool:
+        """
+        Homes the named axes at the same time, seeking fast then re-approaching slowly.
+        Time spent in each homing phase is kept in self.homing_times
+        :param axis_names: axes to home, any of 'x' and 'y'
+        :param timeout: default number of seconds before timing out with no home
+        :param backoff_mm: number of mm to back off
+        :return: True if every axis homed, False otherwise
+        """
+        axes = {'x': (self.x_axis, self.x_endstop), 'y': (self.y_axis, self.y_endstop)}
+        steppers = [axes[name][0] for name in axis_names]
+        endstops = [axes[name][1] for name in axis_names]
+
+        homed, self.homing_times = home_axes(steppers, endstops, self.endstop_triggered,
+                                             self.homing_fast_speed, self.homing_slow_speed,
+                                             backoff_mm, timeout=timeout,
+                                             clock=self.backend.clock, sleep=self.backend.sleep)
+
+        for name, stepper, ok in zip(axis_names, steppers, homed):
+            if ok:
+                axis = 'xy'.index(name)
+                self.steps[axis] = 0
+                self.target[axis] = 0
+            else:
+                print('%s home timed out.' % name.upper())
+                stepper.disable()
+
+        if REGISTRY.enabled:
+            for phase, seconds in self.homing_times.items():
+                REGISTRY.histogram('frosting_homing_seconds', 'Time spent in each homing phase',
+                                   phase=phase).observe(seconds)
+
+        print('Homing took %.2f s (%s)' % (sum(self.homing_times.values()),
+              ', '.join('%s %.2f s' % phase for phase in self.homing_times.items())))
+        return all(homed)
 
     def home_x_axis(self, timeout: int = 30, backoff_mm: int = 2) -> bool:
         """
@@ -76,21 +153,7 @@ class FrostingMainBoard:
         :param timeout: default number of seconds before timing out with no home
         :return: True if homed, False otherwise
         """
-        # move x axis to limit switch
-        timer = time.time()
-        while not GPIO.input(self.x_endstop) == GPIO.HIGH:
-            if time.time()-timer > timeout:
-                print('X home timed out.')
-                self.x_axis.disable()
-                return False
-
-            self.x_axis.step(-1)
-            time.sleep(1/(self.default_speed * self.x_axis.steps_per_mm))
-
-        time.sleep(1)  # wait for a bit
-        self.x_axis.move(backoff_mm, self.default_speed)
-        self.x_position = 0
-        return True
+        return self.home_axes(['x'], timeout, backoff_mm)
 
     def home_y_axis(self, timeout: int = 30, backoff_mm: int = 2) -> bool:
         """
@@ -99,115 +162,114 @@ class FrostingMainBoard:
         :param timeout: default number of seconds before timing out with no home
         :return: True if homed, False otherwise
         """
-        # move y axis to limit switch
-        timer = time.time()
-        while not GPIO.input(self.y_endstop) == GPIO.HIGH:
-            if time.time() - timer > timeout:
-                print('Y home timed out.')
-                self.y_axis.disable()
-                return False
-
-            self.y_axis.step(-1)
-            time.sleep(1 / (self.default_speed * self.y_axis.steps_per_mm))
-
-        time.sleep(1)  # wait for a bit
-        self.y_axis.move(backoff_mm, self.default_speed)
-        self.y_position = 0
-        return True
+        return self.home_axes(['y'], timeout, backoff_mm)
 
     def home_all(self) -> bool:
         """
-        Homes both x and y axes. Returns true if homed successfully
+        Homes both x and y axes at the same time. Returns true if homed successfully
         :return: True if homed, False if an axis fails
         """
         print('Homing all axes...')
-        if self.home_x_axis():
-            if self.home_y_axis():
-                return True
-            else:
-                return False
-        else:
-            return False
+        return self.home_axes(['x', 'y'])
+
+    @property
+    def location(self) -> np.ndarray:
+        """Commanded [x, y] position in mm, in the frame of the current tool"""
+        return self.target - self.tool_offsets[self.tool]
+
+    def select_tool(self, extruder: FrostingDCMotor):
+        """
+        Switches to an extruder's coordinate frame. Nothing moves: the next
+        move goes to its target in the new frame.
+        :param extruder: extruder whose frame commands are given in from now on
+        :return: None
+        """
+        self.tool = extruder
+        return
+
+    def steps_at(self, position: np.ndarray) -> np.ndarray:
+        """
+        Nearest whole steps to a carriage position
+        :param position: [x, y] carriage position in mm from home
+        :return: [x, y] int64 steps from home
+        """
+        return np.array([position_steps(position[0], self.x_axis.steps_per_mm),
+                         position_steps(position[1], self.y_axis.steps_per_mm)])
+
+    def move_to(self, target: np.ndarray):
+        """
+        Moves the carriage in a straight line to a commanded position
+        :param target: [x, y] carriage position in mm from home
+        :return: None
+        """
+        self.target = np.array(target, dtype=float)
+        steps = self.steps_at(self.target)
+
+        # Interlace x and y steps along the line
+        plan = plan_steps(*(steps - self.steps))
+        for step_x, step_y in plan.tolist():
+            if step_x:
+                self.x_axis.step(step_x)
+            if step_y:
+                self.y_axis.step(step_y)
+
+        self.steps = steps
+        return
 
     def x_y_move(self, dx: float, dy: float):
         """
         Moves x and y stepper motors linearly a
         distance dx and dy respectively, at speed
         speed, which is total speed over the distance
-        d = sqrt(dx^2 + dy^2)
+        d = sqrt(dx^2 + dy^2). Parts of a step left over
+        are carried on to the next move.
         :param dy: distance to move in y (can be negative)
         :param dx: distance to move in x (can be negative)
         :return: None
         """
-        if dx > 0:
-            dir_x = 1
-        elif dx < 0:
-            dir_x = -1
-        else:
-            dir_x = 0
-
-        if dy > 0:
-            dir_y = 1
-        elif dy < 0:
-            dir_y = -1
-        else:
-            dir_y = 0
-
-        # Calculate number of steps needed to go in x and y
-        steps_x = int(abs(dx) * self.x_axis.steps_per_mm)
-        steps_y = int(abs(dy) * self.y_axis.steps_per_mm)
-
-        # Within the loop iteration, interlace x and y steps using lcm of step counts
-        if steps_x > 0 and steps_y > 0:
-            iter_lcm = np.lcm(steps_x, steps_y)
-            x_mod = iter_lcm // steps_x
-            y_mod = iter_lcm // steps_y
-        elif steps_x == 0:
-            iter_lcm = steps_y
-            x_mod = 0.1  # will never trigger
-            y_mod = 1
-        elif steps_y == 0:
-            iter_lcm = steps_x
-            x_mod = 1
-            y_mod = 0.1  # will never trigger
-        else:
-            iter_lcm = 0
-            x_mod = 1
-            y_mod = 1
-
-        # loop through lcm
-        for j in np.arange(1, iter_lcm + 1, 1):
-            step_x = j % x_mod == 0
-            step_y = j % y_mod == 0
-            if step_x and step_y:
-                self.x_axis.step(dir_x)
-                self.y_axis.step(dir_y)
-            elif step_x:
-                self.x_axis.step(dir_x)
-            elif step_y:
-                self.y_axis.step(dir_y)
-            else:
-                pass
-
+        self.move_to(self.target + (dx, dy))
         return
 
     def go_and_extrude(self, command: np.ndarray, extruder: FrostingDCMotor):
         """
-        Goes to a location [x,y] using the x_y_move function.
+        Goes to a location [x,y] in the extruder's frame.
         Extrudes with motor throttle e.
-        Updates board's location after moving
         :param command: [x,y,e] coordinates to move to and extrude
         :param extruder: which extruder to extrude with
         :return: None
         """
         x, y, e = command
-        go_to = np.array(([x, y]))
-        dx, dy = go_to - self.location
+        self.select_tool(extruder)
+
+        with REGISTRY.timed('frosting_go_and_extrude_seconds', 'Time per go_and_extrude move'):
+            extruder.drive(e)
+            self.move_to(self.tool_offsets[extruder] + (x, y))
+        return
 
-        extruder.drive(e)
-        self.x_y_move(dx, dy)
+    def executor(self, extruder: FrostingDCMotor) -> StepExecutor:
+        """
+        Makes a step executor for this board's axes, timed by the backend clock
+        :param extruder: extruder object the executor drives
+        :return: StepExecutor, not yet started
+        """
+        return StepExecutor(self.x_axis, self.y_axis, extruder, self.backend.clock, self.backend.sleep,
+                            realtime=getattr(self.backend, 'realtime', True))
 
-        self.location = go_to
+    def record_draw_metrics(self, planned_time: float, elapsed: float):
+        """
+        Records a drawing's timing and executor stats in the metrics registry
+        :param planned_time: seconds the schedule was planned to take
+        :param elapsed: seconds the drawing actually took
+        :return: None
+        """
+        steps = self.executor_stats['steps']
+        REGISTRY.histogram('frosting_draw_seconds', 'Time per drawing').observe(elapsed)
+        REGISTRY.gauge('frosting_planned_step_rate', 'Step iterations per second planned for the last drawing').set(
+            steps / planned_time if planned_time > 0 else 0)
+        REGISTRY.gauge('frosting_achieved_step_rate', 'Step iterations per second achieved in the last drawing').set(
+            steps / elapsed if elapsed > 0 else 0)
+        for name, value in self.executor_stats.items():
+            REGISTRY.gauge('frosting_executor_' + name, 'Step executor ' + name.replace('_', ' ')).set(value)
         return
 
     def draw(self, commands: np.ndarray, extruder: FrostingDCMotor):
@@ -217,14 +279,89 @@ class FrostingMainBoard:
              [x2, y2, e2],
              ...
              [xn, yn, en]]
-        Using the go_to_location function.
+        The whole array is planned ahead with the motion planner, so the
+        steppers accelerate along straight runs and slow for corners.
         :param commands: Coordinates and extruder values
          of format [[x1, y1, e1], ...[xn, yn, en]]
         :param extruder: extruder object to drive
         :return: None
         """
-        moves = len(commands)
-        for i in range(moves):
-            self.go_and_extrude(commands[i, :], extruder)
-        extruder.stop()
+        self.draw_stream((commands,), extruder)
+        return
+
+    def fitted_commands(self, fitted: np.ndarray, extruder: FrostingDCMotor, start: np.ndarray = None) -> np.ndarray:
+        """
+        The commands draw_fitted() draws for a fitted toolpath, with each arc
+        split into chords within half a step of the circle
+        :param fitted: fitted toolpath from toolpath_fit.fit_arcs
+        :param extruder: extruder object the toolpath is drawn with
+        :param start: [x, y] in the extruder's frame the toolpath is drawn from,
+                      defaults to where the carriage is now
+        :return: [[x1, y1, e1], ...[xn, yn, en]] coordinates in the extruder's frame
+        """
+        if start is None:
+            start = self.target - self.tool_offsets[extruder]
+        max_error = 0.5 / max(self.x_axis.steps_per_mm, self.y_axis.steps_per_mm)
+        return expand(fitted, max_error, start)
+
+    def draw_fitted(self, fitted: np.ndarray, extruder: FrostingDCMotor):
+        """
+        Draws a fitted toolpath from toolpath_fit, with rows [x, y, e, g, i, j].
+        Each arc is split into chords within half a step of the circle and planned
+        with the rest of the toolpath, so curves run as one continuous step stream
+        instead of stopping at every short move.
+        :param fitted: fitted toolpath from toolpath_fit.fit_arcs
+        :param extruder: extruder object to drive
+        :return: None
+        """
+        self.draw(self.fitted_commands(fitted, extruder), extruder)
+        return
+
+    def draw_stream(self, chunks, extruder: FrostingDCMotor):
+        """
+        Draws command arrays as they arrive from an iterable, such as
+        img_processing.stream(). The extruder throttle follows the planned
+        speed (see extrusion.py). Commands are in the extruder's frame.
+        Chunks are planned on this thread and
+        queued for the executor thread, so the next chunk is planned while
+        the steppers are still drawing the last one. Executor metrics end
+        up in self.executor_stats.
+        :param chunks: iterable of command arrays of format [[x1, y1, e1], ...[xn, yn, en]]
+        :param extruder: extruder object to drive
+        :return: None
+        """
+        self.select_tool(extruder)
+        offset = self.tool_offsets[extruder]
+        executor = self.executor(extruder)
+        executor.start()
+        t_offset = 0
+        start = self.backend.clock()
+        try:
+            for commands in chunks:
+                commands = np.asarray(commands)
+                if len(commands) == 0:
+                    continue
+                commands = np.array(commands, dtype=float)
+                commands[:, 0:2] += offset
+                with REGISTRY.timed('frosting_plan_seconds', 'Time to plan each chunk of a drawing'):
+                    schedule = self.motion_planner.plan(commands, self.target)
+                    schedule = self.extrusion.apply(schedule)
+                if len(schedule):
+                    # Each chunk starts and ends at rest, so its steps follow on from the last chunk
+                    schedule['t'] += t_offset
+                    t_offset = schedule['t'][-1]
+                    executor.put(schedule)
+                self.target = commands[-1, 0:2].copy()
+                self.steps = self.steps_at(self.target)
+            executor.close()
+            executor.join()
+        except BaseException:
+            # Stop the motors now, rather than after every step still queued
+            executor.abort()
+            raise
+        finally:
+            self.executor_stats = executor.stats()
+            if REGISTRY.enabled:
+                self.record_draw_metrics(t_offset, self.backend.clock() - start)
+            extruder.stop()
         return
@@ -0,0 +1,187 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# frosting_hal.py
+#
+# Hardware backends for the frosting board. A backend provides the two
+# motor driver boards (kits with stepper1, stepper2 and motor1..4 like
+# an Adafruit MotorKit), the endstops, and the clock used for timing.
+#
+# AdafruitBackend drives the real MotorKits and GPIO pins on the Pi.
+# SimulatedBackend records every step and throttle change, triggers
+# endstops at configured positions and runs on a virtual clock, so the
+# same draw/home_all code runs headless at full speed on any machine.
+#
+# NECESSARY FOR USE (AdafruitBackend only):
+# sudo apt-get install python-rpi.gpio python3-rpi.gpio
+# sudo pip3 install adafruit-circuitpython-motorkit
+# sudo pip3 install adafruit-circuitpython-motor
+
+import time
+
+try:
+    from adafruit_motor import stepper
+except ImportError:
+    class stepper:
+        """Stand-in for adafruit_motor.stepper constants when it isn't installed."""
+        FORWARD = 1
+        BACKWARD = 2
+        SINGLE = 1
+        DOUBLE = 2
+        INTERLEAVE = 3
+        MICROSTEP = 4
+
+
+class HardwareBackend:
+    """
+    Interface for hardware backends.
+    stepper_kit and extruder_kit must have stepper1, stepper2 and motor1..4
+    like an Adafruit MotorKit.
+    """
+    stepper_kit = None
+    extruder_kit = None
+
+    def setup_endstop(self, pin: int):
+        raise NotImplementedError
+
+    def read_endstop(self, pin: int) -> bool:
+        raise NotImplementedError
+
+    def clock(self) -> float:
+        """Seconds from an arbitrary start, for timing steps"""
+        return time.perf_counter()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+        return
+
+
+class AdafruitBackend(HardwareBackend):
+    def __init__(self, stepper_address: int = 0x60, extruder_address: int = 0x61):
+        """
+        Constructs the real hardware backend
+        :param stepper_address: I2C address of the stepper board (default board)
+        :param extruder_address: I2C address of the extruder board (bridge jumper A0)
+        """
+        from adafruit_motorkit import MotorKit
+        import RPi.GPIO as GPIO
+
+        self.GPIO = GPIO
+        self.stepper_kit = MotorKit(address=stepper_address)
+        self.extruder_kit = MotorKit(address=extruder_address)
+        GPIO.setmode(GPIO.BCM)  # Use GPIO pin numbering
+
+    def setup_endstop(self, pin: int):
+        self.GPIO.setup(pin, self.GPIO.IN, pull_up_down=self.GPIO.PUD_DOWN)
+        return
+
+    def read_endstop(self, pin: int) -> bool:
+        return self.GPIO.input(pin) == self.GPIO.HIGH
+
+
+class SimulatedStepper:
+    def __init__(self, backend, position: int = 0):
+        """
+        Constructs a simulated stepper, standing in for an adafruit_motor StepperMotor
+        :param backend: SimulatedBackend whose clock the stepper uses
+        :param position: starting position in steps
+        """
+        self.backend = backend
+        self.position = position
+        self.steps = 0
+        self.released = False
+
+    def onestep(self, direction: int = stepper.FORWARD, style: int = stepper.SINGLE) -> int:
+        self.position += 1 if direction == stepper.FORWARD else -1
+        self.steps += 1
+        self.released = False
+        self.backend.advance(self.backend.step_time)
+        return self.position
+
+    def release(self):
+        self.released = True
+        return
+
+
+class SimulatedDCMotor:
+    def __init__(self, backend):
+        """
+        Constructs a simulated DC motor, standing in for an adafruit_motor DCMotor
+        :param backend: SimulatedBackend whose clock the motor uses
+        """
+        self.backend = backend
+        self._throttle = None
+        self.throttle_log = []  # (time, throttle) for every change
+
+    @property
+    def throttle(self) -> float:
+        return self._throttle
+
+    @throttle.setter
+    def throttle(self, value: float):
+        self._throttle = value
+        self.throttle_log.append((self.backend.clock(), value))
+        self.backend.advance(self.backend.throttle_time)
+
+
+class SimulatedKit:
+    def __init__(self, backend, stepper_positions: tuple = (0, 0)):
+        """
+        Constructs a simulated motor driver board with 2 steppers and 4 DC motors
+        :param backend: SimulatedBackend the board belongs to
+        :param stepper_positions: starting positions of stepper1 and stepper2 in steps
+        """
+        self.stepper1 = SimulatedStepper(backend, stepper_positions[0])
+        self.stepper2 = SimulatedStepper(backend, stepper_positions[1])
+        self.motor1 = SimulatedDCMotor(backend)
+        self.motor2 = SimulatedDCMotor(backend)
+        self.motor3 = SimulatedDCMotor(backend)
+        self.motor4 = SimulatedDCMotor(backend)
+
+
+class SimulatedBackend(HardwareBackend):
+    def __init__(self, start_steps: tuple = (300, 300), endstops: dict = None, realtime: bool = False,
+                 step_time: float = 0, throttle_time: float = 0):
+        """
+        Constructs a simulated hardware backend
+        :param start_steps: starting positions of the x and y steppers in steps
+        :param endstops: {pin: (stepper name, position)}, the endstop on pin is pressed
+                         while that stepper is at or below position. Defaults to the
+                         board's x and y endstops at position 0
+        :param realtime: sleep for real instead of advancing a virtual clock
+        :param step_time: seconds each step takes, to model I2C latency
+        :param throttle_time: seconds each throttle change takes
+        """
+        self.realtime = realtime
+        self.step_time = step_time
+        self.throttle_time = throttle_time
+        self.time = 0.0
+
+        self.stepper_kit = SimulatedKit(self, start_steps)
+        self.extruder_kit = SimulatedKit(self)
+        self.endstops = {23: ('stepper1', 0), 24: ('stepper2', 0)} if endstops is None else endstops
+        self.pins = set()
+
+    def setup_endstop(self, pin: int):
+        self.pins.add(pin)
+        return
+
+    def read_endstop(self, pin: int) -> bool:
+        name, position = self.endstops[pin]
+        return getattr(self.stepper_kit, name).position <= position
+
+    def clock(self) -> float:
+        return time.perf_counter() if self.realtime else self.time
+
+    def advance(self, seconds: float):
+        """Moves the virtual clock on, for time taken by simulated hardware"""
+        if seconds > 0:
+            self.sleep(seconds)
+        return
+
+    def sleep(self, seconds: float):
+        if self.realtime:
+            time.sleep(seconds)
+        else:
+            self.time += max(seconds, 0)
+        return
@@ -17,20 +17,98 @@
 # https://docs.circuitpython.org/projects/motor/en/latest/index.html
 
 from frosting_board import FrostingMainBoard
-from img_processing import run as run_img_processing
-from img_processing import waitForUnload, write_done
+from img_processing import connectAirtable, waitForUnload, write_done
+from job_scheduler import JobScheduler
+from job_planner import JobPlanner, report
+from job_estimator import JobEstimator
+from toolpath_fit import fit_arcs
 from e_stop import main as emergency_stop
-import pandas as pd
+from metrics import REGISTRY
 import numpy as np
+import os
 
-# Offset for black extruder
-black_extruder_offset = 20
+ESTIMATOR_FILE = 'estimator.json'
+
+
+def frost(main_board: FrostingMainBoard, white_drawing: np.ndarray, black_drawing: np.ndarray,
+          estimator: JobEstimator = None):
+    """
+    Frosts one cake: the white background, then the black image, as one plan
+    from job_planner with a single homing and return to the corner
+    :param main_board: the robot
+    :param white_drawing: background coordinates
+    :param black_drawing: image coordinates
+    :param estimator: job estimator to predict the time with and record each phase's
+                      measured time in, or None
+    :return: None
+    """
+    extruders = {'white': main_board.white_extruder, 'black': main_board.black_extruder}
+    planner = JobPlanner(main_board.motion_planner, main_board.tool_offsets[extruders['white']],
+                         main_board.tool_offsets[extruders['black']])
+    phases = planner.plan(white_drawing, black_drawing)
+    print(report(phases, planner.separate_seconds(white_drawing, black_drawing)))
+
+    # The black image is drawn as arcs, fitted from where the white layer ends
+    black = next(phase for phase in phases if phase['name'] == 'black')
+    white = next(phase for phase in phases if phase['name'] == 'white')
+    carriage = np.zeros(2)
+    if len(white['commands']):
+        carriage = white['commands'][-1, 0:2] + main_board.tool_offsets[extruders['white']]
+    black_start = carriage - main_board.tool_offsets[extruders['black']]
+    fitted = fit_arcs(black['commands'], start=black_start)
+    print('Fitted %d moves as %d arcs and lines.' % (len(black['commands']), len(fitted)))
+
+    if estimator is not None:
+        # Estimated from the moves the board actually makes
+        drawn = [dict(phase, commands=main_board.fitted_commands(fitted, extruders['black'], black_start))
+                 if phase is black else phase for phase in phases]
+        candidates = dict(estimator.plan_candidates(drawn))
+        print('Estimated %.1f s with the calibrated write costs.'
+              % sum(estimator.predict(terms) for terms in candidates.values()))
+
+    print('Starting frosting!')
+    for phase in phases:
+        start = main_board.backend.clock()
+        if phase['name'] == 'home':
+            print('Homing all...')
+            main_board.home_all()
+        elif phase['name'] == 'black':
+            # The board keeps its position in steps and the black drawing is
+            # offset to the black nozzle, so there's no need to home again
+            print('Switching to black...')
+            main_board.select_tool(extruders['black'])
+            print('Drawing black image...')
+            main_board.draw_fitted(fitted, extruders['black'])
+        else:
+            print('Drawing %s...' % phase['name'])
+            main_board.draw(phase['commands'], extruders[phase['tool']])
+        if estimator is not None:
+            estimator.record(candidates[phase['name']], main_board.backend.clock() - start)
+
+    # Turn everything off
+    main_board.x_axis.disable()
+    main_board.y_axis.disable()
+    main_board.white_extruder.coast()
+    main_board.black_extruder.coast()
+    return
 
 
 def main():
+    scheduler = None
     try:
         main_board = FrostingMainBoard()
 
+        # Calibrated against every cake frosted so far
+        estimator = JobEstimator(main_board.motion_planner, main_board.extrusion, offsets={
+            'white': main_board.tool_offsets[main_board.white_extruder],
+            'black': main_board.tool_offsets[main_board.black_extruder]})
+        if os.path.exists(ESTIMATOR_FILE):
+            estimator.load(ESTIMATOR_FILE)
+
+        # Orders are prepared in a worker process while earlier cakes are frosted
+        scheduler = JobScheduler(connectAirtable())
+        scheduler.poll()
+
         print('Started frosting main script... would you like to wait for unload?')
         if input('y/n: ') == 'y':
             print("Waiting for unload...")
@@ -40,42 +118,41 @@ def main():
         else:
             print('Beginning frosting process.')
 
-        print("Getting image...")
-        # Get the image files
-        run_img_processing()
-
-        # Convert them to our drawings
-        white_drawing = pd.read_csv('bgd_coordinates.csv').values[:, 0:3]
-        black_drawing = pd.read_csv('img_coordinates.csv').values[:, 0:3]
-
-        # Draw the white image
-        print('Starting frosting!')
-        print('Homing all...')
-        main_board.home_all()
-        print('Drawing white background...')
-        main_board.draw(white_drawing, main_board.white_extruder)
-
-        # Draw the black image
-        print('Homing all...')
-        main_board.home_all()
-        print("Switching to black...")
-        main_board.x_y_move(black_extruder_offset, 0)
-        main_board.location = np.array((0, 0))
-        print('Drawing black image...')
-        main_board.draw(black_drawing, main_board.black_extruder)
-
-        # Turn everything off
-        main_board.x_axis.disable()
-        main_board.y_axis.disable()
-        main_board.white_extruder.coast()
-        main_board.black_extruder.coast()
-        write_done()
-
-        print('Done!')
+        while True:
+            print("Waiting for the next order...")
+            job = scheduler.next_job()
+            REGISTRY.reset()
+
+            try:
+                frost(main_board, job.bgd, job.img, estimator)
+            except Exception as e:
+                scheduler.finish(job, e)
+                raise
+            write_done()
+            scheduler.finish(job)
+            print('Estimator calibrated to %.1f s RMS: %s' % (estimator.calibrate(), estimator.describe()))
+            estimator.save(ESTIMATOR_FILE)
+
+            print('Done!')
+            print(scheduler.summary())
+            if REGISTRY.enabled:
+                print(REGISTRY.report())
+                REGISTRY.write('metrics.json')
+                REGISTRY.write('metrics.prom')
+
+            # Pick up new orders so they prepare during the unload
+            scheduler.poll()
+            print("Waiting for unload...")
+            # The status still says 'complete' from the last unload, so wait for it to change
+            waitForUnload(next_unload=True)
 
     except KeyboardInterrupt:
         emergency_stop()
 
+    finally:
+        if scheduler is not None:
+            scheduler.close()
+
     return
 
 
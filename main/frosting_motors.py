@@ -13,16 +13,17 @@
 # https://docs.circuitpython.org/projects/motor/en/latest/index.html
 
 
-from adafruit_motorkit import MotorKit
-from adafruit_motor import stepper
+from frosting_hal import stepper
+from metrics import REGISTRY
 import time
 
 
 class FrostingStepper:
-    def __init__(self, kit: MotorKit, motor_number: int, steps_per_mm: float):
+    def __init__(self, kit: 'MotorKit', motor_number: int, steps_per_mm: float):
         """
         Constructs a frosting stepper
-        :param kit: Adafruit MotorKit object. This is the board from which the steppers are controlled
+        :param kit: Adafruit MotorKit object, or a simulated one from frosting_hal.
+                    This is the board from which the steppers are controlled
         :param motor_number: Stepper number 1 or 2
         :param steps_per_mm: Number of mm traveled per step on the stepper
         """
@@ -39,6 +40,11 @@ class FrostingStepper:
             print('Defaulting to stepper #1 as stepper number not recognized.')
             self.stepper_object = self.kit.stepper1
 
+        # Metrics
+        self.step_count = REGISTRY.counter('frosting_steps_total', 'Steps taken', stepper=str(motor_number))
+        self.step_seconds = REGISTRY.histogram('frosting_onestep_seconds', 'Time to write one step to the stepper board',
+                                               stepper=str(motor_number))
+
     def step(self, dir: int):
         """
         Steps the motor one step, in either 1 (positive) or -1 (negative) direction
@@ -53,7 +59,13 @@ class FrostingStepper:
             print('Stepper not moving either direction')
             return
 
-        self.stepper_object.onestep(direction=direction, style=stepper.INTERLEAVE)
+        if REGISTRY.enabled:
+            start = time.perf_counter()
+            self.stepper_object.onestep(direction=direction, style=stepper.INTERLEAVE)
+            self.step_seconds.observe(time.perf_counter() - start)
+            self.step_count.inc()
+        else:
+            self.stepper_object.onestep(direction=direction, style=stepper.INTERLEAVE)
         return
 
     def move(self, dist: float, speed: float):
@@ -85,10 +97,11 @@ class FrostingStepper:
 
 
 class FrostingDCMotor:
-    def __init__(self, kit: MotorKit, motor_number: int, extrude_modifier: float = 1):
+    def __init__(self, kit: 'MotorKit', motor_number: int, extrude_modifier: float = 1):
         """
         Constructs a frosting dc motor
-        :param kit: Adafruit MotorKit object. This is the board from which the steppers are controlled
+        :param kit: Adafruit MotorKit object, or a simulated one from frosting_hal.
+                    This is the board from which the steppers are controlled
         :param motor_number: DC motor number 1, 2, 3 or 4.
         :param extrude_modifier: Modifies any drive() command by this value.
                                  Ex: drive(1 * extrude_modifier)
@@ -110,6 +123,11 @@ class FrostingDCMotor:
             print('Defaulting to motor #1 as motor number not recognized.')
             self.motor_object = self.kit.motor1
 
+        # Metrics
+        self.throttle_seconds = REGISTRY.histogram('frosting_throttle_write_seconds',
+                                                   'Time to write a throttle to the extruder board',
+                                                   motor=str(motor_number))
+
     def drive(self, dc: float):
         """
         Drive the motor at duty cycle dc. Negative values make the motor go backwards.
@@ -126,11 +144,20 @@ class FrostingDCMotor:
             self.stop()
             return
 
-        self.motor_object.throttle = drive_value
+        self._set_throttle(drive_value)
+        return
+
+    def _set_throttle(self, value: float):
+        if REGISTRY.enabled:
+            start = time.perf_counter()
+            self.motor_object.throttle = value
+            self.throttle_seconds.observe(time.perf_counter() - start)
+        else:
+            self.motor_object.throttle = value
         return
 
     def stop(self):
-        self.motor_object.throttle = 0
+        self._set_throttle(0)
         return
 
     def coast(self):
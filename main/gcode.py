@@ -0,0 +1,296 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# gcode.py
+#
+# Reads and writes standard G-code, so jobs can be prepared in other
+# CAM tools and replayed on FrostingMainBoard.draw or in the simulator,
+# and our toolpaths can be checked in any G-code viewer.
+#
+# Exported files are absolute, in mm:
+#     G0 X Y              travel (e = 0)
+#     G1 X Y S            frosting move, S is the extruder throttle
+#     G2/G3 X Y I J S     clockwise/counterclockwise arc from toolpath_fit,
+#                         I J the center relative to the start of the arc
+#     T0 / T1             white / black extruder
+# F feedrates are in mm/min. S is only written when the throttle
+# changes, like a laser cutter's power.
+#
+# The reader keeps the usual modal state (motion mode, G90/G91, G20/G21,
+# G92 offsets, feedrate, throttle and tool) and reads line by line into
+# a fixed size buffer, so any size of file is read in chunks of at most
+# chunk_size moves. Files written for 3D printers work too: a G1 that
+# increases E is a frosting move. Anything else, like Z moves, is
+# skipped.
+#
+# Arcs read back as chords are up to max_error (MAX_ERROR by default)
+# inside the circle, on top of the tolerance the arcs were fitted to,
+# so a replayed toolpath can be tolerance + max_error from the original
+# moves. To stay within a bound, fit with the difference:
+#     save_gcode('job.gcode', [('black', fit_arcs(commands, tolerance=0.5 - MAX_ERROR))])
+#
+# Example, replaying a job:
+#     for tool, commands in read_gcode('job.gcode'):
+#         board.draw(commands, board.black_extruder if tool == 'black' else board.white_extruder)
+#
+# NECESSARY FOR USE:
+# numpy
+
+from toolpath_fit import LINE, CW, CCW, expand
+import numpy as np
+import re
+
+TOOLS = ('white', 'black')      # T0 and T1
+MM_PER_INCH = 25.4
+MAX_ERROR = 0.05                # mm chords of arcs read back may be inside the arc
+
+_WORD = re.compile(r'([A-Z])([-+]?(?:\d+\.?\d*|\.\d+))')
+_COMMENT = re.compile(r'\([^)]*\)')
+
+
+def _number(value: float, decimals: int) -> str:
+    """Shortest fixed point text for a value, e.g. 12.5 rather than 12.500"""
+    text = '%.*f' % (decimals, value)
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    return '0' if text == '-0' else text
+
+
+def format_gcode(commands: np.ndarray, tool: str = None, feedrate: float = 1800,
+                 travel_feedrate: float = 3000, decimals: int = 3):
+    """
+    Generates G-code lines for a command array or a fitted toolpath
+    :param commands: [[x1, y1, e1], ...] commands, or (n, 6) [x, y, e, g, i, j]
+                     rows from toolpath_fit.fit_arcs. Reading arcs back adds up to the
+                     reader's max_error to the tolerance they were fitted to
+    :param tool: 'white' or 'black' to select the extruder first, or None
+    :param feedrate: mm/min for frosting moves
+    :param travel_feedrate: mm/min for travel moves
+    :param decimals: decimal places of coordinates
+    :return: generator of lines, each ending in a newline
+    """
+    commands = np.asarray(commands, dtype=float)
+    if tool is not None:
+        yield 'T%d\n' % TOOLS.index(tool)
+
+    fitted = commands.ndim == 2 and commands.shape[1] == 6
+    feed = throttle = None
+    for row in commands.tolist():
+        x, y, e = row[0:3]
+        g = int(row[3]) if fitted else LINE
+        words = []
+        if g == LINE and e == 0:
+            words.append('G0')
+            move_feed = travel_feedrate
+        else:
+            words.append('G1' if g == LINE else 'G2' if g == CW else 'G3')
+            move_feed = feedrate
+        words += ['X' + _number(x, decimals), 'Y' + _number(y, decimals)]
+        if g != LINE:
+            words += ['I' + _number(row[4], decimals), 'J' + _number(row[5], decimals)]
+        if words[0] != 'G0' and e != throttle:
+            words.append('S' + _number(e, 3))
+            throttle = e
+        if move_feed != feed:
+            words.append('F' + _number(move_feed, 0))
+            feed = move_feed
+        yield ' '.join(words) + '\n'
+
+
+def save_gcode(filename: str, layers: list, feedrate: float = 1800, travel_feedrate: float = 3000,
+               decimals: int = 3) -> int:
+    """
+    Writes layers of commands to a G-code file
+    :param filename: file to write
+    :param layers: list of (tool, commands), e.g. [('white', bgd), ('black', fitted)].
+                   Commands may be [x, y, e] arrays or fitted toolpaths
+    :param feedrate: mm/min for frosting moves
+    :param travel_feedrate: mm/min for travel moves
+    :param decimals: decimal places of coordinates
+    :return: number of moves written
+    """
+    moves = 0
+    with open(filename, 'w') as f:
+        f.write('; Frosting robot job\nG21 ; mm\nG90 ; absolute\n')
+        for tool, commands in layers:
+            f.writelines(format_gcode(commands, tool, feedrate, travel_feedrate, decimals))
+            moves += len(commands)
+        f.write('M2\n')
+    return moves
+
+
+def _arc_center(start: np.ndarray, end: np.ndarray, radius: float, g: int) -> np.ndarray:
+    """Center of an R form arc, relative to its start. Negative R takes the long way round"""
+    chord = end - start
+    half = np.hypot(*chord) / 2
+    if half == 0:
+        raise ValueError('R form arc with the same start and end')
+    height = np.sqrt(max(radius * radius - half * half, 0))
+    # Center is to the left of the chord for a short CCW arc
+    left = np.array((-chord[1], chord[0])) / (2 * half)
+    side = 1 if (g == CCW) == (radius > 0) else -1
+    return chord / 2 + side * height * left
+
+
+def iter_gcode(lines, chunk_size: int = 4096, fitted: bool = False, max_error: float = MAX_ERROR):
+    """
+    Reads G-code into command arrays, a chunk at a time
+    :param lines: iterable of G-code lines, e.g. an open file
+    :param chunk_size: most moves per chunk
+    :param fitted: yield (n, 6) [x, y, e, g, i, j] rows with arcs kept as arcs, for
+                   FrostingMainBoard.draw_fitted. Otherwise arcs are split into chords
+                   and chunks are [x, y, e] commands for draw() and the simulator
+    :param max_error: mm chords of arcs may be inside the arc. This adds to the tolerance
+                      the arcs were fitted to, see the notes at the top
+    :return: generator of (tool, chunk). A new chunk starts at every tool change.
+             tool is 'white' or 'black', or None before any T word
+    """
+    buffer = np.empty((chunk_size, 6))
+    count = 0
+    position = np.zeros(2)          # in mm, with G92 offsets applied
+    chunk_start = position.copy()
+    offset = np.zeros(2)            # G92: file coordinate = machine position - offset
+    motion = 0
+    absolute = True
+    scale = 1.0
+    throttle = None
+    extruder_position = 0.0
+    relative_extruder = False
+    tool = None
+
+    def flush():
+        chunk = buffer[:count].copy()
+        if not fitted:
+            chunk = expand(chunk, max_error, chunk_start)
+        return tool, chunk
+
+    for line in lines:
+        line = line.split(';', 1)[0].upper()
+        if '(' in line:
+            line = _COMMENT.sub('', line)
+        words = {}
+        codes = []
+        for letter, value in _WORD.findall(line.replace(' ', '')):
+            if letter in 'GM':
+                codes.append((letter, float(value)))
+            else:
+                words[letter] = float(value)
+
+        move = None
+        for letter, code in codes:
+            if letter == 'M':
+                if code == 5:
+                    throttle = 0.0
+                elif code == 82:
+                    relative_extruder = False
+                elif code == 83:
+                    relative_extruder = True
+            elif code in (0, 1, 2, 3):
+                motion = int(code)
+                move = motion
+            elif code == 20:
+                scale = MM_PER_INCH
+            elif code == 21:
+                scale = 1.0
+            elif code == 90:
+                absolute = True
+            elif code == 91:
+                absolute = False
+            elif code == 92:
+                for axis, name in enumerate('XY'):
+                    if name in words:
+                        offset[axis] = position[axis] - words[name] * scale
+                if 'E' in words:
+                    extruder_position = words['E']
+                words = {}
+            elif code == 28:
+                # Home: treat as a travel back to the origin
+                words = {'X': 0.0, 'Y': 0.0}
+                move = 0
+                offset[:] = 0
+
+        if 'T' in words:
+            new_tool = int(words['T'])
+            new_tool = TOOLS[new_tool] if new_tool < len(TOOLS) else new_tool
+            if new_tool != tool:
+                if count:
+                    yield flush()
+                    count = 0
+                chunk_start = position.copy()
+                tool = new_tool
+        if 'S' in words:
+            throttle = words['S']
+
+        if 'X' not in words and 'Y' not in words:
+            continue
+        if move is None:
+            move = motion
+
+        target = position.copy()
+        for axis, letter in enumerate('XY'):
+            if letter in words:
+                value = words[letter] * scale
+                target[axis] = value + offset[axis] if absolute else target[axis] + value
+
+        # Extruder value of the move
+        extruded = None
+        if 'E' in words:
+            extruded = words['E'] if relative_extruder else words['E'] - extruder_position
+            extruder_position += extruded
+        if move == 0:
+            e = 0.0
+        elif extruded is not None:
+            e = (throttle or 1.0) if extruded > 0 else 0.0
+        else:
+            e = 1.0 if throttle is None else throttle
+
+        row = buffer[count]
+        row[0:2] = target
+        row[2] = e
+        if move in (2, 3):
+            g = CW if move == 2 else CCW
+            if 'R' in words:
+                row[4:6] = _arc_center(position, target, words['R'] * scale, g)
+            else:
+                row[4] = words.get('I', 0.0) * scale
+                row[5] = words.get('J', 0.0) * scale
+            row[3] = g
+        else:
+            row[3] = LINE
+            row[4:6] = 0
+        position = target
+        count += 1
+
+        if count == chunk_size:
+            yield flush()
+            count = 0
+            chunk_start = position.copy()
+
+    if count:
+        yield flush()
+
+
+def read_gcode(filename: str, chunk_size: int = 4096, fitted: bool = False, max_error: float = MAX_ERROR):
+    """
+    Reads a G-code file in chunks, see iter_gcode
+    :return: generator of (tool, chunk)
+    """
+    with open(filename) as f:
+        yield from iter_gcode(f, chunk_size, fitted, max_error)
+
+
+def load_gcode(filename: str, fitted: bool = False, max_error: float = MAX_ERROR) -> list:
+    """
+    Reads a whole G-code file
+    :param filename: file to read
+    :param fitted: keep arcs as arcs, see iter_gcode
+    :param max_error: mm chords of arcs may be inside the arc
+    :return: list of (tool, commands), one for each run of moves with the same tool
+    """
+    layers = []
+    for tool, chunk in read_gcode(filename, fitted=fitted, max_error=max_error):
+        if layers and layers[-1][0] == tool:
+            layers[-1][1].append(chunk)
+        else:
+            layers.append((tool, [chunk]))
+    return [(tool, np.concatenate(chunks)) for tool, chunks in layers]
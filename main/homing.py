@@ -0,0 +1,112 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# homing.py
+#
+# Homes any number of axes at the same time. Each axis seeks its
+# endstop fast, backs off, re-approaches slowly so the trigger point
+# is repeatable, then backs off to its zero position. Steps for all
+# axes are interleaved in one loop on their own timers, so the axes
+# share the stepper board without threads fighting over I2C.
+#
+# Axes only need step(dir) and steps_per_mm, and endstops, the clock
+# and sleeping all go through functions, so homing runs the same
+# against real switches or simulated ones.
+
+import time
+
+PHASES = ('fast_seek', 'backoff', 'slow_seek', 'final_backoff')
+
+
+def _run_axes(axes: list, endstops: list, read_endstop, direction: int, speed: float,
+              max_mm: float, stop_on: bool = None, timeout: float = None,
+              clock=time.perf_counter, sleep=time.sleep) -> list:
+    """
+    Steps every axis in direction at speed until each has moved max_mm, or
+    until its endstop reads stop_on if stop_on is not None.
+    :return: list of True for each axis that stopped on its endstop
+    """
+    now = clock()
+    delays = [1 / (speed * axis.steps_per_mm) for axis in axes]
+    steps_left = [int(max_mm * axis.steps_per_mm) for axis in axes]
+    next_step = [now] * len(axes)
+    triggered = [False] * len(axes)
+    active = set(range(len(axes)))
+    deadline = None if timeout is None else now + timeout
+
+    while active:
+        now = clock()
+        if deadline is not None and now > deadline:
+            break
+
+        for i in sorted(active):
+            if now < next_step[i]:
+                continue
+            if stop_on is not None and bool(read_endstop(endstops[i])) == stop_on:
+                triggered[i] = True
+                active.discard(i)
+                continue
+            if steps_left[i] <= 0:
+                active.discard(i)
+                continue
+
+            axes[i].step(direction)
+            steps_left[i] -= 1
+            next_step[i] += delays[i]
+
+        if active:
+            wait = min(next_step[i] for i in active) - clock()
+            if wait > 0:
+                sleep(wait)
+
+    return triggered
+
+
+def home_axes(axes: list, endstops: list, read_endstop, fast_speed: float = 40, slow_speed: float = 4,
+              backoff_mm: float = 2, max_travel_mm: float = 250, timeout: float = 30,
+              clock=time.perf_counter, sleep=time.sleep) -> tuple:
+    """
+    Homes axes together in two phases: fast seek then slow re-approach.
+    Endstops are at the negative end of each axis.
+    :param axes: steppers to home, each with step(dir) and steps_per_mm
+    :param endstops: endstop identifier for each axis, passed to read_endstop
+    :param read_endstop: function returning True when the given endstop is triggered
+    :param fast_speed: mm/s to seek the endstops
+    :param slow_speed: mm/s to re-approach the endstops
+    :param backoff_mm: mm to back off after each approach. Also the final zero position
+    :param max_travel_mm: most an axis can travel before reaching its endstop
+    :param timeout: seconds before giving up on the fast seek
+    :param clock: function returning the time in seconds
+    :param sleep: function sleeping for a number of seconds
+    :return: (homed, timings) where homed is a list of True for each axis that
+             homed and timings is the seconds spent in each phase
+    """
+    timings = {}
+
+    start = clock()
+    homed = _run_axes(axes, endstops, read_endstop, -1, fast_speed, max_travel_mm, True, timeout,
+                     clock, sleep)
+    timings['fast_seek'] = clock() - start
+
+    # Back off until clear of the switch, then creep back onto it
+    found = [i for i in range(len(axes)) if homed[i]]
+    axes_found = [axes[i] for i in found]
+    endstops_found = [endstops[i] for i in found]
+
+    start = clock()
+    _run_axes(axes_found, endstops_found, read_endstop, 1, fast_speed, backoff_mm, clock=clock, sleep=sleep)
+    timings['backoff'] = clock() - start
+
+    start = clock()
+    retriggered = _run_axes(axes_found, endstops_found, read_endstop, -1, slow_speed, 2 * backoff_mm, True,
+                            clock=clock, sleep=sleep)
+    timings['slow_seek'] = clock() - start
+    for i, ok in zip(found, retriggered):
+        homed[i] = ok
+
+    start = clock()
+    _run_axes([axes[i] for i in found if homed[i]], [endstops[i] for i in found if homed[i]],
+              read_endstop, 1, slow_speed * 2, backoff_mm, clock=clock, sleep=sleep)
+    timings['final_backoff'] = clock() - start
+
+    return homed, timings
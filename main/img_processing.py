@@ -20,56 +20,122 @@
 #####################################################################
 import numpy as np
 import cv2
-import requests
+import os
 import urllib.request
+import asyncio
+import time
+import queue
+import threading
 from airtable import Airtable
+from airtable_client import AirtablePoller
+from toolpath_cache import content_hash
+from motion_planner import MotionPlanner
+from centerline import centerlines
+from gcode import save_gcode
 
-def __getFromAirtable(table_name, query):
-    base_id = 'appuhn9X6CJyPGaho'
-    api_key = open('api_key.txt').read()
-    headers = {"Authorization": "Bearer " + api_key}
+NOZZLE_WIDTH_MM = 3         # width of a frosting bead
+SIMPLIFY_TOLERANCE = 0.25   # max contour deviation as a fraction of nozzle width
+BGD_LINE_SPACING = 0.9      # background row spacing as a fraction of nozzle width
+BGD_MARGIN_MM = 3           # unfrosted border around the edge of the pan
+COAST_MM = 5                # length at the end of each outline drawn without extruding
+MODES = ('outline', 'centerline')
+
+_airtable = None
+_debug_images = None   # (queue, writer thread) while debug images are enabled
+
+
+def connectAirtable(**kwargs):
+    """
+    Set up the Airtable poller shared by every Airtable request.
+
+    Called with no arguments on first use. Pass api_url to use a local
+        stand-in server, see fake_airtable.py.
 
-    url = "https://api.airtable.com/v0/" + base_id + "/" + table_name + "?" + query
+    Parameters
+    ----------
+    **kwargs
+        Arguments for airtable_client.AirtablePoller.
 
-    return requests.get(url, params=(), headers=headers).json()
+    Returns
+    -------
+    AirtablePoller
+        The shared poller.
+    """
+    global _airtable
+    if _airtable is not None:
+        _airtable.close()
+    _airtable = AirtablePoller(**kwargs)
 
-def waitForUnload():
-    """Wait until unloading process has completed."""
-    ctrl_table = 'control'
-    query = "sort%5B0%5D%5Bfield%5D=Name"
+    return _airtable
 
-    rcd_to_get = 4 # when sorting by name, 'frosting position set' is 5th record
-    in_position = False
 
-    while not in_position:
-        response = __getFromAirtable(ctrl_table, query)
-        unload = response['records'][rcd_to_get]['fields']['Select']
-        if unload == 'complete':
-            in_position = True
+def __getAirtable():
+    """Shared Airtable poller, connecting on first use."""
+    return _airtable if _airtable is not None else connectAirtable()
 
 
-def __imgFromAirtable():
+def waitForUnload(next_unload=False):
+    """
+    Wait until unloading process has completed.
+
+    Parameters
+    ----------
+    next_unload : bool
+        Wait for an unload that hasn't finished yet, rather than
+        returning on the status left by the last one.
+    """
+    asyncio.run(__getAirtable().wait_for_unload(next_unload))
+
+
+def __imgFromAirtable(cache=None):
     """
     Get last image submitted to Airtable form.
 
     Requires existence of text file containing the API key of a user
     with Airtable base edit access.
 
+    Parameters
+    ----------
+    cache : ToolpathCache
+        Cache to skip the download if this image was seen before, or
+        None to always download.
+
     Returns
     -------
-    np.ndarray
-        Array of image submitted in grayscale.
+    tuple
+        Hash of the image file, and a function returning the image
+        array in grayscale. The image is only downloaded or decoded
+        when that is called.
     """
-    img_table = 'image'
-    query = "sort%5B0%5D%5Bfield%5D=Created"
+    return __imgFromAttachment(__getAirtable().latest_image(), cache)
+
+
+def __imgFromAttachment(attachment, cache=None):
+    """Hash of an Airtable image attachment and a function loading it, see __imgFromAirtable."""
+    img_hash = None if cache is None else cache.image_hash(attachment['id'])
+    if img_hash is not None:
+        def load():
+            img = cache.get_image(img_hash)
+            return img if img is not None else __downloadImg(attachment, cache)[1]
+
+        return (img_hash, load)
+
+    img_hash, img = __downloadImg(attachment, cache)
+    return (img_hash, lambda: img)
 
-    response = __getFromAirtable(img_table, query)
 
-    rcd_len = len(response["records"])
-    image_url = response["records"][rcd_len - 1]["fields"]["Image"][0]["url"]
-    img_file, _ = urllib.request.urlretrieve(image_url)
+def __downloadImg(attachment, cache):
+    """Download and decode an Airtable image attachment, caching it if there is a cache."""
+    with urllib.request.urlopen(attachment['url']) as response:
+        data = response.read()
+    img_hash = content_hash(data)
+    img = cv2.imdecode(np.frombuffer(data, dtype='uint8'), cv2.IMREAD_GRAYSCALE)
 
-    return cv2.imread(img_file, cv2.IMREAD_GRAYSCALE)
+    if cache is not None:
+        cache.remember_attachment(attachment['id'], img_hash)
+        cache.put_image(img_hash, img)
+
+    return (img_hash, img)
 
 
 def __rowsToAdd(pix_col, pix_row):
@@ -104,31 +170,22 @@ def __colsToAdd(pix_row, pix_col):
     return (add_lft, add_rgt)
 
 
-def __addRows(add_top, add_btm, img):
-    """Add calculated number of blank rows to top and bottom of image."""
-    pix_col = np.shape(img)[1]
-
-    top_shape = (add_top, pix_col)
-    top = np.full(top_shape, 0)
-    btm_shape = (add_btm, pix_col)
-    btm = np.full(btm_shape, 0)
-
-    return np.concatenate((top, img, btm))
-
-
-def __addCols(add_lft, add_rgt, img):
-    """Add calculated number of blank columns to left and right of image."""
-    pix_row = np.shape(img)[0]
-
-    lft_shape = (pix_row, add_lft)
-    lft = np.full(lft_shape, 0)
-    rgt_shape = (pix_row, add_rgt)
-    rgt = np.full(rgt_shape, 0)
+def __panPadding(rows, cols):
+    """Blank (top, bottom, left, right) pixels giving an image the pan ratio."""
+    pan_ratio = 7.5 / 6
+    img_ratio = rows / cols
 
-    return np.concatenate((lft, img, rgt), axis=1)
+    if img_ratio < pan_ratio:
+        add_top, add_btm = __rowsToAdd(cols, rows)
+        return (add_top, add_btm, 0, 0)
+    elif img_ratio > pan_ratio:
+        add_lft, add_rgt = __colsToAdd(rows, cols)
+        return (0, 0, add_lft, add_rgt)
+    else:
+        return (0, 0, 0, 0)
 
 
-def __changeImgRatio(img):
+def __changeImgRatio(img, value=0):
     """
     Change ratio of image sides to ratio of pan dimensions.
     
@@ -140,177 +197,575 @@ def __changeImgRatio(img):
     ----------
     img : np.ndarray
         Array of pixels holding image to transform.
+    value : int
+        Pixel value of the blank rows or columns.
     
     Returns
     -------
     np.ndarray
         Array of pixels with correct overall dimensions and original
-        image centered.
+        image centered, with the same dtype as img.
     """
-    rows = np.shape(img)[0]
-    cols = np.shape(img)[1]
-    
-    pan_ratio = 7.5 / 6
-    img_ratio = rows / cols
-
-    if img_ratio < pan_ratio:
-        add_top, add_btm = __rowsToAdd(cols, rows)
-        return __addRows(add_top, add_btm, img)
-    elif img_ratio > pan_ratio:
-        add_lft, add_rgt = __colsToAdd(rows, cols)
-        return __addCols(add_lft, add_rgt, img)
-    else:
-        return img
+    top, btm, lft, rgt = __panPadding(img.shape[0], img.shape[1])
+    return cv2.copyMakeBorder(img, top, btm, lft, rgt, cv2.BORDER_CONSTANT, value=value)
 
 
-def __getToDimensions(img):
-    """Resizes image so 1 pixel translates to a 1 mm square."""
+def __panShape():
+    """(width, height) of the pan in mm, which is its size in pixels."""
     in_to_mm = 25.4
     pan_wth = 6 * in_to_mm
     pan_hgt = 7.5 * in_to_mm
-    pan_shape = int(pan_wth), int(pan_hgt)
+    return int(pan_wth), int(pan_hgt)
+
+
+def panBuffer():
+    """
+    Allocate an image buffer the size of the pan.
+
+    Returns
+    -------
+    np.ndarray
+        Empty uint8 array with 1 pixel per mm of pan, to pass to
+        __getImg as out.
+    """
+    pan_wth, pan_hgt = __panShape()
+    return np.empty((pan_hgt, pan_wth), dtype=np.uint8)
 
-    wth_ratio = pan_wth / img.shape[0]
-    hgt_ratio = pan_hgt / img.shape[1]
 
-    return cv2.resize(img, pan_shape, wth_ratio, hgt_ratio, cv2.INTER_AREA)
+def __getToDimensions(img, out=None):
+    """Resizes image so 1 pixel translates to a 1 mm square, into out if given."""
+    return cv2.resize(img, __panShape(), dst=out, interpolation=cv2.INTER_LINEAR)
 
 
-def __getImgCoords(contours):
+def enableDebugImages(directory='.'):
     """
-    Transfer contour coordinates to G-code [x, y, e] format.
-    
-    The first and last 5 coordinates of each contour line have an e
-        value of 0, indicating no extrusion should occur. All other
-        line coordinates have an e value of 1, representing extrusion.
-    The last coordinate of the returned array returns the extruder to
-        its original position.
+    Save the intermediate images of each run for debugging.
+
+    Images are queued and written by a background thread, so
+        processing doesn't wait on the disk.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to write binary_image.jpeg, resized_image.jpeg,
+        dim_image.jpeg and contours.jpeg to.
+    """
+    global _debug_images
+    disableDebugImages()
+
+    images = queue.Queue()
+
+    def write():
+        while True:
+            item = images.get()
+            if item is None:
+                return
+            name, img = item
+            cv2.imwrite(os.path.join(directory, name), img)
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    _debug_images = (images, writer)
+
+
+def disableDebugImages():
+    """Stop saving debug images, once the queued ones are written."""
+    global _debug_images
+    if _debug_images is None:
+        return
+    images, writer = _debug_images
+    _debug_images = None
+    images.put(None)
+    writer.join()
+
+
+def __debugImage(name, img):
+    """Queue a copy of img to be saved, if debug images are enabled."""
+    if _debug_images is not None:
+        _debug_images[0].put((name, img.copy()))
+
+
+def simplifyContours(contours, tolerance_mm=NOZZLE_WIDTH_MM * SIMPLIFY_TOLERANCE, closed=True):
+    """
+    Simplify contour lines with the Ramer-Douglas-Peucker algorithm.
+
+    Removes vertices that are within tolerance_mm of the line through
+        their neighbours, so curves and noisy edges become fewer,
+        longer moves. Images are scaled so 1 pixel is 1 mm before
+        contours are found, so the tolerance is in pixels as well.
 
     Parameters
     ----------
     contours : tuple
-        Set of contour lines and their coordinates. Size is equal to
-        the number of contour lines found.
-    
+        Set of closed contour lines from cv2.findContours.
+    tolerance_mm : float
+        Maximum distance between the original and simplified lines.
+        A tolerance of 0 returns the contours unchanged.
+    closed : bool
+        Whether the lines are closed contours. Open lines keep both
+        of their ends.
+
     Returns
     -------
-    np.ndarray
-        All coordinates for all lines in G-code format, including
-        return point at end.
+    tuple
+        Simplified contour lines in the same format.
     """
-    coordinates = []
-    for line in contours:
-        num_coords = len(line)
-        for point_num in range(num_coords):
-            coord = line[point_num][0]
-            if (point_num == 0) or (num_coords - point_num <= 5):
-                coord = np.append(coord, 0)
-            else:
-                coord = np.append(coord, 1)
+    if tolerance_mm <= 0:
+        return contours
 
-            coordinates.append(coord)
+    simplified = tuple(cv2.approxPolyDP(line, tolerance_mm, closed) for line in contours)
 
-    # return to original pos
-    coordinates.append([0, 0, 0])
+    moves_before = sum(len(line) for line in contours)
+    moves_after = sum(len(line) for line in simplified)
+    print("Simplified contours from %d to %d moves (tolerance %.2f mm)."
+          % (moves_before, moves_after, tolerance_mm))
 
-    return np.asarray(coordinates)
+    return simplified
 
 
-def __getImg():
-    """Get coordinates of line contours from uploaded image."""
-    grayscale_img = __imgFromAirtable()
-    
-    _, binary_img = cv2.threshold(grayscale_img, 128, 255, cv2.THRESH_BINARY)
-    inv_img = cv2.bitwise_not(binary_img)
-    cv2.imwrite("binary_image.jpeg", inv_img)
+def __contourEnds(contours, starts, reverse):
+    """Entry and exit point of every contour for its start vertex and direction."""
+    if len(contours) == 0:
+        return np.empty((0, 2)), np.empty((0, 2))
+    lengths = np.array([len(line) for line in contours])
+    points = np.concatenate([line.reshape(-1, 2) for line in contours]).astype(float)
+    offsets = np.cumsum(lengths) - lengths
+    first = points[offsets + starts]
+    last = points[offsets + (starts - 1) % lengths]
+    reverse = np.asarray(reverse)[:, np.newaxis]
 
-    resized_img = __changeImgRatio(inv_img).astype('uint8')
-    cv2.imwrite("resized_image.jpeg", resized_img)
+    return np.where(reverse, last, first), np.where(reverse, first, last)
 
-    dim_img = __getToDimensions(resized_img)
-    cv2.imwrite("dim_image.jpeg", dim_img)
 
-    ctrs, _ = cv2.findContours(dim_img, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    ctr_img = cv2.drawContours(dim_img, ctrs, -1, (0,255,0), 3)
-    cv2.imwrite("contours.jpeg", ctr_img)
-    return (__getImgCoords(ctrs), dim_img)
+def __travelDistance(entries, exits, start):
+    """Non-extruding travel from start through every contour and back to start."""
+    ends = np.vstack((start, exits))
+    begins = np.vstack((entries, start))
 
+    return np.sum(np.hypot(*(begins - ends).T))
 
-def __getPos(rows, cols, spacing):
-    """Get correct spacing for background lines."""
-    num_x_y = int(1 / spacing)
-    x = np.linspace(0, cols, num_x_y)
-    y = np.linspace(0, rows, num_x_y)
-    Y, X = np.meshgrid(y, x)
 
-    return np.column_stack([X.ravel(), Y.ravel()]).astype(int)
+def __nearestNeighbourOrder(contours, start, closed=True):
+    """
+    Greedy contour order, always entering the nearest vertex of any contour left.
+
+    Vertices are bucketed in a grid sorted by cell, so each row of cells
+        is one slice, and searched in squares of cells around the last
+        exit, doubling in size until the nearest vertex found is closer
+        than anything outside the square. Vertices of finished contours
+        are dropped from the grid whenever they are most of it.
+    Open lines can only be entered at one of their two ends, and start
+        1 means the line is entered at its last vertex.
+    """
+    lines = [line.reshape(-1, 2).astype(float) for line in contours]
+    if not closed:
+        lines = [line[[0, -1]] for line in lines]
+    counts = np.array([len(line) for line in lines])
+    vertices = np.concatenate(lines)
+    owner = np.repeat(np.arange(len(lines)), counts)
+    vertex_num = np.arange(len(vertices)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    # about 4 vertices per cell
+    low = vertices.min(axis=0)
+    span = np.maximum(vertices.max(axis=0) - low, 1)
+    cell = max(np.sqrt(span[0] * span[1] * 4 / len(vertices)), 1.0)
+    cols, rows = (span // cell).astype(int) + 1
+
+    cells = ((vertices - low) // cell).astype(int)
+    cell_ids = cells[:, 1] * cols + cells[:, 0]
+    members = np.argsort(cell_ids, kind='stable')
+    member_cells = cell_ids[members]
+    cell_start = np.searchsorted(member_cells, np.arange(rows * cols + 1))
+    done = np.zeros(len(lines), dtype=bool)
+    finished_vertices = 0
+
+    order = np.empty(len(lines), dtype=int)
+    starts = np.zeros(len(lines), dtype=int)
+    x, y = np.asarray(start, dtype=float)
+    for i in range(len(lines)):
+        cx, cy = int((x - low[0]) // cell), int((y - low[1]) // cell)
+        reach = 1
+        while True:
+            x0, x1 = max(cx - reach, 0), min(cx + reach, cols - 1)
+            y0, y1 = max(cy - reach, 0), min(cy + reach, rows - 1)
+            everything = cx - reach <= 0 and cy - reach <= 0 and cx + reach >= cols - 1 and cy + reach >= rows - 1
+            if x0 <= x1 and y0 <= y1:
+                found = np.concatenate([members[cell_start[row * cols + x0]:cell_start[row * cols + x1 + 1]]
+                                        for row in range(y0, y1 + 1)])
+                found = found[~done[owner[found]]]
+                if len(found):
+                    dist = (vertices[found, 0] - x) ** 2 + (vertices[found, 1] - y) ** 2
+                    nearest = np.argmin(dist)
+                    # Anything outside the square is at least reach cells away
+                    if everything or dist[nearest] <= (reach * cell) ** 2:
+                        break
+            reach *= 2
+
+        best, best_vertex = owner[found[nearest]], vertex_num[found[nearest]]
+        order[i] = best
+        starts[best] = best_vertex
+        x, y = lines[best][best_vertex - 1]
+        done[best] = True   # finished contours are never nearest again
+        finished_vertices += counts[best]
+        if 2 * finished_vertices > len(members) and i + 1 < len(lines):
+            # still sorted by cell after dropping the finished ones
+            left = ~done[owner[members]]
+            members, member_cells = members[left], member_cells[left]
+            cell_start = np.searchsorted(member_cells, np.arange(rows * cols + 1))
+            finished_vertices = 0
+
+    return order, starts
+
+
+def __twoOpt(entries, exits, start, time_budget):
+    """
+    Improve a contour order by reversing runs of contours (2-opt).
 
+    Reversing a run also reverses each of its contours, so each one is
+        entered where it used to be left.
 
-def __reverseBgdLines(positions, spc_inv):
-    """Mirror order of coordinates for every other line."""
-    rev_coords = []
-    for i in range(spc_inv):
-        temp_crd_list = positions[(i * spc_inv):(((i + 1) * spc_inv))]
-        if (i + 1) % 2 == 0:
-            for j in reversed(range(spc_inv)):
-                rev_coords.append(temp_crd_list[j])
-        else:
-            for j in range(spc_inv):
-                rev_coords.append(temp_crd_list[j])
+    Returns the new order as indices into entries and a flag for every
+        position that is now drawn reversed.
+    """
+    num = len(entries)
+    order = np.arange(num)
+    flipped = np.zeros(num, dtype=bool)
+    ent = np.vstack((start, entries, start))
+    ext = np.vstack((start, exits, start))
+
+    deadline = time.perf_counter() + time_budget
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for i in range(1, num + 1):
+            if time.perf_counter() > deadline:
+                break
+            # Reverse positions i..j, for every j at once
+            j = np.arange(i, num + 1)
+            old = np.hypot(*(ent[i] - ext[i - 1])) + np.hypot(*(ent[j + 1] - ext[j]).T)
+            new = np.hypot(*(ext[j] - ext[i - 1]).T) + np.hypot(*(ent[j + 1] - ent[i]).T)
+            gain = old - new
+            best = np.argmax(gain)
+            if gain[best] > 1e-9:
+                j = j[best]
+                ent[i:j + 1], ext[i:j + 1] = ext[j:i - 1:-1].copy(), ent[j:i - 1:-1].copy()
+                order[i - 1:j] = order[i - 1:j][::-1]
+                flipped[i - 1:j] = ~flipped[i - 1:j][::-1]
+                improved = True
+
+    return order, flipped
+
+
+def orderContours(contours, start=(0, 0), time_budget=0.25, closed=True):
+    """
+    Reorder contour lines to cut down travel between them.
 
-    return rev_coords
+    Contours are chosen nearest neighbour first, entering each closed
+        contour at its vertex nearest to the last one drawn, then the
+        order and directions are improved with 2-opt until no move
+        helps or the time budget runs out. The nearest neighbour pass
+        comes out of the same budget, so thousands of contours are
+        ordered in about time_budget seconds. Open lines are entered at
+        whichever end is nearer instead.
 
+    Parameters
+    ----------
+    contours : tuple
+        Set of closed contour lines from cv2.findContours, or open
+        lines from centerline.centerlines.
+    start : tuple
+        Position of the extruder before drawing, in mm.
+    time_budget : float
+        Seconds to spend ordering, including improving the nearest
+        neighbour order.
+    closed : bool
+        Whether the lines are closed contours.
 
-def __gcodeBgdCoords(coords, num_coords):
-    """Apply G-code formatting to background coordinates."""
-    coordinates = []
-    for i in range(num_coords):
-        if (i == 0):
-            coord = np.append(coords[i], 0)
-        else:
-            coord = np.append(coords[i], 1)
+    Returns
+    -------
+    list
+        Contour lines in drawing order, each rotated to start at its
+        entry point and in its drawing direction.
+    """
+    deadline = time.perf_counter() + time_budget
+    contours = [line for line in contours if len(line) > 0]
+    if len(contours) == 0:
+        return contours
+    start = np.asarray(start, dtype=float)
+
+    no_reverse = np.zeros(len(contours), dtype=bool)
+    entries, exits = __contourEnds(contours, np.zeros(len(contours), dtype=int), no_reverse)
+    travel_before = __travelDistance(entries, exits, start)
+
+    nn_order, starts = __nearestNeighbourOrder(contours, start, closed)
+    if closed:
+        nn_reverse = no_reverse
+    else:
+        # open lines always start at vertex 0, reversed if entered at the end
+        nn_reverse, starts = starts == 1, np.zeros(len(contours), dtype=int)
+    entries, exits = __contourEnds(contours, starts, nn_reverse)
+    order, reverse = __twoOpt(entries[nn_order], exits[nn_order], start,
+                              max(deadline - time.perf_counter(), 0))
+    order = nn_order[order]
+    reverse = reverse ^ nn_reverse[order]
 
-        coordinates.append(coord)
+    ordered = []
+    for line, flip in zip(order, reverse):
+        rotated = np.concatenate((contours[line][starts[line]:], contours[line][:starts[line]]))
+        ordered.append(rotated[::-1] if flip else rotated)
 
-    # return to original pos
-    coordinates.append([0, 0, 0])
+    entries, exits = __contourEnds(ordered, np.zeros(len(ordered), dtype=int), no_reverse)
+    travel_after = __travelDistance(entries, exits, start)
+    print("Reordered %d contours: travel %.0f mm -> %.0f mm (saved %.0f mm)."
+          % (len(ordered), travel_before, travel_after, travel_before - travel_after))
 
-    return np.asarray(coordinates)
+    return ordered
 
 
-def __getBgdCoords(positions, spacing):
+def __getImgCoords(contours, return_home=True, coast_mm=COAST_MM):
     """
-    Get background coordinates from contours covering cake face.
+    Transfer contour coordinates to G-code [x, y, e] format.
     
+    The first coordinate of each contour line, and the last coast_mm
+        along it, have an e value of 0, indicating no extrusion should
+        occur. All other line coordinates have an e value of 1,
+        representing extrusion. Where the coast starts partway along a
+        move, a point is added there, so how much of each line is
+        frosted doesn't depend on how far apart its points are.
+    The last coordinate of the returned array returns the extruder to
+        its original position.
+
     Parameters
     ----------
-    positions : list
-        List of all coordinates to cover full cake face.
-    spacing : float
-        Relative space between each coordinate.
+    contours : tuple
+        Set of contour lines and their coordinates. Size is equal to
+        the number of contour lines found.
+    return_home : bool
+        Whether to add the return point at the end.
+    coast_mm : float
+        Length at the end of each line to move through without
+        extruding. Centerlines use 0 so strokes are frosted all the
+        way to their ends.
     
     Returns
     -------
     np.ndarray
-        All coordinates to cover cake in G-code format, including
+        All coordinates for all lines in G-code format, including
         return point at end.
     """
-    num_coords = int(len(positions))
-    spc_inv = int(1 / spacing)
+    lengths = np.array([len(line) for line in contours], dtype=int)
+    num_points = np.sum(lengths)
+    if len(lengths) == 0:
+        # only the return to original pos
+        return np.zeros((int(return_home), 3), dtype=int)
+
+    points = np.concatenate([np.reshape(line, (-1, 2)) for line in contours]).astype(float)
+    firsts = np.cumsum(lengths) - lengths
+    first = np.zeros(num_points, dtype=bool)
+    first[firsts] = True
+
+    # distance along each line from each point to the line's end
+    moves = np.concatenate(([0], np.hypot(*np.diff(points, axis=0).T)))
+    moves[first] = 0
+    travelled = np.cumsum(moves)
+    to_end = np.repeat(travelled[firsts + lengths - 1], lengths) - travelled
+
+    # split moves that start before the coast and end inside it
+    split = ~first & (to_end < coast_mm) & (np.concatenate(([0], to_end[:-1])) > coast_mm)
+    ends = np.flatnonzero(split)
+    fraction = (to_end[ends - 1] - coast_mm) / moves[ends]
+    split_points = np.rint(points[ends - 1] + fraction[:, np.newaxis] * (points[ends] - points[ends - 1]))
+    keep = np.any(split_points != points[ends], axis=1) & np.any(split_points != points[ends - 1], axis=1)
+    ends, split_points = ends[keep], split_points[keep]
+
+    points = np.insert(points, ends, split_points, axis=0)
+    # lines no longer than the coast are not frosted at all
+    extrude = np.insert(~first & (to_end >= coast_mm), ends, True)
+
+    coordinates = np.zeros((len(points) + int(return_home), 3), dtype=int)
+    coordinates[:len(points), 0:2] = points
+    coordinates[:len(points), 2] = extrude
+
+    # last row stays [0, 0, 0] to return to original pos
+    return coordinates
+
+
+def iterImgCoords(contours, chunk_size=100, closed=True):
+    """
+    Generate G-code [x, y, e] coordinates for contour lines in chunks.
+
+    Contours are simplified and ordered up front, then converted
+        chunk_size contour lines at a time as chunks are requested,
+        so drawing can start before every line is converted.
+
+    Parameters
+    ----------
+    contours : tuple
+        Set of contour lines from cv2.findContours.
+    chunk_size : int
+        Number of contour lines per chunk.
+    closed : bool
+        Whether the lines are closed contours, or open centerlines.
+
+    Yields
+    ------
+    np.ndarray
+        Coordinates in G-code format. The last chunk is the return
+        point.
+    """
+    contours = orderContours(simplifyContours(contours, closed=closed), closed=closed)
+    coast_mm = COAST_MM if closed else 0
 
-    rev_coords = __reverseBgdLines(positions, spc_inv)
+    for first in range(0, len(contours), chunk_size):
+        yield __getImgCoords(contours[first:first + chunk_size], return_home=False, coast_mm=coast_mm)
 
-    return __gcodeBgdCoords(rev_coords, num_coords)
+    # return to original pos
+    yield __getImgCoords((), return_home=True)
 
 
-def __getBgd(img):
+def __getImg(grayscale_img, out=None, mode='outline'):
     """
-    Get coordinates of background contours to cover full cake face.
-    
+    Get line contours and the scaled image from uploaded image.
+
+    The image stays uint8 throughout: it is padded to the pan ratio
+        with white, thresholded and inverted in place, then resized
+        straight into the pan sized output.
+
+    Parameters
+    ----------
+    grayscale_img : np.ndarray
+        uint8 grayscale image, dark lines on a white background.
+    out : np.ndarray
+        Buffer from panBuffer() to resize into. Allocated if None.
+    mode : str
+        'outline' traces the edges of every shape as closed contours,
+        which suits filled shapes. 'centerline' traces the middle of
+        every stroke as open lines, so line drawings and text are
+        frosted once per stroke instead of once per edge.
+
+    Returns
+    -------
+    tuple
+        Contour lines, and the scaled binary image they were found in.
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown mode %r, expected one of %s" % (mode, MODES))
+
+    padded = __changeImgRatio(grayscale_img, value=255)
+    cv2.threshold(padded, 128, 255, cv2.THRESH_BINARY_INV, dst=padded)
+    dim_img = __getToDimensions(padded, out)
+
+    if mode == 'centerline':
+        ctrs = centerlines(dim_img > 127, min_spur=NOZZLE_WIDTH_MM)
+    else:
+        ctrs, _ = cv2.findContours(dim_img, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+
+    if _debug_images is not None:
+        top, _, lft, _ = __panPadding(grayscale_img.shape[0], grayscale_img.shape[1])
+        __debugImage("binary_image.jpeg", padded[top:top + grayscale_img.shape[0],
+                                                 lft:lft + grayscale_img.shape[1]])
+        __debugImage("resized_image.jpeg", padded)
+        __debugImage("dim_image.jpeg", dim_img)
+        __debugImage("contours.jpeg", cv2.polylines(dim_img.copy(), ctrs, mode == 'outline', (0,255,0), 3))
+    return (ctrs, dim_img)
+
+
+def __coverageMask(shape, contours, margin_mm, closed=True):
+    """Pan area to frost with background: inside the margin and off the image lines."""
+    mask = np.zeros(shape, dtype=np.uint8)
+    margin = int(round(margin_mm))
+    mask[margin:shape[0] - margin, margin:shape[1] - margin] = 255
+    if contours is not None and len(contours) > 0:
+        # the black pass frosts a nozzle wide band along every contour
+        cv2.polylines(mask, contours, closed, 0, NOZZLE_WIDTH_MM)
+    return mask > 0
+
+
+def scanlineFill(mask, line_spacing_mm, min_length_mm=NOZZLE_WIDTH_MM):
+    """
+    Fill a mask with serpentine rows in G-code [x, y, e] format.
+
+    Rows are line_spacing_mm apart and clipped to the mask. Each run
+        of a row inside the mask is one extruding move, and every other
+        row runs right to left. Moves between the ends of neighbouring
+        rows keep extruding, so a solid region is one continuous line.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        Boolean array, True where frosting should go. 1 pixel is 1 mm.
+    line_spacing_mm : float
+        Distance between rows.
+    min_length_mm : float
+        Runs shorter than this are skipped.
+
+    Returns
+    -------
+    np.ndarray
+        Coordinates in G-code format, including return point at end.
+    """
+    rows = np.unique(np.arange(line_spacing_mm / 2, mask.shape[0], line_spacing_mm).astype(int))
+
+    # run starts and ends along each scanline, in row major order so they pair up
+    edges = np.diff(np.pad(mask[rows].astype(np.int8), ((0, 0), (1, 1))), axis=1)
+    line, start_col = np.nonzero(edges == 1)
+    _, end_col = np.nonzero(edges == -1)
+    end_col = end_col - 1
+
+    keep = end_col - start_col >= min_length_mm
+    line, start_col, end_col = line[keep], start_col[keep], end_col[keep]
+
+    # serpentine: every other scanline with runs on it goes right to left
+    flip = np.unique(line, return_inverse=True)[1] % 2 == 1
+    order = np.lexsort((np.where(flip, -start_col, start_col), line))
+    first = np.where(flip, end_col, start_col)[order]
+    last = np.where(flip, start_col, end_col)[order]
+    y = rows[line[order]]
+
+    coordinates = np.zeros((2 * len(order) + 1, 3), dtype=int)
+    coordinates[0:-1:2, 0] = first
+    coordinates[1:-1:2, 0] = last
+    coordinates[0:-1:2, 1] = y
+    coordinates[1:-1:2, 1] = y
+    coordinates[1:-1:2, 2] = 1
+
+    # keep extruding across short hops to the next row
+    hops = coordinates[2:-1:2, 0:2] - coordinates[1:-2:2, 0:2]
+    coordinates[2:-1:2, 2] = np.hypot(hops[:, 0], hops[:, 1]) <= 1.5 * line_spacing_mm
+
+    # last row stays [0, 0, 0] to return to original pos
+    return coordinates
+
+
+def __fillStats(coordinates):
+    """Frosting length in mm and estimated drawing time in s of G-code coordinates."""
+    # steps per mm don't change the velocity profile
+    lengths, _, _, _, durations = MotionPlanner(1, 1).profile(coordinates.astype(float))
+    return np.sum(lengths[coordinates[:, 2] > 0]), np.sum(durations)
+
+
+def __getBgd(img, contours=None, line_spacing_mm=NOZZLE_WIDTH_MM * BGD_LINE_SPACING,
+             margin_mm=BGD_MARGIN_MM, closed=True):
+    """
+    Get coordinates of background rows covering the cake face.
+
+    Rows are spaced by the bead width and skip the margin and the
+        bands along the image contours that the black pass frosts.
+
     Parameters
     ----------
     img : np.ndarray
         Array for image obtained from __getImg method
+    contours : tuple
+        Image contour lines to leave for the black pass, or None to
+        cover the whole face.
+    line_spacing_mm : float
+        Distance between rows.
+    margin_mm : float
+        Unfrosted border around the edge of the pan.
+    closed : bool
+        Whether the image lines are closed contours, or open
+        centerlines.
 
     Returns
     -------
@@ -318,14 +773,18 @@ def __getBgd(img):
         All coordinates to cover cake in G-code format, including
         return point at end.
     """
-    blank = np.zeros(img.shape, dtype='uint8')
+    coordinates = scanlineFill(__coverageMask(img.shape, contours, margin_mm, closed), line_spacing_mm)
 
-    blank_rows = blank.shape[0]
-    blank_cols = blank.shape[1]
-    spacing_pt = .08
-    positions = __getPos(blank_rows, blank_cols, spacing_pt)
+    length, duration = __fillStats(coordinates)
+    if contours is not None and len(contours) > 0:
+        full_length, full_duration = __fillStats(
+            scanlineFill(__coverageMask(img.shape, None, margin_mm), line_spacing_mm))
+    else:
+        full_length, full_duration = length, duration
+    print("Background: %.0f mm of frosting, about %.0f s (saved %.0f mm, %.0f s by skipping image lines)."
+          % (length, duration, full_length - length, full_duration - duration))
 
-    return __getBgdCoords(positions.tolist(), spacing_pt)
+    return coordinates
 
 
 def write_done():
@@ -342,13 +801,203 @@ def write_done():
     return
 
 
-def run():
-    img_coordinates, dim_img = __getImg()
-    np.savetxt("img_coordinates.csv", img_coordinates, delimiter=',')
+def __prefetch(chunks, depth):
+    """Run a chunk generator ahead in a background thread, up to depth chunks."""
+    buffer = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for chunk in chunks:
+                buffer.put(chunk)
+        except Exception as e:
+            buffer.put(e)
+        buffer.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    while True:
+        chunk = buffer.get()
+        if chunk is done:
+            return
+        if isinstance(chunk, Exception):
+            raise chunk
+        yield chunk
+
+
+def __processingParams(mode='outline'):
+    """Parameters that change the processed toolpath, for cache keys."""
+    return {'version': 4,
+            'mode': mode,
+            'nozzle_width_mm': NOZZLE_WIDTH_MM,
+            'simplify_tolerance': SIMPLIFY_TOLERANCE,
+            'bgd_line_spacing': BGD_LINE_SPACING,
+            'bgd_margin_mm': BGD_MARGIN_MM,
+            'coast_mm': COAST_MM}
 
-    bgd_coordinates = __getBgd(dim_img)
-    np.savetxt("bgd_coordinates.csv", bgd_coordinates, delimiter=',')
 
+def __cacheChunks(img_chunks, cache, key, bgd_coordinates):
+    """Pass image chunks through, caching the whole toolpath once every chunk is done."""
+    chunks = []
+    for chunk in img_chunks:
+        chunks.append(chunk)
+        yield chunk
+
+    cache.put(key, bgd=bgd_coordinates, img=np.concatenate(chunks))
+
+
+def stream(chunk_size=100, prefetch=4, cache=None, mode='outline'):
+    """
+    Get the background coordinates and a stream of image coordinates.
+
+    The background is ready straight away. Image contours keep being
+        converted in a background thread while the background is
+        drawn, and are handed over chunk by chunk.
+
+    Parameters
+    ----------
+    chunk_size : int
+        Number of contour lines per image chunk.
+    prefetch : int
+        Number of image chunks to prepare ahead. 0 converts each
+        chunk only when it is requested.
+    cache : ToolpathCache
+        Cache of images and toolpaths. A design that was processed
+        before is not downloaded or processed again. None disables
+        caching.
+    mode : str
+        'outline' or 'centerline', see __getImg.
+
+    Returns
+    -------
+    tuple
+        Background coordinates in G-code format, and an iterator of
+        image coordinate chunks in G-code format.
+    """
+    img_hash, load_img = __imgFromAirtable(cache)
+
+    if cache is not None:
+        key = cache.key(img_hash, __processingParams(mode))
+        cached = cache.get(key)
+        if cached is not None:
+            print("Using cached toolpath.")
+            return (cached['bgd'], iter((cached['img'],)))
+
+    closed = mode == 'outline'
+    ctrs, dim_img = __getImg(load_img(), mode=mode)
+    bgd_coordinates = __getBgd(dim_img, ctrs, closed=closed)
+
+    img_chunks = iterImgCoords(ctrs, chunk_size, closed)
+    if cache is not None:
+        img_chunks = __cacheChunks(img_chunks, cache, key, bgd_coordinates)
+    if prefetch > 0:
+        img_chunks = __prefetch(img_chunks, prefetch)
+
+    return (bgd_coordinates, img_chunks)
+
+
+def prepareToolpath(attachment, cache=None, mode='outline'):
+    """
+    Get the background and image coordinates for an Airtable image.
+
+    Used to prepare upcoming orders ahead of time, see
+        job_scheduler.py.
+
+    Parameters
+    ----------
+    attachment : dict
+        Airtable image attachment, with at least 'id' and 'url'.
+    cache : ToolpathCache
+        Cache of images and toolpaths, or None.
+    mode : str
+        'outline' or 'centerline', see __getImg.
+
+    Returns
+    -------
+    tuple
+        Background and image coordinates in G-code format.
+    """
+    img_hash, load_img = __imgFromAttachment(attachment, cache)
+
+    if cache is not None:
+        key = cache.key(img_hash, __processingParams(mode))
+        cached = cache.get(key)
+        if cached is not None:
+            return (cached['bgd'], cached['img'])
+
+    closed = mode == 'outline'
+    ctrs, dim_img = __getImg(load_img(), mode=mode)
+    bgd_coordinates = __getBgd(dim_img, ctrs, closed=closed)
+    img_coordinates = np.concatenate(list(iterImgCoords(ctrs, closed=closed)))
+
+    if cache is not None:
+        cache.put(key, bgd=bgd_coordinates, img=img_coordinates)
+
+    return (bgd_coordinates, img_coordinates)
+
+
+def run(export=True, cache=None, mode='outline'):
+    """
+    Get the background and image coordinates as whole arrays.
+
+    Parameters
+    ----------
+    export : bool
+        Also write them to bgd_coordinates.csv and img_coordinates.csv,
+        which have no header row, and to job.gcode for G-code tools.
+    cache : ToolpathCache
+        Cache of images and toolpaths, or None.
+    mode : str
+        'outline' or 'centerline', see __getImg.
+
+    Returns
+    -------
+    tuple
+        Background and image coordinates in G-code format.
+    """
+    bgd_coordinates, img_chunks = stream(prefetch=0, cache=cache, mode=mode)
+    img_coordinates = np.concatenate(list(img_chunks))
+
+    if export:
+        np.savetxt("img_coordinates.csv", img_coordinates, delimiter=',')
+        np.savetxt("bgd_coordinates.csv", bgd_coordinates, delimiter=',')
+        save_gcode("job.gcode", [('white', bgd_coordinates), ('black', img_coordinates)])
+
+    return (bgd_coordinates, img_coordinates)
+
+
+def compareModes(grayscale_img):
+    """
+    Compare the image toolpath of every mode for one image.
+
+    Parameters
+    ----------
+    grayscale_img : np.ndarray
+        uint8 grayscale image, dark lines on a white background.
+
+    Returns
+    -------
+    dict
+        For each mode, the number of lines and moves, frosted and
+        travel path length in mm, and estimated drawing time in s.
+    """
+    results = {}
+    for mode in MODES:
+        ctrs, _ = __getImg(grayscale_img, mode=mode)
+        coordinates = np.concatenate(list(iterImgCoords(ctrs, closed=mode == 'outline')))
+        frosted, duration = __fillStats(coordinates)
+        moves = np.diff(np.vstack(([0, 0], coordinates[:, 0:2])), axis=0)
+        results[mode] = {'lines': len(ctrs),
+                         'moves': len(coordinates),
+                         'frosted_mm': float(frosted),
+                         'travel_mm': float(np.sum(np.hypot(*moves.T)) - frosted),
+                         'seconds': float(duration)}
+
+    for mode, result in results.items():
+        print("%-10s %5d lines %6d moves %8.0f mm frosted %8.0f mm travel  about %.0f s"
+              % (mode, result['lines'], result['moves'], result['frosted_mm'],
+                 result['travel_mm'], result['seconds']))
+    return results
 
 if __name__ == '__main__':
     waitForUnload()
@@ -0,0 +1,292 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# job_estimator.py
+#
+# Predicts how long a job will take before it starts, from the same
+# velocity profile the motion planner plans and the same whole-step
+# moves the board makes, so orders can be scheduled and alternative
+# toolpaths compared.
+#
+# The motion planner says when each move should finish, but every step
+# is an I2C write, and a move can't finish before its writes are done.
+# The executor never waits to catch up, so once it falls behind it runs
+# steps back to back until it is on time again. The finish time of a
+# drawing is then
+#     max over moves j of (planned end of move j + cost of every write after it)
+# where the cost of a write is a per-step, per-throttle-change or
+# per-move time. That is worked out for every move at once, and the
+# whole estimate is a few numpy passes over the command array.
+#
+# Given the board's ExtrusionController, the estimate is worked out
+# step by step from the full step schedule instead, which also counts
+# the throttle changes the controller makes along each line. That is
+# slower but closer, for checking a job rather than scoring many plans.
+#
+# The write costs, a scale on the planned motion time and the time to
+# home are parameters. calibrate() fits them by least squares to
+# recorded runs: for the move that decides each run's finish time the
+# estimate is linear in the parameters, so it alternates between
+# finding those moves and solving for the parameters. Which moves
+# decide depends on how slow writes are, so the fit is started from a
+# range of write costs and the best one kept.
+#
+# NECESSARY FOR USE:
+# numpy
+
+from motion_planner import MotionPlanner
+from extrusion import ExtrusionController
+from step_planner import position_steps
+import json
+import numpy as np
+
+PARAMS = ('time_scale', 'step_seconds', 'throttle_seconds', 'move_seconds', 'homing_seconds')
+
+# Step and throttle write seconds that calibration starts fits from
+WRITE_COSTS = (1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2)
+
+# Most recent runs kept for calibration, about 75 cakes of 4 phases
+MAX_RUNS = 300
+
+
+class JobEstimator:
+    def __init__(self, motion_planner: MotionPlanner, extrusion: ExtrusionController = None,
+                 offsets: dict = None, time_scale: float = 1,
+                 step_seconds: float = 0.001, throttle_seconds: float = 0.001, move_seconds: float = 0,
+                 homing_seconds: float = 8, max_runs: int = MAX_RUNS):
+        """
+        Constructs a job estimator
+        :param motion_planner: motion planner of the board, for steps per mm, speed and acceleration
+        :param extrusion: extrusion controller of the board, to estimate step by step. None
+                          estimates move by move, which is faster
+        :param offsets: {'white': [x, y], 'black': [x, y]} tool offsets, for plans from job_planner
+        :param time_scale: multiple of the planned motion time the robot actually takes
+        :param step_seconds: seconds per stepper write, 1 / the highest step rate the board manages
+        :param throttle_seconds: seconds per extruder throttle change
+        :param move_seconds: overhead per move
+        :param homing_seconds: seconds to home both axes
+        :param max_runs: most recorded runs to keep, older ones are dropped so
+                         saving and calibrating don't slow down as runs pile up
+        """
+        self.motion_planner = motion_planner
+        self.extrusion = extrusion
+        self.offsets = {'white': np.zeros(2), 'black': np.zeros(2)} if offsets is None else \
+            {tool: np.asarray(offset, dtype=float) for tool, offset in offsets.items()}
+        self.params = np.array((time_scale, step_seconds, throttle_seconds, move_seconds, homing_seconds),
+                               dtype=float)
+        self.runs = []      # (candidates, measured seconds) of recorded runs, oldest first
+        self.max_runs = max_runs
+
+    def candidates(self, commands: np.ndarray, start: np.ndarray = None, max_candidates: int = 512) -> np.ndarray:
+        """
+        Finish time terms of a drawing, one row per move that could decide when it finishes.
+        The estimate is the largest of candidates @ params.
+        :param commands: [[x1, y1, e1], ...[xn, yn, en]] carriage coordinates in mm
+        :param start: [x, y] carriage position before the first move, defaults to [0, 0]
+        :param max_candidates: most rows to keep, spread evenly over the drawing
+        :return: (k, len(PARAMS)) array of [planned end, steps, throttle changes, moves, homes]
+                 after each candidate move
+        """
+        commands = np.asarray(commands, dtype=float).reshape(-1, 3)
+        if start is None:
+            start = np.zeros(2)
+        if len(commands) == 0:
+            return np.zeros((1, len(PARAMS)))
+
+        # Writes from each point on, with nothing left after the end
+        def after(costs):
+            return np.concatenate((np.cumsum(costs[::-1])[::-1], [0]))
+
+        if self.extrusion is not None:
+            return self._step_candidates(commands, start, after, max_candidates)
+
+        durations = self.motion_planner.profile(commands, start)[4]
+        ends = np.concatenate(([0], np.cumsum(durations)))
+
+        # Whole-step moves from the nearest step to each target, like the board
+        points = np.vstack((np.asarray(start, dtype=float)[np.newaxis, :], commands[:, 0:2]))
+        positions = np.column_stack((position_steps(points[:, 0], self.motion_planner.x_steps_per_mm),
+                                     position_steps(points[:, 1], self.motion_planner.y_steps_per_mm)))
+        writes = np.sum(np.abs(np.diff(positions, axis=0)), axis=1)
+        changes = np.diff(np.concatenate(([0], commands[:, 2]))) != 0
+
+        # Candidate 0 is the start of the drawing, candidate j the end of move j
+        terms = np.column_stack((ends, after(writes), after(changes), after(np.ones(len(commands))),
+                                 np.zeros(len(ends))))
+        return self._thin(terms, max_candidates)
+
+    def _step_candidates(self, commands: np.ndarray, start: np.ndarray, after, max_candidates: int) -> np.ndarray:
+        """Candidates from the full step schedule, one per step iteration, see candidates()"""
+        schedule = self.extrusion.apply(self.motion_planner.plan(commands, start))
+        if len(schedule) == 0:
+            return np.zeros((1, len(PARAMS)))
+        writes = np.abs(schedule['x']).astype(float) + np.abs(schedule['y'])
+        changes = np.concatenate(([True], schedule['e'][1:] != schedule['e'][:-1]))
+
+        # First step of each move, for the per-move overhead
+        new_move = np.zeros(len(schedule))
+        points = np.vstack((np.asarray(start, dtype=float)[np.newaxis, :], commands[:, 0:2]))
+        counts = np.max(np.abs(np.diff(np.column_stack((
+            position_steps(points[:, 0], self.motion_planner.x_steps_per_mm),
+            position_steps(points[:, 1], self.motion_planner.y_steps_per_mm))), axis=0)), axis=1)
+        firsts = np.cumsum(counts) - counts
+        new_move[firsts[counts > 0]] = 1
+
+        # Candidate j is step j being taken on time, then every write from it on
+        terms = np.column_stack((np.append(schedule['t'], schedule['t'][-1]), after(writes), after(changes),
+                                 after(new_move), np.zeros(len(schedule) + 1)))
+        return self._thin(terms, max_candidates)
+
+    @staticmethod
+    def _thin(terms: np.ndarray, max_candidates: int) -> np.ndarray:
+        """
+        Keeps about max_candidates rows: every row that decides the finish time for
+        some pair of write costs in WRITE_COSTS, and the rest spread evenly
+        """
+        if len(terms) <= max_candidates:
+            return terms
+        costs = np.array([(1, step, throttle, 0, 0) for step in WRITE_COSTS for throttle in WRITE_COSTS])
+        deciding = np.argmax(terms @ costs.T, axis=0)
+        spread = np.linspace(0, len(terms) - 1, max_candidates).astype(int)
+        return terms[np.unique(np.concatenate((deciding, spread)))]
+
+    def home_candidates(self) -> np.ndarray:
+        """Finish time terms of homing both axes"""
+        terms = np.zeros((1, len(PARAMS)))
+        terms[0, PARAMS.index('homing_seconds')] = 1
+        return terms
+
+    def predict(self, candidates: np.ndarray) -> float:
+        """Estimated seconds of a drawing or homing from its candidates"""
+        return float(np.max(candidates @ self.params))
+
+    def estimate(self, commands: np.ndarray, start: np.ndarray = None) -> dict:
+        """
+        Estimates how long drawing commands takes
+        :param commands: [[x1, y1, e1], ...[xn, yn, en]] carriage coordinates in mm
+        :param start: [x, y] carriage position before the first move, defaults to [0, 0]
+        :return: {'seconds', 'motion_seconds', 'write_seconds'} where motion_seconds is the
+                 planned motion time and write_seconds the time lost waiting for writes
+        """
+        candidates = self.candidates(commands, start)
+        seconds = self.predict(candidates)
+        motion = float(candidates[-1, 0] * self.params[0])
+        return {'seconds': seconds, 'motion_seconds': motion, 'write_seconds': seconds - motion}
+
+    def plan_candidates(self, phases: list) -> list:
+        """
+        Candidates of every phase of a plan from job_planner
+        :param phases: list of phases from JobPlanner.plan
+        :return: list of (name, candidates)
+        """
+        result = []
+        carriage = np.zeros(2)
+        for phase in phases:
+            if phase['commands'] is None:
+                result.append((phase['name'], self.home_candidates()))
+                carriage = np.zeros(2)
+                continue
+            machine = np.array(phase['commands'], dtype=float).reshape(-1, 3)
+            machine[:, 0:2] += self.offsets[phase['tool']]
+            result.append((phase['name'], self.candidates(machine, carriage)))
+            if len(machine):
+                carriage = machine[-1, 0:2]
+        return result
+
+    def estimate_plan(self, phases: list) -> dict:
+        """
+        Estimates how long each phase of a plan takes
+        :param phases: list of phases from JobPlanner.plan
+        :return: {'phases': {name: seconds}, 'seconds': total}
+        """
+        seconds = {name: self.predict(candidates) for name, candidates in self.plan_candidates(phases)}
+        return {'phases': seconds, 'seconds': sum(seconds.values())}
+
+    def record(self, candidates: np.ndarray, seconds: float):
+        """
+        Records how long a drawing or homing really took, for calibrate(). Only
+        the most recent max_runs are kept
+        :param candidates: from candidates(), home_candidates() or plan_candidates()
+        :param seconds: measured time
+        :return: None
+        """
+        self.runs.append((np.asarray(candidates, dtype=float), float(seconds)))
+        del self.runs[:-self.max_runs]
+        return
+
+    def _fit(self, params: np.ndarray, prior: np.ndarray, measured: np.ndarray, iterations: int,
+             ridge: float) -> np.ndarray:
+        """Alternating least squares from params, see calibrate()"""
+        # Solved relative to the prior and the typical run, so the ridge term is unitless
+        scale = max(float(np.mean(np.abs(measured))), 1e-9)
+        prior_scale = np.where(prior > 0, prior, 1)
+        decided = None
+        for _ in range(iterations):
+            rows = np.array([candidates[np.argmax(candidates @ params)] for candidates, _ in self.runs])
+            if decided is not None and np.array_equal(rows, decided):
+                break
+            decided = rows
+            a = np.vstack((rows * prior_scale / scale, np.sqrt(ridge) * np.eye(len(PARAMS))))
+            b = np.concatenate((measured / scale, np.sqrt(ridge) * prior / prior_scale))
+            params = np.clip(np.linalg.lstsq(a, b, rcond=None)[0] * prior_scale, 0, None)
+        return params
+
+    def calibrate(self, iterations: int = 20, ridge: float = 1e-3, write_costs: tuple = WRITE_COSTS) -> float:
+        """
+        Fits the parameters to the recorded runs by least squares. Parameters the
+        runs say little about stay near their current values.
+        :param iterations: most rounds of finding deciding moves and solving
+        :param ridge: weight pulling each parameter towards where its fit started
+        :param write_costs: step and throttle write seconds to start fits from
+        :return: RMS error in seconds of the fitted estimates over the recorded runs
+        """
+        if not self.runs:
+            return 0.0
+        prior = self.params.copy()
+        measured = np.array([seconds for _, seconds in self.runs])
+
+        def rms(params):
+            predicted = np.array([np.max(candidates @ params) for candidates, _ in self.runs])
+            return float(np.sqrt(np.mean((predicted - measured) ** 2)))
+
+        starts = [prior]
+        for step_seconds in write_costs:
+            for throttle_seconds in write_costs:
+                start = prior.copy()
+                start[PARAMS.index('step_seconds')] = step_seconds
+                start[PARAMS.index('throttle_seconds')] = throttle_seconds
+                starts.append(start)
+
+        fits = [self._fit(start, start, measured, iterations, ridge) for start in starts]
+        errors = [rms(params) for params in fits]
+        self.params = fits[int(np.argmin(errors))]
+        return min(errors)
+
+    def describe(self) -> dict:
+        """Parameters by name"""
+        return dict(zip(PARAMS, self.params.tolist()))
+
+    def save(self, filename: str):
+        """
+        Saves the parameters and recorded runs as json
+        :param filename: file to write
+        :return: None
+        """
+        with open(filename, 'w') as f:
+            json.dump({'params': self.describe(),
+                       'runs': [{'candidates': candidates.tolist(), 'seconds': seconds}
+                                for candidates, seconds in self.runs]}, f)
+        return
+
+    def load(self, filename: str):
+        """
+        Loads parameters and recorded runs saved by save()
+        :param filename: file to read
+        :return: None
+        """
+        with open(filename) as f:
+            saved = json.load(f)
+        self.params = np.array([saved['params'][name] for name in PARAMS], dtype=float)
+        self.runs = [(np.array(run['candidates'], dtype=float).reshape(-1, len(PARAMS)), run['seconds'])
+                     for run in saved['runs'][-self.max_runs:]]
+        return
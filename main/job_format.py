@@ -0,0 +1,135 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# job_format.py
+#
+# Binary job files for [x, y, e] command arrays. A job file is a 64
+# byte header followed by one little-endian float32 record per command,
+# so it can be memory mapped and handed straight to draw() or the
+# simulator without parsing or copying.
+#
+# Header layout (little-endian):
+#     magic          4s  b'FRST'
+#     version        H
+#     header size    H
+#     units          B   0 = mm, 1 = inch
+#     extruder       B   0 = unspecified, 1 = white, 2 = black
+#     tool offset    2d  [x, y] in units
+#     command count  Q
+#     checksum       I   crc32 of the records
+#
+# NECESSARY FOR USE:
+# numpy
+
+from collections import namedtuple
+import numpy as np
+import struct
+import zlib
+
+MAGIC = b'FRST'
+VERSION = 1
+HEADER_SIZE = 64
+HEADER_FORMAT = '<4sHHBB2xddQI'
+
+RECORD_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('e', '<f4')])
+
+UNITS = ('mm', 'inch')
+EXTRUDERS = (None, 'white', 'black')
+
+JobHeader = namedtuple('JobHeader', ['version', 'units', 'extruder', 'tool_offset', 'count', 'checksum'])
+
+
+def save_job(filename: str, commands: np.ndarray, units: str = 'mm', extruder: str = None,
+             tool_offset: tuple = (0, 0)) -> JobHeader:
+    """
+    Writes a command array to a binary job file
+    :param filename: job file to write
+    :param commands: [[x1, y1, e1], ...[xn, yn, en]] commands
+    :param units: 'mm' or 'inch'
+    :param extruder: 'white', 'black' or None
+    :param tool_offset: [x, y] offset of the extruder from the origin
+    :return: header that was written
+    """
+    commands = np.asarray(commands).reshape(-1, 3)
+    records = np.empty(len(commands), dtype=RECORD_DTYPE)
+    records['x'] = commands[:, 0]
+    records['y'] = commands[:, 1]
+    records['e'] = commands[:, 2]
+    payload = records.tobytes()
+
+    header = JobHeader(VERSION, units, extruder, (float(tool_offset[0]), float(tool_offset[1])),
+                       len(records), zlib.crc32(payload))
+    packed = struct.pack(HEADER_FORMAT, MAGIC, header.version, HEADER_SIZE, UNITS.index(units),
+                         EXTRUDERS.index(extruder), header.tool_offset[0], header.tool_offset[1],
+                         header.count, header.checksum)
+
+    with open(filename, 'wb') as f:
+        f.write(packed.ljust(HEADER_SIZE, b'\0'))
+        f.write(payload)
+
+    return header
+
+
+def read_header(filename: str) -> JobHeader:
+    """
+    Reads the header of a binary job file
+    :param filename: job file to read
+    :return: header of the job
+    """
+    with open(filename, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+
+    if len(raw) < struct.calcsize(HEADER_FORMAT):
+        raise ValueError('%s is too short to be a job file' % filename)
+    magic, version, header_size, units, extruder, offset_x, offset_y, count, checksum = \
+        struct.unpack_from(HEADER_FORMAT, raw)
+    if magic != MAGIC:
+        raise ValueError('%s is not a job file' % filename)
+    if version > VERSION or header_size != HEADER_SIZE:
+        raise ValueError('%s is job format version %d, only up to %d is supported' % (filename, version, VERSION))
+
+    return JobHeader(version, UNITS[units], EXTRUDERS[extruder], (offset_x, offset_y), count, checksum)
+
+
+def load_job(filename: str, verify: bool = False) -> tuple:
+    """
+    Opens a binary job file without reading the commands into memory
+    :param filename: job file to open
+    :param verify: check the checksum, which reads the whole file
+    :return: (header, commands) where commands is a read-only (n, 3)
+             float32 memory map of [[x1, y1, e1], ...[xn, yn, en]]
+    """
+    header = read_header(filename)
+    if header.count == 0:
+        return header, np.empty((0, 3), dtype='<f4')
+
+    records = np.memmap(filename, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(header.count,))
+    if verify and zlib.crc32(records) != header.checksum:
+        raise ValueError('%s failed its checksum' % filename)
+
+    # Every field is float32, so the records view as plain rows of 3
+    return header, records.view('<f4').reshape(header.count, 3)
+
+
+def csv_to_job(csv_file: str, job_file: str, **header) -> JobHeader:
+    """
+    Converts a coordinates csv (e.g. bgd_coordinates.csv) to a binary job file
+    :param csv_file: header-less csv of [x, y, e] rows
+    :param job_file: job file to write
+    :param header: units, extruder and tool_offset for save_job
+    :return: header that was written
+    """
+    commands = np.loadtxt(csv_file, delimiter=',', ndmin=2)[:, 0:3]
+    return save_job(job_file, commands, **header)
+
+
+def job_to_csv(job_file: str, csv_file: str):
+    """
+    Converts a binary job file to a header-less coordinates csv
+    :param job_file: job file to read
+    :param csv_file: csv to write
+    :return: None
+    """
+    _, commands = load_job(job_file, verify=True)
+    np.savetxt(csv_file, commands, delimiter=',')
+    return
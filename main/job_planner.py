@@ -0,0 +1,202 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# job_planner.py
+#
+# Merges the white background and black image of a cake into one plan.
+# Drawn as two separate jobs, each layer returns the gantry to the
+# corner when it finishes and the robot homes again before the second
+# one. Since the board tracks its position in steps and keeps a frame
+# for each extruder (see frosting_board.py), the plan homes once, goes
+# straight from the end of the white layer to the start of the black
+# one, and only returns to the corner at the very end.
+#
+# Each layer is split into regions: runs of extruding moves, each with
+# the travel move into it. Regions are reordered nearest first from
+# wherever the last one ended, and background rows can also be drawn
+# backwards. The new order is only kept if the motion planner expects
+# it to be faster than the order the layer came in: img_processing
+# already orders image contours with 2-opt, and background rows
+# joined by short hops draw faster than a shorter but more jagged tour.
+#
+# A plan is a list of phases, each a dict:
+#     name      'home', 'white', 'black' or 'park'
+#     tool      extruder the phase draws with, None for homing
+#     commands  [x, y, e] commands in the tool's frame, None for homing
+#     seconds   estimated time, from the motion planner's velocity profile
+#     moves, frosted_mm, travel_mm
+#
+# NECESSARY FOR USE:
+# numpy
+
+from motion_planner import MotionPlanner
+import numpy as np
+
+
+class JobPlanner:
+    def __init__(self, motion_planner: MotionPlanner, white_offset: np.ndarray = (0, 0),
+                 black_offset: np.ndarray = (20, 0), homing_seconds: float = 8):
+        """
+        Constructs a job planner
+        :param motion_planner: motion planner of the board, to estimate times with
+        :param white_offset: [x, y] mm from the carriage to the white nozzle's drawing origin
+        :param black_offset: [x, y] mm from the carriage to the black nozzle's drawing origin
+        :param homing_seconds: estimated time to home both axes
+        """
+        self.motion_planner = motion_planner
+        self.offsets = {'white': np.asarray(white_offset, dtype=float),
+                        'black': np.asarray(black_offset, dtype=float)}
+        self.homing_seconds = homing_seconds
+
+    @staticmethod
+    def regions(commands: np.ndarray, start: np.ndarray = None) -> list:
+        """
+        Splits commands into regions, each a run of extruding moves plus any
+        non-extruding moves that follow it before the next travel
+        :param commands: [[x1, y1, e1], ...[xn, yn, en]] coordinates in mm
+        :param start: [x, y] location before the first move, defaults to [0, 0]
+        :return: list of (points, e) where points is the (m + 1, 2) path of the
+                 region from where its first extruding move starts, and e the m
+                 extruder values of its moves
+        """
+        commands = np.asarray(commands, dtype=float).reshape(-1, 3)
+        if start is None:
+            start = np.zeros(2)
+        points = np.vstack((np.asarray(start, dtype=float)[np.newaxis, :], commands[:, 0:2]))
+        e = commands[:, 2]
+
+        # Drop the return to the origin added at the end of each layer
+        if len(e) and e[-1] == 0 and not np.any(commands[-1, 0:2]):
+            points, e = points[:-1], e[:-1]
+
+        extruding = e > 0
+        firsts = np.flatnonzero(extruding & ~np.concatenate(([False], extruding[:-1])))
+        lasts = np.concatenate((firsts[1:] - 1, [len(e)]))   # next region's travel move is dropped
+        return [(points[first:last + 1], e[first:last]) for first, last in zip(firsts, lasts)]
+
+    def _seconds(self, regions: list, start: np.ndarray) -> float:
+        """Estimated time to draw regions in order from start"""
+        return float(np.sum(self.motion_planner.profile(self.commands(regions), start)[4]))
+
+    def order_regions(self, regions: list, start: np.ndarray, reversible: bool = False) -> list:
+        """
+        Orders regions nearest first, keeping the original order if it is faster
+        :param regions: regions from regions()
+        :param start: [x, y] location before the first region
+        :param reversible: whether regions may be drawn backwards
+        :return: regions in drawing order, each reversed if it is drawn backwards
+        """
+        if len(regions) < 2:
+            return regions
+        start = np.asarray(start, dtype=float)
+        entries = np.array([points[0] for points, _ in regions])
+        exits = np.array([points[-1] for points, _ in regions])
+
+        left = np.ones(len(regions), dtype=bool)
+        ordered = []
+        here = start
+        for _ in range(len(regions)):
+            to_entry = np.where(left, np.hypot(*(entries - here).T), np.inf)
+            to_exit = np.where(left, np.hypot(*(exits - here).T), np.inf) if reversible else to_entry + np.inf
+            best = int(np.argmin(np.minimum(to_entry, to_exit)))
+            left[best] = False
+            points, e = regions[best]
+            if to_exit[best] < to_entry[best]:
+                points, e = points[::-1], e[::-1]
+            ordered.append((points, e))
+            here = points[-1]
+
+        return ordered if self._seconds(ordered, start) < self._seconds(regions, start) else regions
+
+    @staticmethod
+    def commands(regions: list) -> np.ndarray:
+        """
+        Joins regions back into commands, with a travel move into each
+        :param regions: regions from regions() or order_regions()
+        :return: [[x1, y1, e1], ...[xn, yn, en]] coordinates in mm
+        """
+        pieces = []
+        for points, e in regions:
+            pieces.append(np.column_stack((points, np.concatenate(([0], e)))))
+        return np.concatenate(pieces) if pieces else np.zeros((0, 3))
+
+    def estimate(self, commands: np.ndarray, tool: str, start: np.ndarray) -> dict:
+        """
+        Estimates time and distances of drawing commands with a tool
+        :param commands: [x, y, e] commands in the tool's frame
+        :param tool: 'white' or 'black'
+        :param start: [x, y] carriage position in mm before the first move
+        :return: {'seconds', 'moves', 'frosted_mm', 'travel_mm'}
+        """
+        if len(commands) == 0:
+            return {'seconds': 0.0, 'moves': 0, 'frosted_mm': 0.0, 'travel_mm': 0.0}
+        machine = np.array(commands, dtype=float)
+        machine[:, 0:2] += self.offsets[tool]
+        lengths, _, _, _, durations = self.motion_planner.profile(machine, start)
+        extruding = machine[:, 2] > 0
+        return {'seconds': float(np.sum(durations)),
+                'moves': len(commands),
+                'frosted_mm': float(np.sum(lengths[extruding])),
+                'travel_mm': float(np.sum(lengths[~extruding]))}
+
+    def plan(self, white: np.ndarray, black: np.ndarray) -> list:
+        """
+        Plans a cake: home once, the white layer, the black layer, then back to the corner
+        :param white: background [x, y, e] commands in the white frame
+        :param black: image [x, y, e] commands in the black frame
+        :return: list of phases
+        """
+        phases = [{'name': 'home', 'tool': None, 'commands': None, 'seconds': self.homing_seconds,
+                   'moves': 0, 'frosted_mm': 0.0, 'travel_mm': 0.0}]
+        carriage = np.zeros(2)
+
+        for tool, commands, reversible in (('white', white, True), ('black', black, False)):
+            offset = self.offsets[tool]
+            regions = self.regions(commands, carriage - offset)
+            regions = self.order_regions(regions, carriage - offset, reversible)
+            commands = self.commands(regions)
+            phase = {'name': tool, 'tool': tool, 'commands': commands}
+            phase.update(self.estimate(commands, tool, carriage))
+            phases.append(phase)
+            if len(commands):
+                carriage = commands[-1, 0:2] + offset
+
+        # One return to the corner at the end, to unload the cake
+        park = np.zeros((1, 3))
+        park[0, 0:2] = -self.offsets['black']
+        phase = {'name': 'park', 'tool': 'black', 'commands': park}
+        phase.update(self.estimate(park, 'black', carriage))
+        phases.append(phase)
+        return phases
+
+    def separate_seconds(self, white: np.ndarray, black: np.ndarray) -> float:
+        """
+        Estimated time to draw the layers as two separate jobs, homing before
+        each and returning to the corner after each, to compare plans against
+        """
+        seconds = 2 * self.homing_seconds
+        for tool, commands in (('white', white), ('black', black)):
+            commands = np.asarray(commands, dtype=float).reshape(-1, 3)
+            if len(commands) and (commands[-1, 2] != 0 or np.any(commands[-1, 0:2])):
+                commands = np.vstack((commands, np.zeros(3)))
+            seconds += self.estimate(commands, tool, self.offsets[tool])['seconds']
+        return seconds
+
+
+def report(phases: list, separate_seconds: float = None) -> str:
+    """
+    Table of the phases of a plan and their estimated times
+    :param phases: plan from JobPlanner.plan
+    :param separate_seconds: estimate for separate jobs from JobPlanner.separate_seconds, to show the saving
+    :return: printable table
+    """
+    lines = ['%-6s %7s %10s %10s %8s' % ('phase', 'moves', 'frosted mm', 'travel mm', 'seconds')]
+    for phase in phases:
+        lines.append('%-6s %7d %10.0f %10.0f %8.1f' % (phase['name'], phase['moves'], phase['frosted_mm'],
+                                                       phase['travel_mm'], phase['seconds']))
+    total = sum(phase['seconds'] for phase in phases)
+    lines.append('%-6s %38.1f' % ('total', total))
+    if separate_seconds is not None:
+        lines.append('Saves %.1f s over drawing the layers as separate jobs (%.1f s).'
+                     % (separate_seconds - total, separate_seconds))
+    return '\n'.join(lines)
@@ -0,0 +1,254 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# job_scheduler.py
+#
+# Keeps a queue of cake orders from the Airtable image table and
+# prepares their toolpaths in a worker process while the robot frosts
+# the current cake, so the next cake can start as soon as the last one
+# is unloaded.
+#
+# Each order is a Job that moves through these states:
+#     queued     waiting to be prepared
+#     preparing  image being downloaded and processed in a worker
+#     ready      toolpaths ready to frost
+#     frosting   on the robot
+#     done       frosted
+#     failed     preparing or frosting it raised an error
+# The state of every job is printed when it changes and written to a
+# json status file.
+#
+# An order's 'Mode' field picks how its image is traced: 'outline'
+# (default) for filled shapes or 'centerline' for line drawings and
+# text, see img_processing.__getImg.
+#
+# Example:
+#     scheduler = JobScheduler(connectAirtable())
+#     job = scheduler.next_job()
+#     ... frost job.bgd and job.img ...
+#     scheduler.finish(job)
+#
+# NECESSARY FOR USE:
+# numpy
+# requests
+
+from concurrent.futures import ProcessPoolExecutor
+from img_processing import prepareToolpath
+from toolpath_cache import ToolpathCache
+import json
+import os
+import threading
+import time
+
+STATES = ('queued', 'preparing', 'ready', 'frosting', 'done', 'failed')
+
+
+def prepare_job(attachment: dict, cache_dir: str = None, mode: str = 'outline') -> tuple:
+    """
+    Prepares the toolpaths of an order. Runs in a worker process
+    :param attachment: Airtable image attachment
+    :param cache_dir: ToolpathCache directory, or None to not cache
+    :param mode: 'outline' or 'centerline'
+    :return: (bgd, img) coordinates from img_processing.prepareToolpath
+    """
+    cache = None if cache_dir is None else ToolpathCache(cache_dir)
+    return prepareToolpath(attachment, cache, mode)
+
+
+class Job:
+    def __init__(self, record: dict):
+        """
+        Constructs a job for an order
+        :param record: Airtable record from the image table
+        """
+        self.id = record['id']
+        self.created = record['fields'].get('Created')
+        self.attachment = record['fields']['Image'][0]
+        self.mode = str(record['fields'].get('Mode') or 'outline').lower()
+        self.state = 'queued'
+        self.times = {'queued': time.time()}
+        self.error = None
+        self.future = None
+        self.bgd = None
+        self.img = None
+
+    def describe(self) -> dict:
+        return {'id': self.id,
+                'created': self.created,
+                'image': self.attachment.get('filename', self.attachment['url']),
+                'mode': self.mode,
+                'state': self.state,
+                'times': self.times,
+                'error': None if self.error is None else repr(self.error)}
+
+
+class JobScheduler:
+    def __init__(self, poller, cache_dir: str = 'toolpath_cache', workers: int = 1, lookahead: int = 2,
+                 backlog: bool = False, status_file: str = 'jobs.json', poll_interval: float = 2.0):
+        """
+        Constructs a job scheduler
+        :param poller: AirtablePoller to read orders with
+        :param cache_dir: ToolpathCache directory shared with the workers, or None to not cache
+        :param workers: worker processes preparing toolpaths
+        :param lookahead: most jobs prepared ahead of the one being frosted
+        :param backlog: queue every order already in the table at start. Otherwise
+                        only the latest one is, like frosting one cake at a time
+        :param status_file: json file to write job states to, or None
+        :param poll_interval: seconds between polls for new orders while waiting for one
+        """
+        self.poller = poller
+        self.cache_dir = cache_dir
+        self.lookahead = lookahead
+        self.backlog = backlog
+        self.status_file = status_file
+        self.poll_interval = poll_interval
+
+        self.jobs = {}      # id -> Job, in the order they were queued
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.pool = ProcessPoolExecutor(workers)
+        self._polled = False
+        self._closed = False
+
+    def poll(self) -> list:
+        """
+        Queues new orders from the image table and starts preparing upcoming jobs
+        :return: jobs queued by this poll
+        """
+        records = [record for record in self.poller.image_records() if record['fields'].get('Image')]
+        if not self._polled and not self.backlog:
+            # Orders placed before starting are already frosted, except the latest
+            with self.lock:
+                for record in records[:-1]:
+                    self.jobs.setdefault(record['id'], None)
+        self._polled = True
+
+        new = []
+        with self.lock:
+            for record in records:
+                if record['id'] not in self.jobs:
+                    job = self.jobs[record['id']] = Job(record)
+                    new.append(job)
+                    self._report(job)
+
+        self._prepare_ahead()
+        return new
+
+    def _prepare_ahead(self):
+        """Submits queued jobs to the workers, up to lookahead jobs ahead."""
+        with self.lock:
+            if self._closed:
+                return
+            upcoming = self._upcoming()
+            to_start = [job for job in upcoming[:self.lookahead] if job.state == 'queued']
+            for job in to_start:
+                self._set_state(job, 'preparing')
+                job.future = self.pool.submit(prepare_job, job.attachment, self.cache_dir, job.mode)
+        for job in to_start:
+            job.future.add_done_callback(lambda future, job=job: self._prepared(job, future))
+        return
+
+    def _prepared(self, job: Job, future):
+        """Stores a job's toolpaths once its worker finishes."""
+        with self.lock:
+            try:
+                job.bgd, job.img = future.result()
+                self._set_state(job, 'ready')
+                failed = False
+            except Exception as e:
+                job.error = e
+                self._set_state(job, 'failed')
+                failed = True
+            self.changed.notify_all()
+        if failed:
+            # The failed job no longer counts towards the lookahead, so start the next one
+            self._prepare_ahead()
+        return
+
+    def _upcoming(self) -> list:
+        """Jobs not frosted yet, oldest first. Call with the lock held"""
+        return [job for job in self.jobs.values()
+                if job is not None and job.state in ('queued', 'preparing', 'ready')]
+
+    def _set_state(self, job: Job, state: str):
+        """Moves a job to a new state. Call with the lock held"""
+        job.state = state
+        job.times[state] = time.time()
+        self._report(job)
+        return
+
+    def next_job(self, timeout: float = None) -> Job:
+        """
+        Waits for the oldest upcoming job to be ready and marks it frosting.
+        Jobs that failed to prepare are skipped.
+        :param timeout: seconds to wait, forever if None
+        :return: Job with bgd and img coordinates, or None on timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self.lock:
+                upcoming = self._upcoming()
+                if upcoming and upcoming[0].state == 'ready':
+                    job = upcoming[0]
+                    self._set_state(job, 'frosting')
+                    break
+
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return None
+            if not upcoming:
+                self.poll()
+            with self.lock:
+                upcoming = self._upcoming()
+                if not upcoming or upcoming[0].state != 'ready':
+                    self.changed.wait(self.poll_interval if remaining is None
+                                      else min(self.poll_interval, remaining))
+
+        self._prepare_ahead()
+        return job
+
+    def finish(self, job: Job, error: Exception = None):
+        """
+        Marks a job frosted, or failed if error is given, and frees its toolpaths
+        :param job: job from next_job()
+        :param error: what went wrong while frosting, if anything did
+        :return: None
+        """
+        with self.lock:
+            job.error = error
+            self._set_state(job, 'done' if error is None else 'failed')
+            job.bgd = job.img = None
+        return
+
+    def summary(self) -> str:
+        """One line per job with its state"""
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if job is not None]
+        lines = []
+        for job in jobs:
+            if job.state == 'failed' and 'ready' not in job.times:
+                preparing = 'failed to prepare after %.1f s' % (job.times['failed'] - job.times['queued'])
+            else:
+                preparing = '%.1f s to prepare' % (job.times.get('ready', time.time()) - job.times['queued'])
+            lines.append('%-12s %-10s %-24s %s%s'
+                         % (job.id, job.state, job.describe()['image'], preparing,
+                            '' if job.error is None else ' (%r)' % job.error))
+        return '\n'.join(lines)
+
+    def _report(self, job: Job):
+        """Shows a job's new state and updates the status file. Call with the lock held"""
+        print('Job %s: %s' % (job.id, job.state))
+        if self.status_file is None:
+            return
+        status = [job.describe() for job in self.jobs.values() if job is not None]
+        with open(self.status_file + '.tmp', 'w') as f:
+            json.dump(status, f, indent=2)
+        os.replace(self.status_file + '.tmp', self.status_file)
+        return
+
+    def close(self):
+        """Stops the workers, cancelling jobs that haven't started preparing"""
+        with self.lock:
+            self._closed = True
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        return
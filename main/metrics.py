@@ -0,0 +1,282 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# metrics.py
+#
+# Counters, gauges and timing histograms for the motion loop: I2C
+# latency of every step and throttle write, time per move, planned
+# versus achieved step rate and time spent homing.
+#
+# Everything is recorded in one registry, REGISTRY. Recording is a
+# couple of additions per call, and callers check REGISTRY.enabled
+# before timing anything, so with metrics switched off (set
+# FROSTING_METRICS=0, or call REGISTRY.disable()) the hot path only pays
+# for one attribute lookup.
+#
+# Metrics can be printed as a timing report, written to a file as JSON
+# or Prometheus text, or served over HTTP for Prometheus to scrape.
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import json
+import os
+import threading
+import time
+
+# Upper bounds in seconds, from I2C writes (~1 ms) up to whole drawings
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+        return
+
+    def reset(self):
+        self.value = 0
+        return
+
+    def snapshot(self) -> dict:
+        return {'value': self.value}
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float):
+        self.value = value
+        return
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.reset()
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        return
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)   # last is above every bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        return
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q quantile"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {'count': self.count,
+                'sum': self.sum,
+                'max': self.max,
+                'buckets': dict(zip(map(str, self.buckets), self.counts))}
+
+
+class MetricsRegistry:
+    def __init__(self, enabled: bool = True):
+        """
+        Constructs a metrics registry
+        :param enabled: whether callers should record metrics
+        """
+        self.enabled = enabled
+        self.metrics = {}   # (name, labels) -> metric
+        self.help = {}      # name -> description
+        self.started = time.time()
+        self._server = None
+
+    def enable(self):
+        self.enabled = True
+        return
+
+    def disable(self):
+        self.enabled = False
+        return
+
+    def _get(self, cls, name: str, description: str, labels: dict, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            metric = self.metrics[key] = cls(**kwargs)
+            self.help.setdefault(name, description)
+        return metric
+
+    def counter(self, name: str, description: str = '', **labels) -> Counter:
+        """
+        Gets or creates a counter
+        :param name: metric name, e.g. frosting_steps_total
+        :param description: help text for the metric
+        :param labels: labels telling apart metrics with the same name, e.g. axis='x'
+        :return: Counter
+        """
+        return self._get(Counter, name, description, labels)
+
+    def gauge(self, name: str, description: str = '', **labels) -> Gauge:
+        """Gets or creates a gauge, see counter()"""
+        return self._get(Gauge, name, description, labels)
+
+    def histogram(self, name: str, description: str = '', buckets: tuple = DEFAULT_BUCKETS,
+                  **labels) -> Histogram:
+        """Gets or creates a histogram of values in seconds, see counter()"""
+        return self._get(Histogram, name, description, labels, buckets=buckets)
+
+    @contextmanager
+    def timed(self, name: str, description: str = '', **labels):
+        """
+        Times the body of a with block into a histogram, if metrics are enabled
+            with REGISTRY.timed('frosting_draw_seconds'):
+                ...
+        """
+        if not self.enabled:
+            yield
+            return
+        histogram = self.histogram(name, description, **labels)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    def reset(self):
+        """Zeroes every metric, e.g. at the start of a job"""
+        for metric in self.metrics.values():
+            metric.reset()
+        self.started = time.time()
+        return
+
+    def snapshot(self) -> dict:
+        """
+        Current value of every metric
+        :return: {name: [{'labels': {...}, 'type': ..., values...}, ...]}
+        """
+        snapshot = {}
+        for (name, labels), metric in sorted(self.metrics.items()):
+            entry = {'labels': dict(labels), 'type': metric.kind}
+            entry.update(metric.snapshot())
+            snapshot.setdefault(name, []).append(entry)
+        return snapshot
+
+    def to_json(self) -> str:
+        return json.dumps({'started': self.started, 'metrics': self.snapshot()}, indent=2)
+
+    def to_prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+        for name, entries in self.snapshot().items():
+            if self.help.get(name):
+                lines.append('# HELP %s %s' % (name, self.help[name]))
+            lines.append('# TYPE %s %s' % (name, entries[0]['type']))
+            for entry in entries:
+                labels = entry['labels']
+                if entry['type'] != 'histogram':
+                    lines.append('%s%s %s' % (name, _labels(labels), entry['value']))
+                    continue
+                cumulative = 0
+                for bound, count in entry['buckets'].items():
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, _labels(labels, le=bound), cumulative))
+                lines.append('%s_bucket%s %d' % (name, _labels(labels, le='+Inf'), entry['count']))
+                lines.append('%s_sum%s %r' % (name, _labels(labels), entry['sum']))
+                lines.append('%s_count%s %d' % (name, _labels(labels), entry['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename: str):
+        """
+        Writes metrics to a file, as Prometheus text if it ends in .prom, otherwise as JSON
+        :param filename: file to write
+        :return: None
+        """
+        text = self.to_prometheus() if filename.endswith('.prom') else self.to_json()
+        with open(filename + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(filename + '.tmp', filename)
+        return
+
+    def report(self) -> str:
+        """
+        Timing report of every histogram, for printing at the end of a job
+        :return: table of count, total, mean, p50, p99 and max for each timing
+        """
+        rows = [('timing', 'count', 'total s', 'mean ms', 'p50 ms', 'p99 ms', 'max ms')]
+        for (name, labels), metric in sorted(self.metrics.items()):
+            if metric.kind != 'histogram' or metric.count == 0:
+                continue
+            rows.append((name + _labels(dict(labels)), str(metric.count), '%.3f' % metric.sum,
+                         '%.3f' % (1000 * metric.sum / metric.count),
+                         '%.3f' % (1000 * metric.quantile(0.5)),
+                         '%.3f' % (1000 * metric.quantile(0.99)),
+                         '%.3f' % (1000 * metric.max)))
+        for (name, labels), metric in sorted(self.metrics.items()):
+            if metric.kind != 'histogram':
+                rows.append((name + _labels(dict(labels)), '%g' % metric.value, '', '', '', '', ''))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+                         for row in rows)
+
+    def serve(self, port: int = 9135, host: str = ''):
+        """
+        Serves metrics over HTTP from a background thread: Prometheus text at
+        /metrics and JSON at /metrics.json
+        :param port: port to listen on
+        :param host: address to listen on, all interfaces by default
+        :return: the HTTP server, call shutdown() on it to stop
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics.json':
+                    body, content_type = registry.to_json(), 'application/json'
+                elif self.path == '/metrics':
+                    body, content_type = registry.to_prometheus(), 'text/plain; version=0.0.4'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+
+def _labels(labels: dict, **extra) -> str:
+    """Prometheus label string, e.g. {axis="x",le="0.001"}"""
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % item for item in labels.items()) + '}'
+
+
+REGISTRY = MetricsRegistry(enabled=os.environ.get('FROSTING_METRICS', '1') != '0')
@@ -0,0 +1,154 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# motion_planner.py
+#
+# Plans timed step schedules for a whole drawing. Each segment gets a
+# trapezoidal velocity profile, with entry and exit speeds limited by
+# the acceleration and by the angle of the junction with the next
+# segment (lookahead over the full command array), so long straight
+# rows can cruise fast while corners slow down enough not to lose steps.
+#
+# A step schedule is a structured array, one row per step iteration:
+#     t  seconds since the start of the schedule to take the step
+#     x  x step direction (-1, 0, 1)
+#     y  y step direction (-1, 0, 1)
+#     e  extruder value of the command being drawn
+#
+# NECESSARY FOR USE:
+# numpy
+
+from step_planner import plan_path
+import numpy as np
+
+SCHEDULE_DTYPE = np.dtype([('t', 'f8'), ('x', 'i1'), ('y', 'i1'), ('e', 'f4')])
+
+
+class MotionPlanner:
+    def __init__(self, x_steps_per_mm: float, y_steps_per_mm: float, max_speed: float = 30,
+                 acceleration: float = 150, junction_deviation: float = 0.05):
+        """
+        Constructs a motion planner
+        :param x_steps_per_mm: steps per mm on the x axis
+        :param y_steps_per_mm: steps per mm on the y axis
+        :param max_speed: cruise speed in mm/s
+        :param acceleration: acceleration and deceleration in mm/s^2
+        :param junction_deviation: mm the path may deviate from a sharp corner
+                                   at speed. Bigger means faster cornering
+        """
+        self.x_steps_per_mm = x_steps_per_mm
+        self.y_steps_per_mm = y_steps_per_mm
+        self.max_speed = max_speed
+        self.acceleration = acceleration
+        self.junction_deviation = junction_deviation
+
+    def junction_speeds(self, deltas: np.ndarray) -> np.ndarray:
+        """
+        Maximum speed through each junction between segments.
+        The first and last junctions are 0, starting and ending at rest.
+        :param deltas: [[dx1, dy1], ...[dxn, dyn]] segment displacements in mm
+        :return: n + 1 junction speeds in mm/s
+        """
+        lengths = np.hypot(deltas[:, 0], deltas[:, 1])
+        speeds = np.zeros(len(deltas) + 1)
+        if len(deltas) < 2:
+            return speeds
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            unit = deltas / lengths[:, np.newaxis]
+            # cosine of the angle between the incoming and outgoing directions, reversed
+            cos_theta = -np.sum(unit[:-1] * unit[1:], axis=1)
+            cos_theta = np.clip(cos_theta, -1, 1)
+            sin_half = np.sqrt((1 - cos_theta) / 2)
+            speeds[1:-1] = np.sqrt(self.acceleration * self.junction_deviation * sin_half / (1 - sin_half))
+
+        # Straight through is limited only by cruise speed, zero length segments stop
+        speeds[1:-1][cos_theta <= -1] = self.max_speed
+        speeds[1:-1][~np.isfinite(speeds[1:-1])] = 0
+        return np.minimum(speeds, self.max_speed)
+
+    def profile(self, commands: np.ndarray, start: np.ndarray = None) -> tuple:
+        """
+        Plans the trapezoidal velocity profile of every segment.
+        :param commands: [[x1, y1, e1], ...[xn, yn, en]] coordinates in mm
+        :param start: [x, y] location before the first move, defaults to [0, 0]
+        :return: (lengths, v_entry, v_cruise, v_exit, durations) arrays, one value per segment
+        """
+        if start is None:
+            start = np.zeros(2)
+        targets = np.asarray(commands, dtype=float)[:, 0:2]
+        deltas = np.diff(np.vstack((np.asarray(start, dtype=float)[np.newaxis, :], targets)), axis=0)
+        lengths = np.hypot(deltas[:, 0], deltas[:, 1])
+        a = self.acceleration
+
+        # Lookahead: make every junction reachable from both of its neighbours
+        speeds = self.junction_speeds(deltas)
+        for k in range(len(lengths) - 1, -1, -1):
+            speeds[k] = min(speeds[k], np.sqrt(speeds[k + 1] ** 2 + 2 * a * lengths[k]))
+        for k in range(len(lengths)):
+            speeds[k + 1] = min(speeds[k + 1], np.sqrt(speeds[k] ** 2 + 2 * a * lengths[k]))
+
+        v_entry = speeds[:-1]
+        v_exit = speeds[1:]
+        v_cruise = np.minimum(self.max_speed, np.sqrt((2 * a * lengths + v_entry ** 2 + v_exit ** 2) / 2))
+
+        accel_time = (v_cruise - v_entry) / a
+        decel_time = (v_cruise - v_exit) / a
+        cruise_dist = lengths - (v_cruise ** 2 - v_entry ** 2) / (2 * a) - (v_cruise ** 2 - v_exit ** 2) / (2 * a)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cruise_time = np.where(v_cruise > 0, np.clip(cruise_dist, 0, None) / v_cruise, 0)
+        durations = accel_time + cruise_time + decel_time
+
+        return lengths, v_entry, v_cruise, v_exit, durations
+
+    def time_at(self, s: np.ndarray, lengths: np.ndarray, v_entry: np.ndarray, v_cruise: np.ndarray,
+                v_exit: np.ndarray) -> np.ndarray:
+        """
+        Time taken to travel distance s into a segment with the given trapezoid.
+        All arguments are arrays of the same length, as returned by profile().
+        :param s: distance travelled into the segment in mm
+        :return: seconds since the start of each segment
+        """
+        a = self.acceleration
+        accel_dist = (v_cruise ** 2 - v_entry ** 2) / (2 * a)
+        decel_dist = (v_cruise ** 2 - v_exit ** 2) / (2 * a)
+        decel_start = accel_dist + np.clip(lengths - accel_dist - decel_dist, 0, None)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t_accel = (np.sqrt(v_entry ** 2 + 2 * a * np.minimum(s, accel_dist)) - v_entry) / a
+            t_cruise = np.where(v_cruise > 0, np.clip(np.minimum(s, decel_start) - accel_dist, 0, None) / v_cruise, 0)
+            v_decel = np.sqrt(np.clip(v_cruise ** 2 - 2 * a * np.clip(s - decel_start, 0, None), 0, None))
+            t_decel = (v_cruise - v_decel) / a
+        return t_accel + t_cruise + t_decel
+
+    def plan(self, commands: np.ndarray, start: np.ndarray = None) -> np.ndarray:
+        """
+        Plans the timed step schedule for a drawing of the format:
+            [[x1, y1, e1],
+             [x2, y2, e2],
+             ...
+             [xn, yn, en]]
+        :param commands: Coordinates and extruder values
+        :param start: [x, y] location before the first move, defaults to [0, 0]
+        :return: step schedule with SCHEDULE_DTYPE
+        """
+        commands = np.asarray(commands, dtype=float)
+        steps, offsets = plan_path(commands, self.x_steps_per_mm, self.y_steps_per_mm, start)
+        lengths, v_entry, v_cruise, v_exit, durations = self.profile(commands, start)
+
+        segment_start = np.zeros(len(durations))
+        np.cumsum(durations[:-1], out=segment_start[1:])
+
+        # Distance along its segment at which each step iteration finishes
+        counts = np.diff(offsets)
+        move = np.repeat(np.arange(len(counts)), counts)
+        fraction = (np.arange(len(steps)) - offsets[move] + 1) / counts[move]
+        s = fraction * lengths[move]
+
+        schedule = np.empty(len(steps), dtype=SCHEDULE_DTYPE)
+        schedule['t'] = segment_start[move] + self.time_at(s, lengths[move], v_entry[move],
+                                                           v_cruise[move], v_exit[move])
+        schedule['x'] = steps[:, 0]
+        schedule['y'] = steps[:, 1]
+        schedule['e'] = commands[move, 2]
+        return schedule
@@ -6,135 +6,157 @@
 # This script intends to simulate the robots movements given
 # an image uploaded to the airtable.
 
+import os
+import sys
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
-from main.img_processing import run as run_img_processing
 
+# The robot scripts import each other from main/, so run them the same way
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from img_processing import run as run_img_processing
+from img_processing import simplifyContours
+from step_planner import plan_step_counts, position_steps
 
-def x_y_move(loc: np.ndarray, dx: float, dy: float, x_steps_per_mm, y_steps_per_mm):
+
+def simulate(path: np.ndarray, x_steps_per_mm: int, y_steps_per_mm: int) -> tuple:
     """
-    Moves x and y stepper motors linearly a
-    distance dx and dy respectively, at speed
-    speed, which is total speed over the distance
-    d = sqrt(dx^2 + dy^2)
-    :param dy: distance to move in y (can be negative)
-    :param dx: distance to move in x (can be negative)
-    :return: None
+    Simulates a drawing in one pass. Each move ends at the nearest whole step
+    to its target, like FrostingMainBoard, so err is at most half a step per axis
+    :param path: [[x1, y1, ...], ...[xn, yn, ...]] coordinates in mm
+    :param x_steps_per_mm: steps per mm on the x axis
+    :param y_steps_per_mm: steps per mm on the y axis
+    :return: (trace, pos, err) where trace is the [x, y] location after every
+             step loop iteration, pos is the location after each move and err
+             is the distance from each target to where the move ended
     """
+    path = np.asarray(path, dtype=float)
+    steps_per_mm = np.array((x_steps_per_mm, y_steps_per_mm))
 
-    stepsX = []
-    stepsY = []
+    positions = np.column_stack((position_steps(path[:, 0], x_steps_per_mm),
+                                 position_steps(path[:, 1], y_steps_per_mm)))
+    plan, _ = plan_step_counts(np.diff(positions, axis=0, prepend=0))
 
-    if dx > 0:
-        dir_x = 1
-    elif dx < 0:
-        dir_x = -1
-    else:
-        dir_x = 0
+    trace = np.cumsum(plan, axis=0) / steps_per_mm
+    pos = positions / steps_per_mm
+    err = np.hypot(path[:, 0] - pos[:, 0], path[:, 1] - pos[:, 1])
+
+    return trace, pos, err
 
-    if dy > 0:
-        dir_y = 1
-    elif dy < 0:
-        dir_y = -1
-    else:
-        dir_y = 0
-
-    # Calculate number of steps needed to go in x and y
-    steps_x = int(abs(dx) * x_steps_per_mm)
-    steps_y = int(abs(dy) * y_steps_per_mm)
-
-    # Within the loop iteration, interlace x and y steps using lcm of step counts
-    if steps_x > 0 and steps_y > 0:
-        iter_lcm = np.lcm(steps_x, steps_y)
-        x_mod = iter_lcm // steps_x
-        y_mod = iter_lcm // steps_y
-    elif steps_x == 0:
-        iter_lcm = steps_y
-        x_mod = 0.1  # will never trigger
-        y_mod = 1
-    elif steps_y == 0:
-        iter_lcm = steps_x
-        x_mod = 1
-        y_mod = 0.1  # will never trigger
-    else:
-        iter_lcm = 0
-        x_mod = 1
-        y_mod = 1
-
-    print('On this move with, dx: %s, dy: %s' % (str(dx), str(dy)))
-    print(' steps x, y ## %d %d steps/iter x, y ##'
-          % (steps_x, steps_y))
-
-    for j in np.arange(1, iter_lcm + 1, 1):
-        step_x = j % x_mod == 0
-        step_y = j % y_mod == 0
-        if step_x and step_y:
-            loc[0] = loc[0] + (dir_x / x_steps_per_mm)
-            loc[1] = loc[1] + (dir_y / y_steps_per_mm)
-        elif step_x:
-            loc[0] = loc[0] + (dir_x / x_steps_per_mm)
-        elif step_y:
-            loc[1] = loc[1] + (dir_y / y_steps_per_mm)
-        else:
-            pass
-        stepsX.append(loc[0])
-        stepsY.append(loc[1])
-
-    return loc, stepsX, stepsY
-
-
-def sim_frosting(path: np.ndarray, x_steps_per_mm: int, y_steps_per_mm: int):
-    pos = np.empty(np.shape(path))
-    loc = np.zeros(2)
-    pos[0, :] = loc
-
-    stepsX_all = []
-    stepsY_all = []
-
-    # Simulation loop
-    for i in range(len(pos)):
-        dx = path[i, 0] - loc[0]
-        dy = path[i, 1] - loc[1]
-        new_loc, stepsX, stepsY = x_y_move(loc, dx, dy, x_steps_per_mm, y_steps_per_mm)
-        pos[i, :] = new_loc
-        loc = new_loc
-        stepsX_all = stepsX_all + stepsX
-        stepsY_all = stepsY_all + stepsY
-
-    # Data processing and plotting
-    num = [i for i in range(len(path))]
-    err = [np.sqrt((path[i, 0] - pos[i, 0]) ** 2 + (path[i, 1] - pos[i, 1]) ** 2) for i in range(len(path))]
 
+def plot_simulation(path: np.ndarray, trace: np.ndarray, pos: np.ndarray, err: np.ndarray,
+                    steps_per_mm: int, filename: str = None, max_trace_points: int = 200000):
+    """
+    Plots the desired path against the simulation, the steps taken and the error
+    :param path: [[x1, y1, ...], ...[xn, yn, ...]] coordinates in mm
+    :param trace: location after every step loop iteration, from simulate()
+    :param pos: location after each move, from simulate()
+    :param err: error after each move, from simulate()
+    :param steps_per_mm: steps per mm, for the title
+    :param filename: file to save the plot to (e.g. a png). Shows it if None
+    :param max_trace_points: most step trace points to plot
+    :return: None
+    """
     fig, (ax1, ax2, ax3) = plt.subplots(1, 3)
     fig.set_size_inches(12, 4)
 
     ax1.plot(path[:, 0], path[:, 1])
     ax1.plot(pos[:, 0], pos[:, 1])
-    ax1.set_title('Stepper desired path vs simulation: %s steps/mm' % str(x_steps_per_mm))
+    ax1.set_title('Stepper desired path vs simulation: %s steps/mm' % str(steps_per_mm))
     ax1.set_xlabel('X position (mm)')
     ax1.set_ylabel('Y position (mm)')
-    ax1.legend(['desired path', 'Simulated result'])
+    ax1.legend(['desired path', 'Simulated result'], loc='upper right')
 
-    ax2.plot(stepsX_all, stepsY_all, color='k')
+    # Thin out long step traces, they are too dense to see every step anyway
+    stride = max(1, len(trace) // max_trace_points)
+    ax2.plot(trace[::stride, 0], trace[::stride, 1], color='k')
     ax2.set_title('Steps on Path')
     ax2.set_xlabel('X position (mm)')
     ax2.set_ylabel('Y position (mm)')
-    ax2.legend(['Individual Steps', 'Loop Iterations'])
+    ax2.legend(['Individual Steps', 'Loop Iterations'], loc='upper right')
 
     ax3.set_title('Error vs movement')
     ax3.set_xlabel('Movement #')
     ax3.set_ylabel('Absolute error (mm)')
-    ax3.plot(num, err, 'r')
-    plt.show()
+    ax3.plot(np.arange(len(err)), err, 'r')
+
+    if filename is None:
+        plt.show()
+    else:
+        fig.savefig(filename)
+        plt.close(fig)
+
+
+def sim_frosting(path: np.ndarray, x_steps_per_mm: int, y_steps_per_mm: int, filename: str = None,
+                 plot: bool = True) -> tuple:
+    """
+    Simulates a drawing and plots the result
+    :param path: [[x1, y1, ...], ...[xn, yn, ...]] coordinates in mm
+    :param x_steps_per_mm: steps per mm on the x axis
+    :param y_steps_per_mm: steps per mm on the y axis
+    :param filename: file to save the plot to. Shows it if None
+    :param plot: set False to skip plotting entirely
+    :return: (trace, pos, err) from simulate()
+    """
+    trace, pos, err = simulate(path, x_steps_per_mm, y_steps_per_mm)
+    print('Simulated %d moves, %d step iterations. Max error %.3f mm, mean %.3f mm.'
+          % (len(pos), len(trace), np.max(err, initial=0), np.mean(err) if len(err) > 0 else 0))
+
+    if plot:
+        plot_simulation(path, trace, pos, err, x_steps_per_mm, filename)
 
+    return trace, pos, err
 
-def main():
+
+def simplification_error(line: np.ndarray, simplified: np.ndarray) -> float:
+    """
+    Largest distance from any point of a closed contour line to its simplified line
+    :param line: contour points, shape (n, 1, 2) as returned by cv2.findContours
+    :param simplified: simplified contour points in the same format
+    :return: maximum error in mm
+    """
+    points = line.reshape(-1, 2).astype(float)
+    starts = simplified.reshape(-1, 2).astype(float)
+    ends = np.roll(starts, -1, axis=0)
+
+    # Distance from every point to every segment of the simplified line
+    seg = ends - starts
+    seg_len2 = np.sum(seg ** 2, axis=1)
+    rel = points[:, np.newaxis, :] - starts[np.newaxis, :, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        proj = np.where(seg_len2 > 0, np.sum(rel * seg, axis=2) / seg_len2, 0)
+    proj = np.clip(proj, 0, 1)
+    nearest = starts + proj[:, :, np.newaxis] * seg
+    dist = np.hypot(*(points[:, np.newaxis, :] - nearest).transpose(2, 0, 1))
+
+    return float(np.max(np.min(dist, axis=1)))
+
+
+def check_simplification(contours: tuple, tolerance_mm: float) -> bool:
+    """
+    Simplifies contours and checks every contour stays within tolerance of the original
+    :param contours: contour lines from cv2.findContours
+    :param tolerance_mm: simplification tolerance in mm
+    :return: True if the geometric error is within tolerance
+    """
+    simplified = simplifyContours(contours, tolerance_mm)
+    errors = np.array([simplification_error(line, simple) for line, simple in zip(contours, simplified)])
+    worst = np.max(errors) if len(errors) > 0 else 0
+
+    print('Max simplification error: %.3f mm (tolerance %.3f mm)' % (worst, tolerance_mm))
+    return worst <= tolerance_mm
+
+
+def main(save_dir: str = None):
+    """
+    Simulates the latest airtable image
+    :param save_dir: directory to save plots in instead of showing them
+    :return: None
+    """
     steps_per_mm = 10
 
-    run_img_processing()
-    path = pd.read_csv('bgd_coordinates.csv').values[:, 0:2]
-    path2 = pd.read_csv('img_coordinates.csv').values[:, 0:2]
+    path, path2 = run_img_processing(export=False)
+    path = path[:, 0:2]
+    path2 = path2[:, 0:2]
 
     # reorient
     path = path * -1
@@ -142,9 +164,14 @@ def main():
     path2 = path2 * -1
     path2 = path2 - np.array((np.min(path2[:, 0]), np.min(path2[:, 1])))
 
-    sim_frosting(path, steps_per_mm, steps_per_mm)
-    sim_frosting(path2, steps_per_mm, steps_per_mm)
+    if save_dir is None:
+        sim_frosting(path, steps_per_mm, steps_per_mm)
+        sim_frosting(path2, steps_per_mm, steps_per_mm)
+    else:
+        sim_frosting(path, steps_per_mm, steps_per_mm, os.path.join(save_dir, 'sim_background.png'))
+        sim_frosting(path2, steps_per_mm, steps_per_mm, os.path.join(save_dir, 'sim_image.png'))
 
 
 if __name__ == '__main__':
-    main()
+    # python -m main.sims.sim [plot directory]
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,259 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# step_executor.py
+#
+# Runs step schedules from a dedicated thread so planning and Python
+# bookkeeping never stall the motors. The planner (producer) pushes
+# timed step/throttle events into a bounded single-producer,
+# single-consumer ring buffer, and the executor thread (consumer)
+# drains it, sleeping until just before each event and spinning for
+# the rest.
+#
+# The ring buffer needs no locks: only the producer moves the head and
+# only the consumer moves the tail, and each publishes its index after
+# touching the buffer.
+#
+# abort() stops the executor thread at the next event and throws away
+# whatever is still queued, so an error or Ctrl-C doesn't wait for the
+# motors to finish the buffer.
+#
+# The executor counts underruns (the queue ran dry while more events
+# were coming) and samples queue depth, so it shows whether the planner
+# keeps ahead of the motors.
+#
+# NECESSARY FOR USE:
+# numpy
+
+from motion_planner import SCHEDULE_DTYPE
+import numpy as np
+import threading
+import time
+
+
+class StepQueue:
+    def __init__(self, capacity: int = 8192, dtype: np.dtype = SCHEDULE_DTYPE):
+        """
+        Constructs a single-producer, single-consumer ring buffer of events
+        :param capacity: most events the queue can hold
+        :param dtype: event dtype
+        """
+        self.buffer = np.empty(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.head = 0   # events ever written, only the producer changes it
+        self.tail = 0   # events ever read, only the consumer changes it
+        self.closed = False
+
+    def __len__(self) -> int:
+        return self.head - self.tail
+
+    def push(self, events: np.ndarray) -> int:
+        """
+        Adds as many events as fit without blocking. Producer only
+        :param events: events to add
+        :return: number of events added
+        """
+        count = min(len(events), self.capacity - (self.head - self.tail))
+        start = self.head % self.capacity
+        first = min(count, self.capacity - start)
+        self.buffer[start:start + first] = events[:first]
+        self.buffer[:count - first] = events[first:count]
+        self.head += count
+        return count
+
+    def put(self, events: np.ndarray, poll: float = 0.001, alive=None) -> int:
+        """
+        Adds every event, waiting for room as the consumer drains the queue. Producer only
+        :param events: events to add
+        :param poll: seconds to wait between checks for room
+        :param alive: function returning False once the consumer has stopped, so
+                      there is no point waiting for room. None waits regardless
+        :return: number of events added, fewer than len(events) if the consumer stopped
+        """
+        added = 0
+        while added < len(events):
+            added += self.push(events[added:])
+            if added < len(events):
+                if alive is not None and not alive():
+                    break
+                time.sleep(poll)
+        return added
+
+    def pop(self, max_count: int) -> np.ndarray:
+        """
+        Takes up to max_count events without blocking. Consumer only
+        :param max_count: most events to take
+        :return: copy of the events taken, oldest first
+        """
+        count = min(max_count, self.head - self.tail)
+        start = self.tail % self.capacity
+        first = min(count, self.capacity - start)
+        events = np.concatenate((self.buffer[start:start + first], self.buffer[:count - first]))
+        self.tail += count
+        return events
+
+    def close(self):
+        """Marks that the producer has no more events."""
+        self.closed = True
+        return
+
+
+class StepExecutor:
+    def __init__(self, x_axis, y_axis, extruder, clock=time.perf_counter, sleep=time.sleep,
+                 capacity: int = 8192, batch: int = 64, spin: float = 0.0005, realtime: bool = True):
+        """
+        Constructs a step executor
+        :param x_axis: x FrostingStepper
+        :param y_axis: y FrostingStepper
+        :param extruder: FrostingDCMotor to drive with each event's e value
+        :param clock: function returning the time in seconds
+        :param sleep: function sleeping for a number of seconds
+        :param capacity: most events queued ahead of the motors
+        :param batch: events taken from the queue at a time
+        :param spin: seconds before each event to stop sleeping and spin on the clock
+        :param realtime: False when clock is virtual, so there is nothing to spin for
+        """
+        self.x_axis = x_axis
+        self.y_axis = y_axis
+        self.extruder = extruder
+        self.clock = clock
+        self.sleep = sleep
+        self.queue = StepQueue(capacity)
+        self.batch = batch
+        self.spin = spin if realtime else 0
+        self.thread = None
+        self.error = None
+        self.aborted = False
+
+        # Metrics
+        self.steps = 0
+        self.underruns = 0
+        self.stall_time = 0.0
+        self.late_steps = 0
+        self.max_late = 0.0
+        self.depth_samples = []
+
+    def start(self):
+        """Starts the executor thread, which runs until close() and the queue empties."""
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return
+
+    def put(self, schedule: np.ndarray):
+        """
+        Queues a step schedule, blocking while the queue is full. Times continue
+        from the start of the first schedule, so later schedules must be offset.
+        :param schedule: step schedule from MotionPlanner.plan
+        :return: None
+        """
+        if self.error is not None:
+            raise self.error
+        # Stop waiting for room if the executor thread dies or is aborted
+        self.queue.put(schedule, alive=lambda: self.thread.is_alive() and not self.aborted)
+        if self.error is not None:
+            raise self.error
+        return
+
+    def close(self):
+        """Marks the end of the schedule."""
+        self.queue.close()
+        return
+
+    def abort(self):
+        """Stops the executor thread without running the queued steps, and waits for it."""
+        self.aborted = True
+        self.queue.close()
+        if self.thread is not None:
+            self.thread.join()
+        return
+
+    def join(self):
+        """Waits for every queued step to run."""
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return
+
+    def _wait_until(self, deadline: float):
+        """Sleeps until just before deadline, then spins on the clock."""
+        delay = deadline - self.clock() - self.spin
+        if delay > 0:
+            self.sleep(delay)
+        while self.spin and self.clock() < deadline:
+            pass
+        return
+
+    def _run(self):
+        try:
+            self._drain()
+        except Exception as e:
+            self.error = e
+        return
+
+    def _drain(self):
+        e_current = None
+        start = None
+        while True:
+            if self.aborted:
+                # Drop the queued steps, only the consumer moves the tail
+                self.queue.tail = self.queue.head
+                return
+            depth = len(self.queue)
+            if depth == 0:
+                if self.queue.closed and len(self.queue) == 0:
+                    return
+                # Starved: wait for the planner, then shift the timeline by the stall
+                if start is not None:
+                    self.underruns += 1
+                stalled = self.clock()
+                while len(self.queue) == 0 and not self.queue.closed:
+                    time.sleep(0.0005)
+                if start is not None:
+                    stall = self.clock() - stalled
+                    self.stall_time += stall
+                    start += stall
+                continue
+
+            self.depth_samples.append(depth)
+            events = self.queue.pop(self.batch).tolist()
+            if start is None:
+                start = self.clock() - events[0][0]
+
+            for t, step_x, step_y, e in events:
+                if self.aborted:
+                    break
+                if e != e_current:
+                    self.extruder.drive(e)
+                    e_current = e
+
+                deadline = start + t
+                late = self.clock() - deadline
+                if late > 0:
+                    if late > 0.001:
+                        self.late_steps += 1
+                    self.max_late = max(self.max_late, late)
+                else:
+                    self._wait_until(deadline)
+
+                if step_x:
+                    self.x_axis.step(step_x)
+                if step_y:
+                    self.y_axis.step(step_y)
+                self.steps += 1
+
+    def stats(self) -> dict:
+        """
+        Executor metrics
+        :return: dict of steps run, underruns, seconds stalled waiting for the
+                 planner, steps more than 1 ms late, the latest step, and
+                 min/mean/max queue depth
+        """
+        depths = np.array(self.depth_samples) if self.depth_samples else np.zeros(1)
+        return {'steps': self.steps,
+                'underruns': self.underruns,
+                'stall_time': self.stall_time,
+                'late_steps': self.late_steps,
+                'max_late': self.max_late,
+                'min_depth': int(depths.min()),
+                'mean_depth': float(depths.mean()),
+                'max_depth': int(depths.max())}
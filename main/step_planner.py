@@ -0,0 +1,148 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# step_planner.py
+#
+# Plans the interleaved x and y stepper steps for straight line moves.
+# Uses a line (DDA/Bresenham) algorithm so a move costs
+# max(steps_x, steps_y) iterations instead of lcm(steps_x, steps_y).
+#
+# A step plan is an (n, 2) int8 array, one row per loop iteration:
+#     [[x1, y1],
+#      [x2, y2],
+#      ...]
+# where each value is -1, 0 or 1 (step backward, no step, step forward).
+#
+# NECESSARY FOR USE:
+# numpy
+
+import numpy as np
+
+STEP_DTYPE = np.int8
+
+# Step counts are rounded to this many decimals before truncating or rounding
+# to whole steps, so float error in a move like 0.3 - 0.1 mm doesn't lose a step
+ROUNDING_DECIMALS = 6
+
+
+def position_steps(positions: np.ndarray, steps_per_mm: float) -> np.ndarray:
+    """
+    Nearest whole step to absolute positions on one axis, halves rounding up.
+    Moves go to the nearest step to their target measured from home, so the
+    rounding error of each move is never more than half a step and never
+    builds up over a drawing.
+    :param positions: positions in mm
+    :param steps_per_mm: steps per mm on the axis
+    :return: int64 step positions
+    """
+    scaled = np.round(np.asarray(positions, dtype=float) * steps_per_mm, ROUNDING_DECIMALS)
+    return np.floor(scaled + 0.5).astype(np.int64)
+
+
+def move_steps(dx: float, dy: float, x_steps_per_mm: float, y_steps_per_mm: float) -> tuple:
+    """
+    Number of signed steps needed to move dx, dy mm on their own.
+    Truncates towards zero. Moves in a drawing use position_steps instead
+    :param dx: distance to move in x (can be negative)
+    :param dy: distance to move in y (can be negative)
+    :param x_steps_per_mm: steps per mm on the x axis
+    :param y_steps_per_mm: steps per mm on the y axis
+    :return: (steps_x, steps_y) signed step counts
+    """
+    steps_x = int(round(abs(dx) * x_steps_per_mm, ROUNDING_DECIMALS))
+    steps_y = int(round(abs(dy) * y_steps_per_mm, ROUNDING_DECIMALS))
+    return int(np.sign(dx)) * steps_x, int(np.sign(dy)) * steps_y
+
+
+def plan_steps(steps_x: int, steps_y: int) -> np.ndarray:
+    """
+    Plans the interleaved step sequence for a straight move of
+    steps_x and steps_y signed steps. The axis with more steps steps
+    on every iteration, the other steps whenever its rounded
+    position along the line advances.
+    :param steps_x: signed number of x steps
+    :param steps_y: signed number of y steps
+    :return: (max(|steps_x|, |steps_y|), 2) int8 step plan
+    """
+    n_x = abs(int(steps_x))
+    n_y = abs(int(steps_y))
+    n = max(n_x, n_y)
+
+    plan = np.zeros((n, 2), dtype=STEP_DTYPE)
+    if n == 0:
+        return plan
+
+    # Rounded position of each axis after iteration i is (i * n_axis + n // 2) // n,
+    # so each iteration advances an axis by at most one step
+    i = np.arange(n + 1, dtype=np.int64)
+    half = n // 2
+    plan[:, 0] = np.diff((i * n_x + half) // n) * np.sign(steps_x)
+    plan[:, 1] = np.diff((i * n_y + half) // n) * np.sign(steps_y)
+    return plan
+
+
+def plan_move(dx: float, dy: float, x_steps_per_mm: float, y_steps_per_mm: float) -> np.ndarray:
+    """
+    Plans the step sequence for a move of dx, dy mm
+    :param dx: distance to move in x (can be negative)
+    :param dy: distance to move in y (can be negative)
+    :param x_steps_per_mm: steps per mm on the x axis
+    :param y_steps_per_mm: steps per mm on the y axis
+    :return: (n, 2) int8 step plan
+    """
+    steps_x, steps_y = move_steps(dx, dy, x_steps_per_mm, y_steps_per_mm)
+    return plan_steps(steps_x, steps_y)
+
+
+def plan_path(commands: np.ndarray, x_steps_per_mm: float, y_steps_per_mm: float,
+              start: np.ndarray = None) -> tuple:
+    """
+    Plans the step sequence for a whole drawing ahead of time.
+    Each move ends at the nearest whole step to its target, the same
+    as FrostingMainBoard.go_and_extrude.
+    :param commands: [[x1, y1, ...], ...[xn, yn, ...]] coordinates in mm
+    :param x_steps_per_mm: steps per mm on the x axis
+    :param y_steps_per_mm: steps per mm on the y axis
+    :param start: [x, y] location before the first move, defaults to [0, 0]
+    :return: (plan, offsets) where plan is the (n, 2) int8 step plan of
+             every move concatenated and plan[offsets[k]:offsets[k + 1]]
+             is the plan for move k
+    """
+    if start is None:
+        start = np.zeros(2)
+    commands = np.asarray(commands, dtype=float)
+    points = np.vstack((np.asarray(start, dtype=float)[np.newaxis, :], commands[:, 0:2]))
+
+    positions = np.column_stack((position_steps(points[:, 0], x_steps_per_mm),
+                                 position_steps(points[:, 1], y_steps_per_mm)))
+    return plan_step_counts(np.diff(positions, axis=0))
+
+
+def plan_step_counts(steps: np.ndarray) -> tuple:
+    """
+    Plans the step sequence for a series of moves given in steps.
+    :param steps: [[steps_x1, steps_y1], ...] signed step counts of each move
+    :return: (plan, offsets) where plan is the (n, 2) int8 step plan of
+             every move concatenated and plan[offsets[k]:offsets[k + 1]]
+             is the plan for move k
+    """
+    steps = np.asarray(steps, dtype=np.int64).reshape(-1, 2)
+    signs = np.sign(steps)
+    steps = np.abs(steps)
+
+    counts = steps.max(axis=1)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    # Iteration number within its own move for every step of the drawing
+    move = np.repeat(np.arange(len(counts)), counts)
+    i = np.arange(offsets[-1], dtype=np.int64) - offsets[move] + 1
+    n = counts[move]
+    half = n // 2
+
+    plan = np.empty((offsets[-1], 2), dtype=STEP_DTYPE)
+    for axis in range(2):
+        n_axis = steps[move, axis]
+        plan[:, axis] = ((i * n_axis + half) // n - ((i - 1) * n_axis + half) // n) * signs[move, axis]
+
+    return plan, offsets
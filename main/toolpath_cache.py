@@ -0,0 +1,176 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# toolpath_cache.py
+#
+# On-disk cache of downloaded images and processed toolpaths, so a
+# design repeated for a batch of cakes is only downloaded and processed
+# once. Entries are keyed by the sha256 of the image file plus the
+# processing parameters, and the least recently used entries are
+# evicted once the cache grows past its size limit.
+#
+# Layout of the cache directory:
+#     attachments.json        Airtable attachment id -> image hash
+#     img_<hash>.npy          decoded grayscale image
+#     path_<key>.npz          command arrays for an image and parameters
+#
+# NECESSARY FOR USE:
+# numpy
+
+import hashlib
+import json
+import os
+import numpy as np
+
+
+def content_hash(data: bytes) -> str:
+    """sha256 of an image file's contents"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class ToolpathCache:
+    def __init__(self, cache_dir: str = 'toolpath_cache', max_bytes: int = 256 * 2 ** 20):
+        """
+        Constructs a toolpath cache
+        :param cache_dir: directory to keep cached files in, created if missing
+        :param max_bytes: total size of cached files before the least recently used are evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._attachments_file = os.path.join(cache_dir, 'attachments.json')
+        try:
+            with open(self._attachments_file) as f:
+                self.attachments = json.load(f)
+        except (OSError, ValueError):
+            self.attachments = {}
+
+    @staticmethod
+    def key(image_hash: str, params: dict) -> str:
+        """
+        Cache key for the toolpath of an image processed with params
+        :param image_hash: content_hash() of the image file
+        :param params: processing parameters, anything json serializable
+        :return: hex key
+        """
+        params_json = json.dumps(params, sort_keys=True)
+        return hashlib.sha256((image_hash + params_json).encode()).hexdigest()
+
+    def _path(self, prefix: str, name: str, extension: str) -> str:
+        return os.path.join(self.cache_dir, prefix + name + extension)
+
+    @staticmethod
+    def _touch(path: str):
+        """Marks a file as just used for LRU eviction."""
+        os.utime(path)
+        return
+
+    def image_hash(self, attachment_id: str) -> str:
+        """
+        Hash of an Airtable attachment that was downloaded before
+        :param attachment_id: Airtable attachment id
+        :return: image hash, or None if it is unknown
+        """
+        return self.attachments.get(attachment_id)
+
+    def remember_attachment(self, attachment_id: str, image_hash: str):
+        """
+        Records the hash of a downloaded Airtable attachment, so it isn't downloaded again
+        :param attachment_id: Airtable attachment id
+        :param image_hash: content_hash() of the image file
+        :return: None
+        """
+        self.attachments[attachment_id] = image_hash
+        # Worker processes share the file, so write it whole and swap it in
+        tmp = '%s.%d.tmp' % (self._attachments_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.attachments, f)
+        os.replace(tmp, self._attachments_file)
+        return
+
+    def get_image(self, image_hash: str) -> np.ndarray:
+        """
+        Gets a decoded image
+        :param image_hash: content_hash() of the image file
+        :return: grayscale image, or None if it isn't cached
+        """
+        path = self._path('img_', image_hash, '.npy')
+        try:
+            img = np.load(path)
+        except (OSError, ValueError):
+            return None
+        self._touch(path)
+        return img
+
+    def put_image(self, image_hash: str, img: np.ndarray):
+        """
+        Caches a decoded image
+        :param image_hash: content_hash() of the image file
+        :param img: grayscale image
+        :return: None
+        """
+        path = self._path('img_', image_hash, '.npy')
+        np.save(path + '.tmp.npy', img)
+        os.replace(path + '.tmp.npy', path)
+        self.evict()
+        return
+
+    def get(self, key: str) -> dict:
+        """
+        Gets cached command arrays
+        :param key: key() of the image and parameters
+        :return: {name: array}, or None if they aren't cached
+        """
+        path = self._path('path_', key, '.npz')
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self._touch(path)
+        self.hits += 1
+        return arrays
+
+    def put(self, key: str, **arrays):
+        """
+        Caches command arrays
+        :param key: key() of the image and parameters
+        :param arrays: arrays to store by name, e.g. bgd=..., img=...
+        :return: None
+        """
+        path = self._path('path_', key, '.npz')
+        np.savez(path + '.tmp.npz', **arrays)
+        os.replace(path + '.tmp.npz', path)
+        self.evict()
+        return
+
+    def size(self) -> int:
+        """Total bytes of cached images and toolpaths"""
+        return sum(os.path.getsize(os.path.join(self.cache_dir, name)) for name in self._entries())
+
+    def _entries(self) -> list:
+        return [name for name in os.listdir(self.cache_dir)
+                if name.startswith(('img_', 'path_')) and '.tmp.' not in name]
+
+    def evict(self):
+        """
+        Deletes least recently used files until the cache fits in max_bytes
+        :return: None
+        """
+        entries = []
+        for name in self._entries():
+            stat = os.stat(os.path.join(self.cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+        return
@@ -0,0 +1,202 @@
+# ME35: Robotics Final Project
+# Tufts University 2022.
+#
+# toolpath_fit.py
+#
+# Compresses toolpaths by fitting circular arcs through runs of short
+# moves. Curves come out of findContours as dense polylines; replacing
+# each run that lies within a tolerance of a circle with one G2/G3
+# style arc leaves far fewer commands to store, send and plan.
+#
+# A fitted toolpath is an (n, 6) float array, one row per move:
+#     [x, y, e, g, i, j]
+# where x, y is the end of the move, e the extruder value, g is LINE,
+# CW or CCW (like G1, G2 and G3) and i, j is the arc center relative to
+# the start of the move (0 for lines). Angles are measured with x right
+# and y up, so CCW means a positive turn in command coordinates.
+#
+# expand() turns arcs back into chords short enough to stay within a
+# fraction of a step of the circle, which FrostingMainBoard.draw_fitted
+# plans and draws as one continuous step stream.
+#
+# NECESSARY FOR USE:
+# numpy
+
+import numpy as np
+
+LINE = 1
+CW = 2
+CCW = 3
+
+
+def circle_through(p1: np.ndarray, p2: np.ndarray, p3: np.ndarray) -> tuple:
+    """
+    Circle through three points
+    :return: (center, radius), or (None, inf) if the points are collinear
+    """
+    ax, ay = p1
+    bx, by = p2
+    cx, cy = p3
+    d = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+    if abs(d) < 1e-9:
+        return None, np.inf
+    a2 = ax * ax + ay * ay
+    b2 = bx * bx + by * by
+    c2 = cx * cx + cy * cy
+    center = np.array(((a2 * (by - cy) + b2 * (cy - ay) + c2 * (ay - by)) / d,
+                       (a2 * (cx - bx) + b2 * (ax - cx) + c2 * (bx - ax)) / d))
+    return center, np.hypot(*(p1 - center))
+
+
+def _fit(points: np.ndarray, tolerance: float, max_radius: float):
+    """
+    Fits one arc through a run of points
+    :param points: (m, 2) points, the first is the start of the arc
+    :return: (center, direction) if every point and chord midpoint is within
+             tolerance of the arc, otherwise None
+    """
+    center, radius = circle_through(points[0], points[len(points) // 2], points[-1])
+    if center is None or radius > max_radius:
+        return None
+
+    midpoints = (points[1:] + points[:-1]) / 2
+    for check in (points, midpoints):
+        if np.max(np.abs(np.hypot(*(check - center).T) - radius)) > tolerance:
+            return None
+
+    # Must go round the center one way, less than a full circle. Pixel
+    # staircases wiggle about the arc, so only the angle has to be monotonic
+    angles = np.arctan2(points[:, 1] - center[1], points[:, 0] - center[0])
+    steps = np.angle(np.exp(1j * np.diff(angles)))
+    if abs(np.sum(steps)) > 1.9 * np.pi or not (np.all(steps >= 0) or np.all(steps <= 0)):
+        return None
+
+    return center, CCW if np.sum(steps) > 0 else CW
+
+
+def fit_arcs(commands: np.ndarray, tolerance: float = 0.5, min_moves: int = 3,
+             max_radius: float = 500, start: np.ndarray = None) -> np.ndarray:
+    """
+    Replaces runs of moves lying on a circle with arcs.
+    Moves only join an arc if they have the same extruder value.
+    :param commands: [[x1, y1, e1], ...[xn, yn, en]] coordinates in mm
+    :param tolerance: mm the arc may be from the original points and moves
+    :param min_moves: fewest moves worth replacing with an arc
+    :param max_radius: arcs any flatter than this are left as lines
+    :param start: [x, y] location before the first move, defaults to [0, 0]
+    :return: fitted toolpath, (n, 6) [x, y, e, g, i, j]
+    """
+    commands = np.asarray(commands, dtype=float)
+    if start is None:
+        start = np.zeros(2)
+    points = np.vstack((np.asarray(start, dtype=float)[np.newaxis, :], commands[:, 0:2]))
+    e = np.concatenate(([np.nan], commands[:, 2]))
+    n = len(points) - 1
+
+    # Index of the last move with the same extruder value as each move
+    same_until = np.empty(n + 1, dtype=np.int64)
+    same_until[-1] = n
+    for k in range(n - 1, 0, -1):
+        same_until[k] = same_until[k + 1] if e[k] == e[k + 1] else k
+
+    fitted = []
+    k = 0
+    while k < n:
+        last = same_until[k + 1]
+        best = None
+        end = k + min_moves
+        if end <= last:
+            fit = _fit(points[k:end + 1], tolerance, max_radius)
+            if fit is not None:
+                # Grow the arc by doubling, then bisect for its last move
+                best = (end, fit)
+                step = min_moves
+                while best[0] < last:
+                    end = min(best[0] + step, last)
+                    fit = _fit(points[k:end + 1], tolerance, max_radius)
+                    if fit is None:
+                        break
+                    best = (end, fit)
+                    step *= 2
+                lo, hi = best[0], end
+                while fit is None and hi - lo > 1:
+                    mid = (lo + hi) // 2
+                    mid_fit = _fit(points[k:mid + 1], tolerance, max_radius)
+                    if mid_fit is None:
+                        hi = mid
+                    else:
+                        lo, best = mid, (mid, mid_fit)
+
+        if best is None:
+            fitted.append((points[k + 1, 0], points[k + 1, 1], e[k + 1], LINE, 0, 0))
+            k += 1
+        else:
+            end, (center, direction) = best
+            i, j = center - points[k]
+            fitted.append((points[end, 0], points[end, 1], e[end], direction, i, j))
+            k = end
+
+    return np.array(fitted, dtype=float).reshape(-1, 6)
+
+
+def expand(fitted: np.ndarray, max_error: float = 0.05, start: np.ndarray = None) -> np.ndarray:
+    """
+    Turns a fitted toolpath back into straight moves, splitting each arc into
+    chords that stay within max_error of the circle
+    :param fitted: fitted toolpath, (n, 6) [x, y, e, g, i, j]
+    :param max_error: mm each chord may be inside the arc
+    :param start: [x, y] location before the first move, defaults to [0, 0]
+    :return: [[x1, y1, e1], ...[xn, yn, en]] coordinates in mm
+    """
+    fitted = np.asarray(fitted, dtype=float).reshape(-1, 6)
+    if start is None:
+        start = np.zeros(2)
+    starts = np.vstack((np.asarray(start, dtype=float)[np.newaxis, :], fitted[:-1, 0:2]))
+
+    pieces = []
+    lines_from = 0
+    for k in np.flatnonzero(fitted[:, 3] != LINE):
+        pieces.append(fitted[lines_from:k, 0:3])
+        lines_from = k + 1
+
+        center = starts[k] + fitted[k, 4:6]
+        radius = np.hypot(*fitted[k, 4:6])
+        a0 = np.arctan2(*(starts[k] - center)[::-1])
+        a1 = np.arctan2(*(fitted[k, 0:2] - center)[::-1])
+        sign = 1 if fitted[k, 3] == CCW else -1
+        sweep = (sign * (a1 - a0)) % (2 * np.pi)
+
+        # Chord angle whose sagitta is max_error
+        chord_angle = 2 * np.arccos(max(1 - max_error / radius, -1))
+        count = max(int(np.ceil(sweep / chord_angle)), 1)
+        angles = a0 + sign * sweep * np.arange(1, count + 1) / count
+
+        arc = np.empty((count, 3))
+        arc[:, 0] = center[0] + radius * np.cos(angles)
+        arc[:, 1] = center[1] + radius * np.sin(angles)
+        arc[-1, 0:2] = fitted[k, 0:2]    # end exactly where the command says
+        arc[:, 2] = fitted[k, 2]
+        pieces.append(arc)
+    pieces.append(fitted[lines_from:, 0:3])
+
+    return np.concatenate(pieces)
+
+
+def max_deviation(commands: np.ndarray, expanded: np.ndarray) -> float:
+    """
+    Furthest any original point is from the expanded path, for checking fits
+    :param commands: original coordinates
+    :param expanded: expand() of the fitted coordinates
+    :return: distance in mm
+    """
+    points = np.asarray(commands, dtype=float)[:, 0:2]
+    path = np.asarray(expanded, dtype=float)[:, 0:2]
+    a = path[:-1]
+    d = np.diff(path, axis=0)
+    length2 = np.maximum(np.sum(d * d, axis=1), 1e-12)
+
+    worst = 0.0
+    for p in points:
+        t = np.clip(np.sum((p - a) * d, axis=1) / length2, 0, 1)
+        worst = max(worst, np.min(np.hypot(*(a + t[:, np.newaxis] * d - p).T)))
+    return worst